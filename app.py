@@ -1,39 +1,56 @@
 from itsdangerous import URLSafeSerializer, BadSignature
 from functools import wraps
+from bisect import bisect_left
 
 # NOTE (Render / Python 3.14):
 # eventlet is not compatible with Python 3.14 at the moment (AttributeError: start_joinable_thread).
 # This app is configured to use Flask-SocketIO in "threading" mode so it runs on Render's Python 3.14.
 # Start command suggestion:
 #   gunicorn -w 1 --threads 4 -k gthread -b 0.0.0.0:$PORT app:app
+# Vários workers: defina BACKPLANE_URL=redis://... (ver BACKPLANE abaixo) e use
+# sessões fixas (sticky) no balanceador para o Socket.IO em polling:
+#   gunicorn -w 4 --threads 4 -k gthread -b 0.0.0.0:$PORT app:app
 
 import os
 import io
 import re
 import json
+import math
+import atexit
+import pickle
 import random
-from flask_socketio import SocketIO
+import struct
+import threading
+import uuid
+import zlib
+from flask_socketio import SocketIO, emit, join_room, leave_room, disconnect
+from socketio import PubSubManager
 import unicodedata
 from datetime import datetime, timedelta, time, date
-from collections import Counter, defaultdict
+from collections import Counter, OrderedDict, defaultdict, deque
 from urllib.parse import urlparse, parse_qs
-from functools import wraps
+from functools import wraps, partial
 from decimal import Decimal
+from queue import Queue
+from socket import create_connection
+from time import monotonic
 
 from flask import (
     Flask, render_template, render_template_string, request, redirect, url_for,
-    flash, session, send_file, jsonify, abort, current_app, 
+    flash, session, send_file, jsonify, abort, current_app, has_app_context,
 )
 from flask_login import LoginManager, login_user, logout_user, current_user, login_required
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import func
-from sqlalchemy.orm import joinedload
+from sqlalchemy import func, bindparam, event as sa_event
+from sqlalchemy.orm import joinedload, defer
 from sqlalchemy.sql import text
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 from itsdangerous import URLSafeSerializer, BadSignature
 
+import numpy as np
 import pandas as pd
 import holidays
 import pytz
@@ -50,6 +67,259 @@ app.config['SECRET_KEY'] = os.environ.get(
     'COOPEX_ULTRA_SEGURA_2024_FIXA'
 )
 
+# =========================================================
+# BACKPLANE ENTRE WORKERS (EMITS + ESTADO EFÊMERO COMPARTILHADO)
+# =========================================================
+# Sem BACKPLANE_URL: tudo no próprio processo (um worker, como sempre foi).
+# Com BACKPLANE_URL=redis://[:senha@]host:6379/0: os emits do Socket.IO passam
+# pelo canal 'socketio' para todos os workers, as posições ao vivo são
+# replicadas pelo canal 'posicoes', e contadores de taxa / liderança das
+# tarefas de fundo ficam no servidor (protocolo Redis, RESP2).
+BACKPLANE_URL = os.getenv("BACKPLANE_URL", "").strip()
+WORKER_ID = uuid.uuid4().hex
+
+
+class ErroBackplane(Exception):
+    pass
+
+
+class BackplaneLocal:
+    """Mesmo contrato do BackplaneRedis, em memória (um processo só)."""
+    distribuido = False
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hashes = defaultdict(dict)
+        self._contadores = {}             # chave -> (valor, expira_em | None)
+        self._assinantes = defaultdict(list)
+
+    def publicar(self, canal, dados):
+        with self._lock:
+            filas = list(self._assinantes[canal])
+        for fila in filas:
+            fila.put(dados)
+
+    def escutar(self, canal):
+        fila = Queue()
+        with self._lock:
+            self._assinantes[canal].append(fila)
+        while True:
+            yield fila.get()
+
+    def hset(self, chave, campo, valor):
+        with self._lock:
+            self._hashes[chave][str(campo)] = valor
+
+    def gravar_e_publicar(self, chave, campo, canal, valor):
+        self.hset(chave, campo, valor)
+        self.publicar(canal, valor)
+
+    def hget(self, chave, campo):
+        with self._lock:
+            return self._hashes[chave].get(str(campo))
+
+    def hgetall(self, chave) -> dict:
+        with self._lock:
+            return dict(self._hashes[chave])
+
+    def hdel(self, chave, campo):
+        with self._lock:
+            self._hashes[chave].pop(str(campo), None)
+
+    def incr(self, chave, ttl_s=None) -> int:
+        agora = datetime.utcnow().timestamp()
+        with self._lock:
+            valor, expira = self._contadores.get(chave, (0, None))
+            if expira is not None and expira <= agora:
+                valor, expira = 0, None
+            valor += 1
+            if valor == 1 and ttl_s:
+                expira = agora + ttl_s
+            self._contadores[chave] = (valor, expira)
+            return valor
+
+    def lider(self, tarefa, ttl_s) -> bool:
+        return True
+
+
+class BackplaneRedis:
+    """Cliente mínimo do protocolo Redis (RESP2): uma conexão por thread + uma por assinatura."""
+    distribuido = True
+
+    def __init__(self, url):
+        u = urlparse(url)
+        self.host = u.hostname or "localhost"
+        self.port = u.port or 6379
+        self.senha = u.password
+        self.db = int((u.path or "/0").strip("/") or 0)
+        self._local = threading.local()
+
+    # --- protocolo ---
+    def _abrir(self):
+        sock = create_connection((self.host, self.port), timeout=10)
+        arq = sock.makefile("rb")
+        conn = (sock, arq)
+        if self.senha:
+            self._enviar(conn, "AUTH", self.senha)
+        if self.db:
+            self._enviar(conn, "SELECT", self.db)
+        return conn
+
+    @staticmethod
+    def _codificar(args) -> bytes:
+        partes = [b"*%d\r\n" % len(args)]
+        for a in args:
+            b = a if isinstance(a, bytes) else str(a).encode("utf-8")
+            partes.append(b"$%d\r\n%s\r\n" % (len(b), b))
+        return b"".join(partes)
+
+    @classmethod
+    def _ler(cls, arq):
+        linha = arq.readline()
+        if not linha:
+            raise ConnectionError("backplane fechou a conexão")
+        tipo, resto = linha[:1], linha[1:-2]
+        if tipo == b"+":
+            return resto.decode()
+        if tipo == b"-":
+            raise ErroBackplane(resto.decode())
+        if tipo == b":":
+            return int(resto)
+        if tipo == b"$":
+            n = int(resto)
+            if n < 0:
+                return None
+            dados = arq.read(n + 2)
+            return dados[:-2]
+        if tipo == b"*":
+            n = int(resto)
+            return None if n < 0 else [cls._ler(arq) for _ in range(n)]
+        raise ErroBackplane(f"resposta inválida: {linha!r}")
+
+    def _enviar(self, conn, *args):
+        conn[0].sendall(self._codificar(args))
+        return self._ler(conn[1])
+
+    def comando(self, *args):
+        for tentativa in (1, 2):
+            conn = getattr(self._local, "conn", None)
+            try:
+                if conn is None:
+                    conn = self._local.conn = self._abrir()
+                return self._enviar(conn, *args)
+            except (OSError, ConnectionError):
+                self._local.conn = None
+                try:
+                    conn and conn[0].close()
+                except Exception:
+                    pass
+                if tentativa == 2:
+                    raise
+
+    @staticmethod
+    def _texto(v):
+        return v.decode("utf-8") if isinstance(v, bytes) else v
+
+    # --- contrato do backplane ---
+    def publicar(self, canal, dados):
+        self.comando("PUBLISH", canal, dados)
+
+    def escutar(self, canal):
+        espera = 1
+        while True:
+            try:
+                conn = self._abrir()
+                conn[0].settimeout(None)
+                self._enviar(conn, "SUBSCRIBE", canal)
+                espera = 1
+                while True:
+                    msg = self._ler(conn[1])
+                    if isinstance(msg, list) and len(msg) == 3 and msg[0] == b"message":
+                        yield msg[2]
+            except (OSError, ConnectionError, ErroBackplane) as e:
+                app.logger.warning(f"Backplane: assinatura de {canal} caiu ({e}); nova tentativa em {espera}s")
+                threading.Event().wait(espera)
+                espera = min(espera * 2, 30)
+
+    def hset(self, chave, campo, valor):
+        self.comando("HSET", chave, campo, valor)
+
+    def gravar_e_publicar(self, chave, campo, canal, valor):
+        """HSET + PUBLISH num só envio (pipeline), uma ida e volta por ping."""
+        conn = getattr(self._local, "conn", None) or self._abrir()
+        self._local.conn = conn
+        try:
+            conn[0].sendall(self._codificar(("HSET", chave, campo, valor))
+                            + self._codificar(("PUBLISH", canal, valor)))
+            self._ler(conn[1])
+            self._ler(conn[1])
+        except (OSError, ConnectionError):
+            self._local.conn = None
+            raise
+
+    def hget(self, chave, campo):
+        return self._texto(self.comando("HGET", chave, campo))
+
+    def hgetall(self, chave) -> dict:
+        r = self.comando("HGETALL", chave) or []
+        return {self._texto(r[i]): self._texto(r[i + 1]) for i in range(0, len(r), 2)}
+
+    def hdel(self, chave, campo):
+        self.comando("HDEL", chave, campo)
+
+    def incr(self, chave, ttl_s=None) -> int:
+        valor = self.comando("INCR", chave)
+        if valor == 1 and ttl_s:
+            self.comando("EXPIRE", chave, int(ttl_s))
+        return valor
+
+    def lider(self, tarefa, ttl_s) -> bool:
+        """Só um worker roda cada tarefa de fundo; a liderança expira se ele sumir."""
+        chave = f"lider:{tarefa}"
+        if self.comando("SET", chave, WORKER_ID, "NX", "EX", int(ttl_s)) == "OK":
+            return True
+        if self._texto(self.comando("GET", chave)) == WORKER_ID:
+            self.comando("EXPIRE", chave, int(ttl_s))
+            return True
+        return False
+
+
+class GerenciadorSocketBackplane(PubSubManager):
+    """Client manager do python-socketio que propaga emits/salas pelo backplane."""
+    name = "coopex-backplane"
+
+    def __init__(self, backplane, channel="socketio"):
+        super().__init__(channel=channel)
+        self.backplane = backplane
+
+    def _publish(self, data):
+        try:
+            self.backplane.publicar(self.channel, pickle.dumps(data))
+        except Exception as e:
+            app.logger.warning(f"Backplane: falha ao publicar emit ({e})")
+
+    def _listen(self):
+        yield from self.backplane.escutar(self.channel)
+
+
+BACKPLANE = BackplaneRedis(BACKPLANE_URL) if BACKPLANE_URL else BackplaneLocal()
+
+
+def contar_taxa(chave, janela_s) -> int:
+    """Quantas vezes 'chave' ocorreu na janela atual (compartilhado entre workers)."""
+    janela = int(datetime.utcnow().timestamp() // janela_s)
+    return BACKPLANE.incr(f"taxa:{chave}:{janela}", ttl_s=janela_s * 2)
+
+
+def e_lider(tarefa, intervalo_s) -> bool:
+    """True se este worker deve rodar a tarefa de fundo nesta rodada."""
+    try:
+        return BACKPLANE.lider(tarefa, max(15, intervalo_s * 3))
+    except Exception as e:
+        app.logger.warning(f"Backplane: falha na liderança de {tarefa} ({e})")
+        return False
+
+
 # 🔽 INSTÂNCIA DO SOCKETIO LIGADA NO APP
 from flask_socketio import SocketIO
 
@@ -57,9 +327,13 @@ socketio = SocketIO(
     app,
     async_mode="threading",   # (opcional, mas bom deixar explícito)
     logger=False,
-    engineio_logger=False
+    engineio_logger=False,
+    **({"client_manager": GerenciadorSocketBackplane(BACKPLANE)} if BACKPLANE.distribuido else {}),
 )
 
+# namespace do app nativo (token mobile no auth do connect; pings e ofertas no mesmo socket)
+SOCKET_NS_MOBILE = "/mobile"
+
 
 # --- Admins fixos (usuario: coopex, 2 senhas) ---
 ADMIN_CREDENTIALS = {
@@ -263,6 +537,8 @@ class Cooperado(db.Model):
     last_accuracy_m = db.Column(db.Float, nullable=True)
 
     last_moving_at = db.Column(db.DateTime, nullable=True)  # última vez que estava se movendo
+    # offline | ocioso | livre | em_corrida — mantido pela varredura de presença
+    presenca = db.Column(db.String(20), nullable=True)
 
     def set_senha(self, senha):
         self.senha_hash = generate_password_hash(senha)
@@ -315,6 +591,9 @@ class Entrega(db.Model):
         default=datetime.utcnow,  # UTC naive; converter na view
     )
     data_atribuida = db.Column(db.DateTime, nullable=True)
+    # chegadas detectadas pela cerca (geofence) nos pings do motoboy (UTC naive)
+    chegada_coleta_em = db.Column(db.DateTime, nullable=True)
+    chegada_destino_em = db.Column(db.DateTime, nullable=True)
 
     # Relação com cooperado
     cooperado_id = db.Column(
@@ -376,6 +655,8 @@ class Entrega(db.Model):
     #       {"bairro": "Petrópolis"}
     #     ]
     #   }
+    # Depois de roteirizar (roteirizar_entrega / pedido do cliente) vem também:
+    #   "rota": {"km_estimado": 12.4, "ordem_original": [1, 0], "calculada_em": "..."}
     paradas_json = db.Column(db.Text, nullable=True)
 
     # Status da corrida na visão do cooperado
@@ -388,6 +669,13 @@ class Entrega(db.Model):
         default='pendente'
     )
 
+    # Concorrência otimista: o SQLAlchemy incrementa a cada UPDATE e grava com
+    # "WHERE versao = <a que foi lida>". Se outro operador gravou antes, o commit
+    # levanta StaleDataError em vez de sobrescrever em silêncio.
+    versao = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+
+    __mapper_args__ = {"version_id_col": versao}
+
     # =========================
     #   HELPERS DE ORIGEM
     # =========================
@@ -571,6 +859,272 @@ class Entrega(db.Model):
 # =========================================================
 # HELPER: EMITIR ATUALIZAÇÃO EM TEMPO REAL
 # =========================================================
+def estado_entrega(entrega: Entrega) -> dict:
+    """Estado atual da entrega (painéis em tempo real e respostas 409 de conflito)."""
+    return {
+        "id": entrega.id,
+        "versao": entrega.versao,
+        "cliente": entrega.cliente,
+        "bairro": entrega.bairro,
+        "valor": float(entrega.valor or 0),
+        "status": entrega.status,
+        "status_pagamento": entrega.status_pagamento,
+        "status_corrida": entrega.status_corrida,
+        "pagamento": entrega.pagamento,
+        "recebido_por": entrega.recebido_por,
+        "cooperado_id": entrega.cooperado_id,
+        "cooperado_nome": entrega.cooperado.nome if entrega.cooperado else None,
+        "data_envio": (
+            to_brasilia(entrega.data_envio).strftime('%Y-%m-%d %H:%M')
+            if entrega.data_envio else None
+        ),
+        "data_atribuida": (
+            to_brasilia(entrega.data_atribuida).strftime('%Y-%m-%d %H:%M')
+            if entrega.data_atribuida else None
+        ),
+    }
+
+
+def versao_esperada(dados=None):
+    """
+    Versão da entrega que o cliente tinha na tela: campo 'versao' (JSON ou form)
+    ou header If-Match. None = cliente não mandou (não há o que checar).
+    """
+    bruto = (dados or {}).get("versao")
+    if bruto in (None, ""):
+        bruto = request.form.get("versao")
+    if bruto in (None, ""):
+        bruto = (request.headers.get("If-Match") or "").strip().strip('"')
+    try:
+        return int(bruto) if bruto not in (None, "") else None
+    except (TypeError, ValueError):
+        return None
+
+
+def versao_conflita(entrega: Entrega, esperada) -> bool:
+    return esperada is not None and entrega.versao != esperada
+
+
+def resposta_conflito(entrega_id: int, redirecionar=None):
+    """409 com o estado atual da entrega (ou flash + redirect nas telas com formulário)."""
+    db.session.rollback()
+    msg = 'Esta entrega foi alterada por outra pessoa. Confira os dados atuais e tente de novo.'
+    if redirecionar is not None and not _wants_json():
+        flash(msg, 'warning')
+        return redirect(redirecionar)
+    atual = Entrega.query.get(entrega_id)
+    return jsonify(
+        ok=False,
+        error="conflito_versao",
+        msg=msg,
+        atual=estado_entrega(atual) if atual else None,
+    ), 409
+
+
+def commit_ou_conflito(entrega: Entrega, redirecionar=None):
+    """Commit; se outra gravação mudou a entrega no meio do caminho, devolve a resposta 409."""
+    entrega_id = entrega.id
+    try:
+        db.session.commit()
+    except StaleDataError:
+        return resposta_conflito(entrega_id, redirecionar)
+    return None
+
+
+# =========================================================
+# FILA DE EMISSÕES (SOCKET.IO FORA DA REQUISIÇÃO)
+# =========================================================
+# Os emit_* só enfileiram; uma thread própria monta o payload (com app context)
+# e faz o emit. Se a sessão do banco tem escrita ainda não commitada, o item
+# espera o commit (e some no rollback). Fila limitada: itens 'mesclar' com a
+# mesma chave viram um só (vale o mais novo) e, cheia, descarta primeiro quem
+# não é 'manter'.
+EMISSAO_FILA_MAX = int(os.getenv("EMISSAO_FILA_MAX", "2000"))
+EMISSAO_LOTE_MAX = int(os.getenv("EMISSAO_LOTE_MAX", "200"))
+
+POLITICA_EMISSAO = {
+    "entrega_atualizada": "mesclar",       # só o estado mais novo da entrega importa
+    "fila_espera_atualizada": "mesclar",
+    "nova_corrida": "manter",
+    "entrega_evento": "manter",
+    "status_motoboy": "manter",
+    "socorro_novo": "manter",
+    "socorro_lido": "manter",
+}
+
+
+class ItemEmissao:
+    __slots__ = ("evento", "payload", "destinos", "chave", "enfileirado")
+
+    def __init__(self, evento, payload, destinos, chave):
+        self.evento = evento
+        self.payload = payload      # dict, ou função chamada na thread de envio (None = não emite)
+        self.destinos = destinos    # [kwargs do socketio.emit], ex.: [{"to": "admins"}]
+        self.chave = chave
+        self.enfileirado = monotonic()
+
+
+class FilaEmissoes:
+    def __init__(self, maximo: int):
+        self.maximo = maximo
+        self._cond = threading.Condition()
+        self._fila = deque()
+        self._por_chave = {}
+        self._latencias = deque(maxlen=500)   # ms entre enfileirar e emitir
+        self._contadores = Counter()
+        self._descartes = Counter()
+        self._maior_fila = 0
+
+    def _politica(self, item):
+        return POLITICA_EMISSAO.get(item.evento, "descartar")
+
+    def _descartar_um(self, inclusive_manter=False) -> bool:
+        for antigo in self._fila:
+            if inclusive_manter or self._politica(antigo) != "manter":
+                self._fila.remove(antigo)
+                if antigo.chave is not None:
+                    self._por_chave.pop(antigo.chave, None)
+                self._descartes[antigo.evento] += 1
+                return True
+        return False
+
+    def colocar(self, item: ItemEmissao):
+        with self._cond:
+            self._contadores["enfileirados"] += 1
+            if item.chave is not None:
+                pendente = self._por_chave.get(item.chave)
+                if pendente is not None:
+                    # mantém o lugar (e a idade) na fila, com o conteúdo mais novo
+                    pendente.payload = item.payload
+                    pendente.destinos = item.destinos
+                    self._contadores["mesclados"] += 1
+                    return
+            if len(self._fila) >= self.maximo and not self._descartar_um():
+                if self._politica(item) != "manter":
+                    self._descartes[item.evento] += 1
+                    return
+                self._descartar_um(inclusive_manter=True)
+            self._fila.append(item)
+            if item.chave is not None:
+                self._por_chave[item.chave] = item
+            self._maior_fila = max(self._maior_fila, len(self._fila))
+            self._cond.notify()
+
+    def tirar(self, espera_s=1.0) -> list:
+        with self._cond:
+            if not self._fila:
+                self._cond.wait(espera_s)
+            lote = []
+            while self._fila and len(lote) < EMISSAO_LOTE_MAX:
+                item = self._fila.popleft()
+                if item.chave is not None:
+                    self._por_chave.pop(item.chave, None)
+                lote.append(item)
+            return lote
+
+    def registrar_envio(self, item: ItemEmissao, ok: bool):
+        with self._cond:
+            self._contadores["emitidos" if ok else "erros"] += 1
+            self._latencias.append((monotonic() - item.enfileirado) * 1000.0)
+
+    def metricas(self) -> dict:
+        with self._cond:
+            lat = sorted(self._latencias)
+            return {
+                "fila": len(self._fila),
+                "fila_max": self.maximo,
+                "maior_fila": self._maior_fila,
+                "enfileirados": self._contadores["enfileirados"],
+                "mesclados": self._contadores["mesclados"],
+                "emitidos": self._contadores["emitidos"],
+                "erros": self._contadores["erros"],
+                "descartados": dict(self._descartes),
+                "latencia_ms": {
+                    "media": round(sum(lat) / len(lat), 2) if lat else None,
+                    "p95": round(lat[math.ceil(len(lat) * 0.95) - 1], 2) if lat else None,
+                    "max": round(lat[-1], 2) if lat else None,
+                    "amostras": len(lat),
+                },
+            }
+
+
+FILA_EMISSOES = FilaEmissoes(EMISSAO_FILA_MAX)
+
+
+def _escrita_pendente(sessao) -> bool:
+    return bool(sessao.info.get("escrita_pendente") or sessao.new or sessao.dirty or sessao.deleted)
+
+
+def enfileirar_emissao(evento: str, payload, destinos=None, chave=None):
+    """Agenda um socketio.emit para a thread de envio (após o commit, se houver escrita pendente)."""
+    item = ItemEmissao(evento, payload, destinos or [{}], chave)
+    if has_app_context():
+        sessao = db.session()
+        if _escrita_pendente(sessao):
+            sessao.info.setdefault("emissoes_pendentes", []).append(item)
+            return
+    FILA_EMISSOES.colocar(item)
+
+
+@sa_event.listens_for(db.session, "after_flush")
+def _marcar_escrita_flush(sessao, contexto):
+    sessao.info["escrita_pendente"] = True
+
+
+@sa_event.listens_for(db.session, "do_orm_execute")
+def _marcar_escrita_execute(estado):
+    if estado.is_update or estado.is_delete or estado.is_insert:
+        estado.session.info["escrita_pendente"] = True
+
+
+@sa_event.listens_for(db.session, "after_commit")
+def _liberar_emissoes(sessao):
+    sessao.info.pop("escrita_pendente", None)
+    for item in sessao.info.pop("emissoes_pendentes", []):
+        FILA_EMISSOES.colocar(item)
+
+
+@sa_event.listens_for(db.session, "after_rollback")
+def _descartar_emissoes(sessao):
+    sessao.info.pop("escrita_pendente", None)
+    sessao.info.pop("emissoes_pendentes", None)
+
+
+def _loop_emissoes():
+    while True:
+        lote = FILA_EMISSOES.tirar()
+        if not lote:
+            continue
+        with app.app_context():
+            try:
+                for item in lote:
+                    try:
+                        payload = item.payload() if callable(item.payload) else item.payload
+                        if payload is not None:
+                            for destino in item.destinos:
+                                socketio.emit(item.evento, payload, **destino)
+                        FILA_EMISSOES.registrar_envio(item, True)
+                    except Exception as e:
+                        db.session.rollback()
+                        FILA_EMISSOES.registrar_envio(item, False)
+                        app.logger.warning(f"Falha ao emitir {item.evento}: {e}")
+            finally:
+                db.session.remove()
+
+
+def iniciar_fila_emissoes():
+    socketio.start_background_task(_loop_emissoes)
+
+
+def _payload_entrega_atualizada(entrega_id, acao):
+    entrega = Entrega.query.get(entrega_id)
+    if entrega is None:
+        return None
+    payload = estado_entrega(entrega)
+    payload["acao"] = acao  # 'criada', 'editada', 'excluida', etc.
+    return payload
+
+
 def emitir_atualizacao_entrega(entrega: Entrega, acao: str):
     """
     Emite para todos os painéis (admin, cooperado, rastreamento) que
@@ -581,72 +1135,130 @@ def emitir_atualizacao_entrega(entrega: Entrega, acao: str):
     if not entrega:
         return
 
-    try:
-        payload = {
-            "id": entrega.id,
-            "acao": acao,  # 'criada', 'editada', 'excluida', etc.
-            "cliente": entrega.cliente,
-            "bairro": entrega.bairro,
-            "valor": float(entrega.valor or 0),
-            "status": entrega.status,
-            "status_pagamento": entrega.status_pagamento,
-            "pagamento": entrega.pagamento,
-            "cooperado_id": entrega.cooperado_id,
-            "cooperado_nome": entrega.cooperado.nome if entrega.cooperado else None,
-            "data_envio": (
-                to_brasilia(entrega.data_envio).strftime('%Y-%m-%d %H:%M')
-                if entrega.data_envio else None
-            ),
-            "data_atribuida": (
-                to_brasilia(entrega.data_atribuida).strftime('%Y-%m-%d %H:%M')
-                if entrega.data_atribuida else None
-            ),
-        }
+    # status/cooperado podem ter mudado: recarrega as cercas no próximo ping
+    CERCAS.invalidar(entrega.cooperado_id)
+    ETAS.invalidar(entrega.id)
 
-        # Evento específico para os painéis de entregas
-        socketio.emit(
-            "entrega_atualizada",
-            payload)
+    # painéis de entregas (todos) e o app do cooperado da entrega, na conexão dele;
+    # o payload é montado na thread de envio, já com o estado commitado
+    destinos = [{}]
+    if entrega.cooperado_id:
+        destinos.append({"room": f"cooperado_{entrega.cooperado_id}", "namespace": SOCKET_NS_MOBILE})
+    enfileirar_emissao(
+        "entrega_atualizada",
+        partial(_payload_entrega_atualizada, entrega.id, acao),
+        destinos,
+        chave=("entrega_atualizada", entrega.id),
+    )
 
-    except Exception as e:
-        # não quebra o fluxo se der problema no websocket
-        try:
-            current_app.logger.warning(f'Falha ao emitir entrega_atualizada: {e}')
-        except Exception:
-            pass
+def emitir_evento_entrega(entrega_id: int, evento: str, quando: datetime, **extra):
+    """
+    Marco automático de uma entrega (ex.: 'chegou_coleta', 'chegou_destino')
+    para a sala da entrega (rastreio) e para os admins.
 
-def emitir_posicao_motoboy(cooperado: Cooperado, lat: float, lng: float, velocidade=None):
-    try:
-        ultima_str = ""
-        if cooperado.last_ping:
-            ultima_str = to_brasilia(cooperado.last_ping).strftime('%d/%m %H:%M:%S')
+    Evento Socket.IO: 'entrega_evento'
+    """
+    payload = {
+        "entrega_id": entrega_id,
+        "evento": evento,
+        "quando": _to_utc_aware(quando).isoformat() if quando else None,
+    }
+    payload.update(extra)
+    enfileirar_emissao("entrega_evento", payload, [{"to": f"entrega_{entrega_id}"}, {"to": "admins"}])
+
+
+def payload_corrida_cooperado(entrega: Entrega) -> dict:
+    """Dados da corrida como o painel/app do cooperado mostram (verificação e oferta)."""
+    origem = entrega.get_origem() or {}
+    destino = entrega.get_destino() or {}
+
+    origem_endereco = (
+        origem.get('endereco')
+        or origem.get('address')
+        or origem.get('bairro')
+        or None
+    )
+    origem_bairro = origem.get('bairro') or None
+
+    destino_endereco = (
+        destino.get('endereco')
+        or destino.get('address')
+        or destino.get('bairro')
+        or entrega.bairro
+    )
+    destino_bairro = destino.get('bairro') or entrega.bairro
 
-        is_online, idle_s, status_str = calc_status_cooperado(cooperado)
+    eta = ETAS.estimar(entrega)
 
-        payload = {
-            'id': cooperado.id,
-            'nome': cooperado.nome,
-            'lat': float(lat),
-            'lng': float(lng),
+    return {
+        "id": entrega.id,
+        "cliente": entrega.cliente,
+        "valor": float(entrega.valor or 0),
 
-            'online': bool(is_online),
-            'status': status_str,                 # offline | ocioso | livre | em_corrida
-            'idle_seconds': idle_s,               # tempo ocioso em segundos (se online)
+        "origem_endereco": origem_endereco,
+        "origem_bairro": origem_bairro,
 
-            'velocidade_kmh': float(velocidade) if velocidade is not None else None,
-            'heading': cooperado.last_heading,
-            'accuracy_m': cooperado.last_accuracy_m,
+        "destino_endereco": destino_endereco,
+        "destino_bairro": destino_bairro,
 
-            'ultima_atualizacao': ultima_str,
-        }
+        "lat_origem": origem.get('lat'),
+        "lng_origem": origem.get('lng'),
+        "lat_destino": destino.get('lat'),
+        "lng_destino": destino.get('lng'),
 
-        socketio.emit('posicao_motoboy_atualizada', payload, broadcast=True)
+        "tempo_estimado": f"{eta['eta_min']} min" if eta else "aprox.",
+        "distancia": eta["distancia_km"] if eta else 0,
+        "eta": eta,
+        "status_pagamento": (entrega.status_pagamento or "").lower(),
+        "data_entrega": entrega.data_envio.strftime("%Y-%m-%d") if entrega.data_envio else None,
+        "recebida_por": entrega.recebido_por or "",
+        "versao": entrega.versao,
+    }
 
-    except Exception as e:
-        try:
-            current_app.logger.warning(f'Falha ao emitir posicao_motoboy_atualizada: {e}')
-        except Exception:
-            pass
+
+def emitir_oferta_corrida(entrega: Entrega):
+    """
+    Oferece a corrida ao cooperado atribuído (sala 'cooperado_<id>').
+
+    Evento Socket.IO: 'nova_corrida'
+    """
+    if not entrega or not entrega.cooperado_id:
+        return
+
+    def montar(entrega_id=entrega.id):
+        e = Entrega.query.get(entrega_id)
+        return payload_corrida_cooperado(e) if e else None
+
+    sala = f"cooperado_{entrega.cooperado_id}"
+    enfileirar_emissao("nova_corrida", montar, [{"room": sala}, {"room": sala, "namespace": SOCKET_NS_MOBILE}])
+
+def payload_posicao_motoboy(pos) -> dict:
+    """Item de posição como o mapa dos admins mostra (mesmas chaves de /mapa_motoboys)."""
+    is_online, idle_s, status_str = status_mantido(pos)
+    return {
+        'id': pos.id,
+        'nome': pos.nome,
+        'lat': float(pos.last_lat),
+        'lng': float(pos.last_lng),
+
+        'online': bool(is_online),
+        'status': status_str,                 # offline | ocioso | livre | em_corrida
+        'idle_seconds': idle_s,               # tempo ocioso em segundos (se online)
+
+        'velocidade': float(pos.last_speed_kmh or 0),
+        'heading': pos.last_heading,
+        'accuracy_m': pos.last_accuracy_m,
+
+        'ultima_atualizacao': to_brasilia(pos.last_ping).strftime('%d/%m %H:%M:%S') if pos.last_ping else "",
+    }
+
+
+def emitir_posicao_motoboy(cooperado: Cooperado, lat: float, lng: float, velocidade=None):
+    """
+    Não emite na hora: só marca o cooperado para o próximo quadro da transmissão
+    (TRANSMISSOR_POSICOES), que junta as posições e manda uma vez por tick.
+    """
+    TRANSMISSOR_POSICOES.marcar(cooperado.id)
 
 
 class Credito(db.Model):
@@ -729,143 +1341,2505 @@ class ListaEspera(db.Model):
     created_at = db.Column(db.DateTime, nullable=True, default=datetime.utcnow)
     cooperado = db.relationship('Cooperado', lazy='joined')
 
+def _payload_lista_espera():
+    itens = (
+        ListaEspera.query
+        .order_by(ListaEspera.pos.asc(), ListaEspera.created_at.asc())
+        .all()
+    )
+    payload = []
+    for item in itens:
+        payload.append({
+            "id": item.id,
+            "cooperado_id": item.cooperado_id,
+            "nome": item.cooperado.nome if item.cooperado else item.nome,
+            "pos": item.pos,
+            "created_at": to_brasilia(item.created_at).strftime('%d/%m %H:%M')
+                          if item.created_at else "",
+        })
+    return {"itens": payload}
+
+
 def emitir_lista_espera():
     """
-    Emite para todos os painéis a situação atual da fila de espera.
+    Emite para todos os painéis a situação atual da fila de espera
+    (montada na thread de envio; várias mudanças seguidas viram um emit só).
+    """
+    MEMBROS_FILA_ESPERA.invalidar()
+    enfileirar_emissao("fila_espera_atualizada", _payload_lista_espera, chave="fila_espera_atualizada")
+
+
+# Quem está na fila de espera, em memória: intervalo_ping consulta a cada ping.
+# Invalidado por qualquer commit que mexa em ListaEspera (eventos da sessão abaixo,
+# cobre rotas que não emitem) e, com vários workers, recarregado no máximo a cada
+# FILA_ESPERA_RECARREGAR_SEC (a mudança pode ter sido em outro processo).
+FILA_ESPERA_RECARREGAR_SEC = float(os.getenv("FILA_ESPERA_RECARREGAR_SEC", "30"))
+
+
+class MembrosFilaEspera:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = None
+        self._carregado_em = 0.0
+        self._geracao = 0
+
+    def invalidar(self):
+        with self._lock:
+            self._ids = None
+            self._geracao += 1
+
+    def contem(self, cooperado_id) -> bool:
+        agora = datetime.utcnow().timestamp()
+        with self._lock:
+            ids, geracao = self._ids, self._geracao
+            if ids is not None and agora - self._carregado_em >= FILA_ESPERA_RECARREGAR_SEC:
+                ids = None
+        if ids is None:
+            ids = {
+                cid for (cid,) in
+                db.session.query(ListaEspera.cooperado_id).filter(ListaEspera.cooperado_id.isnot(None)).all()
+            }
+            with self._lock:
+                if self._geracao == geracao:  # ninguém invalidou durante a consulta
+                    self._ids, self._carregado_em = ids, agora
+        return cooperado_id in ids
+
+
+MEMBROS_FILA_ESPERA = MembrosFilaEspera()
+
+
+@sa_event.listens_for(db.session, "after_flush")
+def _marcar_fila_espera_flush(sessao, contexto):
+    if any(isinstance(o, ListaEspera) for o in (*sessao.new, *sessao.dirty, *sessao.deleted)):
+        sessao.info["fila_espera_mudou"] = True
+
+
+@sa_event.listens_for(db.session, "do_orm_execute")
+def _marcar_fila_espera_execute(estado):
+    if (estado.is_update or estado.is_delete or estado.is_insert) and any(
+        m.class_ is ListaEspera for m in estado.all_mappers
+    ):
+        estado.session.info["fila_espera_mudou"] = True
+
+
+@sa_event.listens_for(db.session, "after_commit")
+def _invalidar_fila_espera(sessao):
+    if sessao.info.pop("fila_espera_mudou", False):
+        MEMBROS_FILA_ESPERA.invalidar()
+
+
+@sa_event.listens_for(db.session, "after_rollback")
+def _descartar_fila_espera(sessao):
+    sessao.info.pop("fila_espera_mudou", None)
+
+class Trajeto(db.Model):
+    __tablename__ = 'trajeto'
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    # Quem fez o trajeto
+    cooperado_id = db.Column(db.Integer, db.ForeignKey('cooperado.id'), nullable=False)
+    cooperado = db.relationship('Cooperado', backref='trajetos')
+
+    # Horários em UTC naive (igual ao resto do sistema)
+    inicio = db.Column(db.DateTime, nullable=False)   # quando começou o trajeto
+    fim = db.Column(db.DateTime, nullable=True)       # quando terminou (se tiver)
+
+    # Métricas principais
+    distancia_m = db.Column(db.Float, nullable=True)          # em metros
+    duracao_s = db.Column(db.Integer, nullable=True)          # em segundos
+    velocidade_media_kmh = db.Column(db.Float, nullable=True) # km/h
+
+    # Coordenadas (opcionais)
+    origem_lat = db.Column(db.Float, nullable=True)
+    origem_lng = db.Column(db.Float, nullable=True)
+    destino_lat = db.Column(db.Float, nullable=True)
+    destino_lng = db.Column(db.Float, nullable=True)
+
+    # JSON com pontos do trajeto (lista de lat/lng/hora) – formato ANTIGO, só leitura
+    pontos_json = db.Column(db.Text, nullable=True)
+
+    # Pontos do trajeto em binário compacto (ver codificar_pontos_trajeto)
+    pontos_bin = db.Column(db.LargeBinary, nullable=True)
+
+    # Quando foi gravado no sistema
+    criado_em = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    # Já somado em trajeto_resumo_diario? (só consolidados podem ser apagados)
+    consolidado = db.Column(db.Boolean, nullable=False, default=False)
+
+    def set_pontos(self, pontos):
+        """pontos: lista de (lat, lng, datetime UTC naive)."""
+        self.pontos_bin = codificar_pontos_trajeto(pontos) if pontos else None
+        self.pontos_json = None
+
+    def get_pontos_arrays(self):
+        """
+        Pontos como arrays NumPy (lat, lng, epoch_s) para análises.
+        Lê o binário novo ou, em trajetos antigos, o pontos_json.
+        """
+        if self.pontos_bin:
+            return decodificar_pontos_trajeto_np(self.pontos_bin)
+        if self.pontos_json:
+            try:
+                lista = json.loads(self.pontos_json) or []
+            except Exception:
+                lista = []
+            lat = np.array([float(p["lat"]) for p in lista], dtype=np.float64)
+            lng = np.array([float(p["lng"]) for p in lista], dtype=np.float64)
+            ts = np.array(
+                [_to_utc_aware(datetime.fromisoformat(p["t"])).timestamp() if p.get("t") else 0
+                 for p in lista],
+                dtype=np.int64,
+            )
+            return lat, lng, ts
+        vazio = np.empty(0, dtype=np.float64)
+        return vazio, vazio.copy(), np.empty(0, dtype=np.int64)
+
+    def get_pontos(self):
+        """Pontos como lista de (lat, lng, datetime UTC naive)."""
+        lat, lng, ts = self.get_pontos_arrays()
+        return [
+            (float(a), float(b), datetime.utcfromtimestamp(int(t)))
+            for a, b, t in zip(lat, lng, ts)
+        ]
+
+
+class TrajetoResumoDiario(db.Model):
+    """
+    Totais de trajetos por cooperado e dia (data de Brasília do início do trajeto).
+    Sobrevive à limpeza dos trajetos brutos (> TRAJETO_RETENCAO_DIAS).
+    """
+    __tablename__ = 'trajeto_resumo_diario'
+
+    id = db.Column(db.Integer, primary_key=True)
+    cooperado_id = db.Column(db.Integer, db.ForeignKey('cooperado.id', ondelete='CASCADE'), nullable=False)
+    dia = db.Column(db.Date, nullable=False)
+    n_trajetos = db.Column(db.Integer, nullable=False, default=0)
+    distancia_m = db.Column(db.Float, nullable=False, default=0.0)
+    duracao_s = db.Column(db.Integer, nullable=False, default=0)
+    atualizado_em = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    cooperado = db.relationship('Cooperado')
+
+    __table_args__ = (
+        db.UniqueConstraint("cooperado_id", "dia", name="uq_trajeto_resumo_coop_dia"),
+    )
+
+    @property
+    def velocidade_media_kmh(self):
+        if not self.duracao_s:
+            return 0.0
+        return (self.distancia_m / 1000.0) / (self.duracao_s / 3600.0)
+
+
+# =========================================================
+# CODIFICAÇÃO COMPACTA DOS PONTOS DE TRAJETO
+# =========================================================
+# Formato binário (v1), little-endian:
+#   cabeçalho: versão (uint8) | n pontos (uint32) | t0 epoch s (int64)
+#   corpo zlib: n x int32 delta lat (1e-6 grau; o 1º é absoluto)
+#               n x int32 delta lng (1e-6 grau; o 1º é absoluto)
+#               n x uint16 delta t (segundos; o 1º é 0)
+# ~4-5 bytes/ponto depois do zlib, contra ~75 bytes/ponto no JSON antigo.
+PONTOS_VERSAO = 1
+PONTOS_ESCALA = 1_000_000
+_PONTOS_CAB = struct.Struct("<BIq")
+
+
+def codificar_pontos_trajeto(pontos) -> bytes:
+    """pontos: lista de (lat, lng, datetime UTC naive) em ordem de tempo."""
+    n = len(pontos)
+    lat = np.fromiter((p[0] for p in pontos), dtype=np.float64, count=n)
+    lng = np.fromiter((p[1] for p in pontos), dtype=np.float64, count=n)
+    ts = np.fromiter((int(_to_utc_aware(p[2]).timestamp()) for p in pontos), dtype=np.int64, count=n)
+
+    lat_i = np.rint(lat * PONTOS_ESCALA).astype(np.int64)
+    lng_i = np.rint(lng * PONTOS_ESCALA).astype(np.int64)
+    d_lat = np.diff(lat_i, prepend=0).astype("<i4")
+    d_lng = np.diff(lng_i, prepend=0).astype("<i4")
+    d_t = np.clip(np.diff(ts, prepend=ts[0] if n else 0), 0, 0xFFFF).astype("<u2")
+
+    corpo = d_lat.tobytes() + d_lng.tobytes() + d_t.tobytes()
+    t0 = int(ts[0]) if n else 0
+    return _PONTOS_CAB.pack(PONTOS_VERSAO, n, t0) + zlib.compress(corpo, 9)
+
+
+def decodificar_pontos_trajeto_np(blob: bytes):
+    """Retorna (lat, lng, epoch_s) como arrays NumPy."""
+    versao, n, t0 = _PONTOS_CAB.unpack_from(blob, 0)
+    if versao != PONTOS_VERSAO:
+        raise ValueError(f"versão de pontos desconhecida: {versao}")
+    corpo = zlib.decompress(blob[_PONTOS_CAB.size:])
+
+    d_lat = np.frombuffer(corpo, dtype="<i4", count=n, offset=0)
+    d_lng = np.frombuffer(corpo, dtype="<i4", count=n, offset=4 * n)
+    d_t = np.frombuffer(corpo, dtype="<u2", count=n, offset=8 * n)
+
+    lat = np.cumsum(d_lat, dtype=np.int64) / PONTOS_ESCALA
+    lng = np.cumsum(d_lng, dtype=np.int64) / PONTOS_ESCALA
+    ts = t0 + np.cumsum(d_t, dtype=np.int64)
+    return lat, lng, ts
+
+
+def codificar_polyline(lat, lng, precisao=5) -> str:
+    """Encoded Polyline (formato do Google / Leaflet.PolylineUtil) para mandar ao navegador."""
+    fator = 10 ** precisao
+    saida = []
+    prev_lat = prev_lng = 0
+    for a, b in zip(lat, lng):
+        ia = int(round(float(a) * fator))
+        ib = int(round(float(b) * fator))
+        for delta in (ia - prev_lat, ib - prev_lng):
+            v = ~(delta << 1) if delta < 0 else (delta << 1)
+            while v >= 0x20:
+                saida.append(chr((0x20 | (v & 0x1F)) + 63))
+                v >>= 5
+            saida.append(chr(v + 63))
+        prev_lat, prev_lng = ia, ib
+    return "".join(saida)
+
+
+def decodificar_polyline(texto: str, precisao=5):
+    """Inverso de codificar_polyline: lista de (lat, lng)."""
+    fator = 10 ** precisao
+    pontos = []
+    i = lat = lng = 0
+    n = len(texto)
+    while i < n:
+        valores = []
+        for _ in range(2):
+            res = shift = 0
+            while True:
+                b = ord(texto[i]) - 63
+                i += 1
+                res |= (b & 0x1F) << shift
+                shift += 5
+                if b < 0x20:
+                    break
+            valores.append(~(res >> 1) if res & 1 else (res >> 1))
+        lat += valores[0]
+        lng += valores[1]
+        pontos.append((lat / fator, lng / fator))
+    return pontos
+
+
+# =========================================================
+# REPLAY DE TRAJETOS (SIMPLIFICAÇÃO POR ZOOM + CACHE)
+# =========================================================
+# Um trajeto de 1h tem ~3.600 pontos; no zoom da cidade quase todos caem no
+# mesmo pixel. Simplificamos (Douglas-Peucker) com tolerância = tamanho de
+# ~REPLAY_TOL_PX pixels naquele zoom e guardamos o resultado num LRU por
+# (trajeto, zoom) — trajeto gravado não muda mais, então o cache não invalida.
+REPLAY_TOL_PX = float(os.getenv("REPLAY_TOL_PX", "1.5"))
+REPLAY_MAX_PONTOS = int(os.getenv("REPLAY_MAX_PONTOS", "2000"))
+REPLAY_CACHE_MAX = int(os.getenv("REPLAY_CACHE_MAX", "512"))
+REPLAY_ZOOM_MIN, REPLAY_ZOOM_MAX, REPLAY_ZOOM_PADRAO = 3, 20, 15
+
+
+def tolerancia_por_zoom_m(zoom: int, lat_ref: float) -> float:
+    """Metros por pixel (Web Mercator, tiles de 256px) x REPLAY_TOL_PX."""
+    m_por_px = 156543.03392 * math.cos(math.radians(lat_ref)) / (2 ** zoom)
+    return m_por_px * REPLAY_TOL_PX
+
+
+def simplificar_douglas_peucker(lat, lng, tol_m: float):
+    """
+    Índices dos pontos mantidos (sempre inclui o 1º e o último).
+    Projeta em metros num plano local (equiretangular) e usa distância ao
+    SEGMENTO — trajetos de motoboy vão e voltam pela mesma rua.
+    Versão iterativa (pilha) para não estourar recursão em trajetos longos.
     """
+    n = len(lat)
+    if n <= 2 or tol_m <= 0:
+        return np.arange(n)
+
+    lat0 = float(np.mean(lat))
+    x = (np.asarray(lng) - float(lng[0])) * (111_320.0 * math.cos(math.radians(lat0)))
+    y = (np.asarray(lat) - float(lat[0])) * 110_540.0
+
+    manter = np.zeros(n, dtype=bool)
+    manter[0] = manter[-1] = True
+    pilha = [(0, n - 1)]
+    while pilha:
+        i, j = pilha.pop()
+        if j - i < 2:
+            continue
+        xs, ys = x[i + 1:j], y[i + 1:j]
+        dx, dy = x[j] - x[i], y[j] - y[i]
+        seg2 = dx * dx + dy * dy
+        if seg2 > 0:
+            u = np.clip(((xs - x[i]) * dx + (ys - y[i]) * dy) / seg2, 0.0, 1.0)
+            d = np.hypot(xs - (x[i] + u * dx), ys - (y[i] + u * dy))
+        else:
+            d = np.hypot(xs - x[i], ys - y[i])
+        k = int(np.argmax(d))
+        if d[k] > tol_m:
+            m = i + 1 + k
+            manter[m] = True
+            pilha.append((i, m))
+            pilha.append((m, j))
+    return np.flatnonzero(manter)
+
+
+def _zoom_replay(v) -> int:
     try:
-        itens = (
-            ListaEspera.query
-            .order_by(ListaEspera.pos.asc(), ListaEspera.created_at.asc())
-            .all()
+        z = int(v)
+    except (TypeError, ValueError):
+        z = REPLAY_ZOOM_PADRAO
+    return max(REPLAY_ZOOM_MIN, min(REPLAY_ZOOM_MAX, z))
+
+
+class CacheReplay:
+    """LRU thread-safe: (trajeto_id, zoom) -> (lat, lng, epoch_s, n_original)."""
+
+    def __init__(self, maximo: int):
+        self.maximo = maximo
+        self._lock = threading.Lock()
+        self._itens = OrderedDict()
+
+    def get(self, chave):
+        with self._lock:
+            v = self._itens.get(chave)
+            if v is not None:
+                self._itens.move_to_end(chave)
+            return v
+
+    def put(self, chave, valor):
+        with self._lock:
+            self._itens[chave] = valor
+            self._itens.move_to_end(chave)
+            while len(self._itens) > self.maximo:
+                self._itens.popitem(last=False)
+
+    def descartar_trajeto(self, trajeto_id: int):
+        with self._lock:
+            for chave in [k for k in self._itens if k[0] == trajeto_id]:
+                del self._itens[chave]
+
+
+CACHE_REPLAY = CacheReplay(REPLAY_CACHE_MAX)
+
+
+def replay_simplificado(traj, zoom: int):
+    """(lat, lng, epoch_s, n_original) do trajeto simplificado para o zoom pedido."""
+    chave = (traj.id, zoom)
+    v = CACHE_REPLAY.get(chave)
+    if v is not None:
+        return v
+
+    lat, lng, ts = traj.get_pontos_arrays()
+    n_original = len(lat)
+    if n_original > 2:
+        tol = tolerancia_por_zoom_m(zoom, float(np.mean(lat)))
+        idx = simplificar_douglas_peucker(lat, lng, tol)
+        # ainda grande demais (trajeto muito longo num zoom alto)? afrouxa a tolerância
+        while len(idx) > REPLAY_MAX_PONTOS:
+            tol *= 2
+            idx = simplificar_douglas_peucker(lat, lng, tol)
+        lat, lng, ts = lat[idx], lng[idx], ts[idx]
+
+    v = (lat, lng, ts, n_original)
+    CACHE_REPLAY.put(chave, v)
+    return v
+
+
+def replay_payload(traj, zoom: int, t_ini=None, t_fim=None) -> dict:
+    """
+    JSON do replay: polyline codificada + tempos em segundos desde o 1º ponto
+    (o navegador interpola a animação entre eles). t_ini/t_fim (epoch s)
+    recortam o trecho pedido.
+    """
+    lat, lng, ts, n_original = replay_simplificado(traj, zoom)
+    if t_ini is not None or t_fim is not None:
+        m = np.ones(len(ts), dtype=bool)
+        if t_ini is not None:
+            m &= ts >= t_ini
+        if t_fim is not None:
+            m &= ts <= t_fim
+        lat, lng, ts = lat[m], lng[m], ts[m]
+
+    t0 = int(ts[0]) if len(ts) else None
+    return {
+        "trajeto_id": traj.id,
+        "cooperado_id": traj.cooperado_id,
+        "inicio": to_brasilia(traj.inicio).isoformat() if traj.inicio else None,
+        "fim": to_brasilia(traj.fim).isoformat() if traj.fim else None,
+        "distancia_m": float(traj.distancia_m or 0.0),
+        "n_original": int(n_original),
+        "n": int(len(lat)),
+        "polyline": codificar_polyline(lat, lng),
+        "t0": t0,
+        "dt": [int(t - t0) for t in ts] if t0 is not None else [],
+    }
+
+
+# =========================================================
+# HELPERS DE DATA / FUSO
+# =========================================================
+def to_brasilia(dt):
+    if not dt:
+        return None
+    if dt.tzinfo is None:
+        dt = pytz.utc.localize(dt)
+    return dt.astimezone(BRAZIL_TZ)
+
+from datetime import datetime, timezone
+import os
+
+# -------------------------------------------------------------------
+# CONFIG DE TEMPOS (para NÃO dar NameError)
+# Ajuste os valores como quiser. Também aceita env vars no Render.
+# -------------------------------------------------------------------
+OFFLINE_AFTER_SEC = int(os.getenv("OFFLINE_AFTER_SEC", "120"))  # 2 min sem ping => offline
+IDLE_AFTER_SEC    = int(os.getenv("IDLE_AFTER_SEC", "300"))     # 5 min sem movimento => ocioso
+# Se velocidade >= isso, considera "em movimento"
+MOVING_SPEED_KMH = float(os.getenv("MOVING_SPEED_KMH", "3.0"))
+
+
+def _to_utc_aware(dt):
+    """
+    Garante datetime timezone-aware em UTC.
+    - None -> None
+    - naive -> assume que está em UTC e adiciona tzinfo
+    - aware -> converte para UTC
+    """
+    if dt is None:
+        return None
+    if dt.tzinfo is None:
+        return dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc)
+
+
+def calc_status_cooperado(c):
+    """
+    Retorna: (is_online, idle_seconds, status_str)
+    status_str: offline | ocioso | livre | em_corrida
+    """
+    # Agora é UTC-aware (não dá erro com TIMESTAMPTZ)
+    now_utc = datetime.now(timezone.utc)
+
+    last_ping = _to_utc_aware(getattr(c, "last_ping", None))
+    last_moving_at = _to_utc_aware(getattr(c, "last_moving_at", None))
+
+    # ONLINE “REAL” = socket do cooperado conectado OU ping recente
+    conectado = bool(getattr(c, "conectado", False))
+    is_online = bool(getattr(c, "online", False)) and (last_ping is not None or conectado)
+    if is_online and not conectado:
+        delta = (now_utc - last_ping).total_seconds()
+        if delta > OFFLINE_AFTER_SEC:
+            is_online = False
+
+    if not is_online:
+        return (False, None, "offline")
+
+    # Ocioso = online, mas sem movimento por tempo
+    if last_moving_at:
+        idle_seconds = int((now_utc - last_moving_at).total_seconds())
+    else:
+        # se nunca marcou movimento, usa last_ping como referência
+        idle_seconds = int((now_utc - last_ping).total_seconds()) if last_ping else 0
+
+    # Corrida aceita e não concluída tem prioridade (parado na coleta não é ocioso)
+    if EM_CORRIDA.contem(getattr(c, "id", None)):
+        return (True, idle_seconds, "em_corrida")
+
+    if idle_seconds >= IDLE_AFTER_SEC:
+        return (True, idle_seconds, "ocioso")
+
+    return (True, idle_seconds, "livre")
+
+
+def status_mantido(c):
+    """
+    Mesmo retorno de calc_status_cooperado, mas lendo a presença mantida
+    (pings + varredura de presença) em vez de recalcular os limiares.
+    """
+    presenca = getattr(c, "presenca", None)
+    if presenca is None:
+        return calc_status_cooperado(c)
+    if presenca == "offline":
+        return (False, None, "offline")
+    ref = _to_utc_aware(getattr(c, "last_moving_at", None) or getattr(c, "last_ping", None))
+    idle_seconds = int((datetime.now(timezone.utc) - ref).total_seconds()) if ref else 0
+    return (True, idle_seconds, presenca)
+
+
+# =========================================================
+# PINGS GPS (NORMALIZAÇÃO / APLICAÇÃO NO COOPERADO)
+# =========================================================
+PING_LOTE_MAX = int(os.getenv("PING_LOTE_MAX", "500"))  # máx. de fixes por requisição de lote
+# fixes com horário do aparelho muito no futuro são "puxados" para agora (relógio errado)
+PING_TOLERANCIA_FUTURO_SEC = int(os.getenv("PING_TOLERANCIA_FUTURO_SEC", "60"))
+
+
+def haversine_m(lat1, lng1, lat2, lng2):
+    """Distância em metros entre dois pontos (lat/lng em graus)."""
+    r = 6371000.0
+    p1 = math.radians(lat1)
+    p2 = math.radians(lat2)
+    dp = p2 - p1
+    dl = math.radians(lng2 - lng1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * r * math.asin(min(1.0, math.sqrt(a)))
+
+
+def _float_or_none(v):
+    try:
+        return float(v) if v is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _parse_horario_aparelho(v, agora_utc):
+    """
+    Converte o horário enviado pelo app para UTC naive.
+    Aceita epoch em segundos ou milissegundos, ou string ISO 8601.
+    Sem horário (ou inválido) -> agora.
+    """
+    if v is None or v == "":
+        return agora_utc
+
+    dt = None
+    if isinstance(v, (int, float)) or (isinstance(v, str) and re.fullmatch(r"\d+(\.\d+)?", v.strip())):
+        ts = float(v)
+        if ts > 1e11:  # veio em milissegundos
+            ts = ts / 1000.0
+        try:
+            dt = datetime.utcfromtimestamp(ts)
+        except (OverflowError, OSError, ValueError):
+            dt = None
+    elif isinstance(v, str):
+        try:
+            dt = datetime.fromisoformat(v.strip().replace("Z", "+00:00"))
+            if dt.tzinfo is not None:
+                dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+        except ValueError:
+            dt = None
+
+    if dt is None:
+        return agora_utc
+    if dt > agora_utc + timedelta(seconds=PING_TOLERANCIA_FUTURO_SEC):
+        return agora_utc
+    return dt
+
+
+def normalizar_fix(data: dict, agora_utc=None):
+    """
+    Normaliza um fix de GPS vindo do app/painel.
+
+    Campos aceitos:
+      lat, lng                  (obrigatórios)
+      speed_mps | velocidade    (m/s da Geolocation API, ou km/h)
+      heading, accuracy
+      t | ts | timestamp        (horário do aparelho: epoch s/ms ou ISO)
+
+    Retorna dict {lat, lng, v_kmh, heading, accuracy, t} ou None se inválido.
+    """
+    if not isinstance(data, dict):
+        return None
+    agora_utc = agora_utc or datetime.utcnow()
+
+    lat = _float_or_none(data.get("lat"))
+    lng = _float_or_none(data.get("lng"))
+    if lat is None or lng is None or not (-90.0 <= lat <= 90.0) or not (-180.0 <= lng <= 180.0):
+        return None
+
+    v_kmh = None
+    speed_mps = _float_or_none(data.get("speed_mps"))
+    if speed_mps is not None:
+        v_kmh = speed_mps * 3.6
+    else:
+        v_kmh = _float_or_none(data.get("velocidade"))
+
+    t_raw = data.get("t", data.get("ts", data.get("timestamp")))
+
+    return {
+        "lat": lat,
+        "lng": lng,
+        "v_kmh": v_kmh,
+        "heading": _float_or_none(data.get("heading")),
+        "accuracy": _float_or_none(data.get("accuracy")),
+        "t": _parse_horario_aparelho(t_raw, agora_utc),
+    }
+
+
+def aplicar_fix_cooperado(cooperado, fix, moving_at=None, recebido=None):
+    """
+    Grava o fix nos campos last_* (Cooperado ou PosicaoAoVivo; não faz commit).
+    moving_at: último instante em movimento conhecido (lote, relógio do aparelho);
+    se None, usa o próprio fix.
+    recebido: horário do SERVIDOR em que o fix chegou. last_ping/last_moving_at usam
+    o relógio do servidor (aparelho com relógio atrasado não pode parecer offline);
+    o horário do aparelho (fix["t"]) só ordena fixes e vai para os pontos de trajeto.
+    """
+    recebido = recebido or datetime.utcnow()
+    cooperado.last_lat = fix["lat"]
+    cooperado.last_lng = fix["lng"]
+    cooperado.last_ping = recebido
+    cooperado.online = True
+
+    cooperado.last_speed_kmh = fix["v_kmh"]
+    cooperado.last_heading = fix["heading"]
+    cooperado.last_accuracy_m = fix["accuracy"]
+
+    # marca “último movimento” (idade relativa ao fix, convertida para o relógio do servidor)
+    if moving_at is None and fix["v_kmh"] is not None and fix["v_kmh"] >= MOVING_SPEED_KMH:
+        moving_at = fix["t"]
+    if moving_at is not None:
+        atraso = max(timedelta(0), _to_utc_aware(fix["t"]) - _to_utc_aware(moving_at))
+        moving_at = recebido - atraso
+        last_moving = _to_utc_aware(cooperado.last_moving_at)
+        if last_moving is None or _to_utc_aware(moving_at) > last_moving:
+            cooperado.last_moving_at = moving_at
+
+
+def processar_lote_pings(cooperado, itens: list):
+    """
+    Processa um lote de fixes (possivelmente atrasado / fora de ordem):
+      - normaliza, descarta inválidos e duplicados, ordena por horário do aparelho;
+      - aplica SÓ o mais recente na posição ao vivo (e só se for mais novo que o último
+        fix aplicado, pelo relógio do aparelho);
+        as colunas last_* do cooperado são gravadas depois pelo flush periódico;
+      - entrega o lote inteiro para o armazenamento de trajetos (um único commit);
+      - avalia as cercas de chegada em cada fix do lote (commit próprio).
+
+    Retorna (aceitos, descartados, fix_aplicado_ou_None).
+    """
+    agora = datetime.utcnow()
+    vistos = set()
+    fixes = []
+    for item in itens:
+        fix = normalizar_fix(item, agora)
+        if fix is None:
+            continue
+        chave = (fix["t"], fix["lat"], fix["lng"])
+        if chave in vistos:
+            continue
+        vistos.add(chave)
+        fixes.append(fix)
+
+    descartados = len(itens) - len(fixes)
+    if not fixes:
+        return (0, descartados, None)
+
+    fixes.sort(key=lambda f: f["t"])
+    mais_novo = fixes[-1]
+
+    moving_at = None
+    for f in reversed(fixes):
+        if f["v_kmh"] is not None and f["v_kmh"] >= MOVING_SPEED_KMH:
+            moving_at = f["t"]
+            break
+
+    aplicado = None
+    if POSICOES.atualizar(cooperado, mais_novo, moving_at=moving_at, recebido=agora):
+        aplicado = mais_novo
+
+    fechados = SEGMENTADOR.processar(cooperado.id, fixes)
+    gravar_trajetos(fechados, commit=False)
+    db.session.commit()
+
+    # chegadas: cada fix do lote, não só o mais novo (transação própria)
+    registrar_chegadas(cooperado.id, fixes)
+
+    return (len(fixes), descartados, aplicado)
+
+
+# =========================================================
+# POSIÇÕES AO VIVO (MEMÓRIA) + FLUSH PERIÓDICO NO BANCO
+# =========================================================
+# Cada ping atualiza só a memória do processo; as colunas last_* do cooperado
+# são gravadas em lote a cada POSICAO_FLUSH_SEC segundos (e ao desligar).
+POSICAO_FLUSH_SEC = float(os.getenv("POSICAO_FLUSH_SEC", "10"))
+
+
+class PosicaoAoVivo:
+    """Registro de tamanho fixo com os mesmos nomes das colunas last_* do Cooperado."""
+    __slots__ = (
+        "id", "nome", "last_lat", "last_lng", "last_ping", "online",
+        "last_speed_kmh", "last_heading", "last_accuracy_m", "last_moving_at",
+        "presenca", "conectado", "fix_t", "sujo",
+    )
+
+    CAMPOS = (
+        "last_lat", "last_lng", "last_ping", "online",
+        "last_speed_kmh", "last_heading", "last_accuracy_m", "last_moving_at",
+        "presenca",
+    )
+
+    def __init__(self, origem=None):
+        self.id = getattr(origem, "id", None)
+        self.nome = getattr(origem, "nome", None)
+        for campo in self.CAMPOS:
+            setattr(self, campo, getattr(origem, campo, None))
+        self.online = bool(self.online)
+        self.conectado = bool(getattr(origem, "conectado", False))  # socket autenticado aberto
+        self.fix_t = getattr(origem, "fix_t", None)  # horário do aparelho do último fix aplicado
+        self.sujo = False
+
+    def copia(self):
+        c = PosicaoAoVivo(self)
+        c.sujo = self.sujo
+        return c
+
+
+class PosicoesAoVivo:
+    """Mapa cooperado_id -> PosicaoAoVivo, protegido por lock (O(1) por ping)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._itens = {}
+        self._sids = {}       # cooperado_id -> {sid} dos sockets autenticados
+        self._sid_dono = {}   # sid -> cooperado_id
+
+    def atualizar(self, cooperado, fix, moving_at=None, recebido=None):
+        """
+        Aplica o fix na posição do cooperado. Retorna False (e não mexe em nada) se o
+        fix é mais velho que o último aplicado, comparando horários do próprio aparelho.
+        """
+        with self._lock:
+            rec = self._itens.get(cooperado.id)
+            if rec is None:
+                rec = PosicaoAoVivo(cooperado)
+                self._itens[cooperado.id] = rec
+            if rec.fix_t is not None and _to_utc_aware(fix["t"]) < _to_utc_aware(rec.fix_t):
+                return False
+            aplicar_fix_cooperado(rec, fix, moving_at=moving_at, recebido=recebido)
+            rec.fix_t = fix["t"]
+            rec.nome = cooperado.nome
+            rec.sujo = True
+            lat, lng = rec.last_lat, rec.last_lng
+            transicao = _transicao_presenca(rec)
+            replica = self._instantaneo(rec)
+        # fora do lock das posições (a grade tem o próprio lock)
+        GRADE.mover(cooperado.id, lat, lng)
+        self._replicar(replica)
+        if transicao:
+            emitir_status_motoboy(*transicao)
+        ETAS.observar(cooperado.id, fix["v_kmh"])
+        return True
+
+    def semear(self, cooperados):
+        """Carrega posições já gravadas (boot do processo) sem sobrescrever as ao vivo."""
+        novos = []
+        with self._lock:
+            for c in cooperados:
+                if c.id not in self._itens:
+                    rec = PosicaoAoVivo(c)
+                    if rec.presenca is None:
+                        # base antiga, sem presença gravada: só assume o estado (sem evento)
+                        _transicao_presenca(rec)
+                    self._itens[c.id] = rec
+                    novos.append((c.id, c.last_lat, c.last_lng))
+        for cid, lat, lng in novos:
+            GRADE.mover(cid, lat, lng)
+
+    def marcar_offline(self, cooperado_id: int):
+        with self._lock:
+            rec = self._itens.get(cooperado_id)
+            transicao = replica = None
+            if rec is not None and rec.online:
+                rec.online = False
+                rec.sujo = True
+                if rec.presenca != "offline":
+                    transicao = (rec, rec.presenca, False, None, "offline")
+                    rec.presenca = "offline"
+                replica = self._instantaneo(rec)
+        GRADE.remover(cooperado_id)
+        self._replicar(replica)
+        if transicao:
+            emitir_status_motoboy(*transicao)
+
+    def conectar(self, cooperado, sid):
+        """Socket autenticado do cooperado abriu: fica online sem depender do ping."""
+        with self._lock:
+            rec = self._itens.get(cooperado.id)
+            if rec is None:
+                rec = PosicaoAoVivo(cooperado)
+                self._itens[cooperado.id] = rec
+            self._sids.setdefault(cooperado.id, set()).add(sid)
+            self._sid_dono[sid] = cooperado.id
+            rec.conectado = True
+            if not rec.online:
+                rec.online = True
+                rec.sujo = True
+            transicao = _transicao_presenca(rec)
+            lat, lng = rec.last_lat, rec.last_lng
+            replica = self._instantaneo(rec)
+        GRADE.mover(cooperado.id, lat, lng)
+        self._replicar(replica)
+        if transicao:
+            emitir_status_motoboy(*transicao)
+
+    def desconectar(self, sid, encerrou=False):
+        """
+        Socket fechou. Se era o último do cooperado, a presença volta a depender do
+        ping (offline na hora se o último ping já passou do limite); encerrou=True
+        (o app fechou a conexão de propósito) derruba para offline direto.
+        """
+        with self._lock:
+            cid = self._sid_dono.pop(sid, None)
+            if cid is None:
+                return None
+            sids = self._sids.get(cid, set())
+            sids.discard(sid)
+            if sids:
+                return cid
+            self._sids.pop(cid, None)
+            rec = self._itens.get(cid)
+            if rec is None:
+                return cid
+            rec.conectado = False
+            if encerrou and rec.online:
+                rec.online = False
+                rec.sujo = True
+            transicao = _transicao_presenca(rec)
+            replica = self._instantaneo(rec)
+        self._replicar(replica)
+        if transicao:
+            if not transicao[2]:
+                GRADE.remover(cid)
+            emitir_status_motoboy(*transicao)
+        return cid
+
+    def varrer_presenca(self) -> list:
+        """
+        Reavalia os limiares (OFFLINE_AFTER_SEC / IDLE_AFTER_SEC) de quem não está
+        offline e grava as mudanças na própria posição (o flush persiste).
+        Retorna as transições [(rec, anterior, online, idle_s, status)].
+        """
+        with self._lock:
+            transicoes = []
+            for rec in self._itens.values():
+                if rec.presenca == "offline":
+                    continue
+                t = _transicao_presenca(rec)
+                if t:
+                    transicoes.append(t)
+            replicas = [self._instantaneo(t[0]) for t in transicoes]
+        for rec, _, online, _, _ in transicoes:
+            if not online:
+                GRADE.remover(rec.id)
+        for replica in replicas:
+            self._replicar(replica)
+        return transicoes
+
+    # --- réplica entre workers (só com backplane distribuído) ---
+    @staticmethod
+    def _instantaneo(rec):
+        if not BACKPLANE.distribuido:
+            return None
+        dados = {"origem": WORKER_ID, "id": rec.id, "nome": rec.nome, "conectado": rec.conectado}
+        for campo in PosicaoAoVivo.CAMPOS + ("fix_t",):
+            v = getattr(rec, campo)
+            dados[campo] = v.isoformat() if isinstance(v, datetime) else v
+        return dados
+
+    @staticmethod
+    def _replicar(dados):
+        if dados is None:
+            return
+        try:
+            BACKPLANE.gravar_e_publicar("posicoes", dados["id"], "posicoes", json.dumps(dados))
+        except Exception as e:
+            app.logger.warning(f"Backplane: falha ao replicar posição {dados['id']}: {e}")
+
+    def aplicar_remota(self, dados, somente_se_mais_novo=False):
+        """Posição publicada por outro worker: atualiza a cópia local (quem recebeu o ping grava no banco)."""
+        for campo in ("last_ping", "last_moving_at", "fix_t"):
+            if dados.get(campo):
+                dados[campo] = datetime.fromisoformat(dados[campo])
+        cid = int(dados["id"])
+        with self._lock:
+            rec = self._itens.get(cid)
+            if rec is None:
+                rec = PosicaoAoVivo()
+                rec.id = cid
+                self._itens[cid] = rec
+            elif somente_se_mais_novo:
+                atual, remoto = _to_utc_aware(rec.last_ping), _to_utc_aware(dados.get("last_ping"))
+                if atual is not None and (remoto is None or remoto <= atual):
+                    return
+            rec.nome = dados.get("nome")
+            rec.conectado = bool(dados.get("conectado"))
+            for campo in PosicaoAoVivo.CAMPOS + ("fix_t",):
+                setattr(rec, campo, dados.get(campo))
+            lat, lng, online = rec.last_lat, rec.last_lng, rec.presenca != "offline"
+        if online:
+            GRADE.mover(cid, lat, lng)
+        else:
+            GRADE.remover(cid)
+
+    def status(self, cooperado_id: int):
+        """Status mantido da posição ao vivo, sem copiar o registro."""
+        with self._lock:
+            rec = self._itens.get(cooperado_id)
+            if rec is None:
+                return (False, None, "offline")
+            return status_mantido(rec)
+
+    def get(self, cooperado_id):
+        """Cópia consistente da posição (ou None se o cooperado não pingou neste processo)."""
+        with self._lock:
+            rec = self._itens.get(cooperado_id)
+            return rec.copia() if rec is not None else None
+
+    def de(self, cooperado):
+        """Posição ao vivo do cooperado; cai para o próprio objeto do banco se não houver."""
+        return self.get(cooperado.id) or cooperado
+
+    def flush(self) -> int:
+        """Grava no banco (um UPDATE em lote) as posições alteradas desde o último flush."""
+        with self._lock:
+            sujos = [rec for rec in self._itens.values() if rec.sujo]
+            linhas = []
+            for rec in sujos:
+                linha = {"b_id": rec.id}
+                for campo in PosicaoAoVivo.CAMPOS:
+                    linha[campo] = getattr(rec, campo)
+                linhas.append(linha)
+                rec.sujo = False
+
+        if not linhas:
+            return 0
+
+        tabela = Cooperado.__table__
+        stmt = (
+            tabela.update()
+            .where(tabela.c.id == bindparam("b_id"))
+            .values({campo: bindparam(campo) for campo in PosicaoAoVivo.CAMPOS})
         )
-        payload = []
-        for item in itens:
-            payload.append({
-                "id": item.id,
-                "cooperado_id": item.cooperado_id,
-                "nome": item.cooperado.nome if item.cooperado else item.nome,
-                "pos": item.pos,
-                "created_at": to_brasilia(item.created_at).strftime('%d/%m %H:%M')
-                              if item.created_at else "",
-            })
+        try:
+            db.session.execute(stmt, linhas)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            with self._lock:
+                for rec in sujos:
+                    rec.sujo = True
+            raise
+        return len(linhas)
+
+
+POSICOES = PosicoesAoVivo()
+
+
+def _flush_posicoes_seguro():
+    with app.app_context():
+        try:
+            POSICOES.flush()
+        except Exception as e:
+            app.logger.warning(f"Falha no flush de posições: {e}")
+        finally:
+            db.session.remove()
+
+
+def _loop_flush_posicoes():
+    while True:
+        socketio.sleep(POSICAO_FLUSH_SEC)
+        _flush_posicoes_seguro()
+
+
+def iniciar_flush_posicoes():
+    socketio.start_background_task(_loop_flush_posicoes)
+    atexit.register(_flush_posicoes_seguro)
+
+
+# =========================================================
+# PRESENÇA (VARREDURA OFFLINE / OCIOSO)
+# =========================================================
+# A presença de cada cooperado (PosicaoAoVivo.presenca) muda só em transições:
+# no ping (volta a livre/online) e na varredura a cada PRESENCA_VARREDURA_SEC
+# (passa a ocioso/offline, ou em_corrida enquanto há corrida aceita aberta).
+# Cada mudança é gravada uma vez pelo flush e vira um único evento
+# 'status_motoboy' para os admins; as telas só leem o estado.
+PRESENCA_VARREDURA_SEC = float(os.getenv("PRESENCA_VARREDURA_SEC", "5"))
+
+
+class CooperadosEmCorrida:
+    """
+    Quem tem corrida aceita e ainda não concluída. Lido sob o lock das posições
+    (sem banco ali): o conjunto é trocado inteiro a cada varredura.
+    """
+
+    def __init__(self):
+        self._ids = frozenset()
+
+    def contem(self, cooperado_id) -> bool:
+        return cooperado_id in self._ids
+
+    def recarregar(self):
+        self._ids = frozenset(
+            cid for (cid,) in (
+                db.session.query(Entrega.cooperado_id)
+                .filter(
+                    Entrega.cooperado_id.isnot(None),
+                    Entrega.status_corrida == 'aceita',
+                    _filtro_entrega_aberta(),
+                )
+                .distinct()
+                .all()
+            )
+        )
+
+
+EM_CORRIDA = CooperadosEmCorrida()
+
+
+def _transicao_presenca(rec):
+    """Recalcula a presença do registro (sob o lock das posições); devolve a transição ou None."""
+    online, idle_s, status = calc_status_cooperado(rec)
+    if status == rec.presenca:
+        return None
+    anterior = rec.presenca
+    rec.presenca = status
+    if not online:
+        rec.online = False
+    rec.sujo = True
+    return (rec, anterior, online, idle_s, status)
+
+
+def emitir_status_motoboy(rec, anterior, online, idle_s, status):
+    enfileirar_emissao("status_motoboy", {
+        "id": rec.id,
+        "nome": rec.nome,
+        "status": status,            # offline | ocioso | livre | em_corrida
+        "anterior": anterior,
+        "online": bool(online),
+        "idle_seconds": idle_s,
+    }, [{"to": "admins"}])
+
+
+def _loop_varredura_presenca():
+    while True:
+        socketio.sleep(PRESENCA_VARREDURA_SEC)
+        # todo worker: o status calculado no ping também depende de quem está em corrida
+        try:
+            with app.app_context():
+                EM_CORRIDA.recarregar()
+        except Exception as e:
+            app.logger.warning(f"Falha ao carregar cooperados em corrida: {e}")
+        if not e_lider("presenca", PRESENCA_VARREDURA_SEC):
+            continue  # outro worker varre (e replica as transições)
+        try:
+            for t in POSICOES.varrer_presenca():
+                emitir_status_motoboy(*t)
+        except Exception as e:
+            app.logger.warning(f"Falha na varredura de presença: {e}")
+
+
+def iniciar_varredura_presenca():
+    socketio.start_background_task(_loop_varredura_presenca)
+
+
+# =========================================================
+# TRANSMISSÃO DE POSIÇÕES (QUADROS POR SALA)
+# =========================================================
+# Os pings só marcam quem se mexeu; a cada POSICAO_TRANSMISSAO_SEC sai um único
+# quadro 'posicoes_motoboys' com as últimas posições para a sala 'admins', e cada
+# sala 'entrega_<id>' (rastreio) recebe só a posição do cooperado daquela corrida.
+POSICAO_TRANSMISSAO_SEC = float(os.getenv("POSICAO_TRANSMISSAO_SEC", "1"))
+
+
+class TransmissorPosicoes:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pendentes = set()
+
+    def marcar(self, cooperado_id):
+        with self._lock:
+            self._pendentes.add(cooperado_id)
+
+    def drenar(self) -> set:
+        with self._lock:
+            pendentes, self._pendentes = self._pendentes, set()
+        return pendentes
+
+
+TRANSMISSOR_POSICOES = TransmissorPosicoes()
+
+
+def transmitir_posicoes():
+    itens = []
+    for cid in TRANSMISSOR_POSICOES.drenar():
+        pos = POSICOES.get(cid)
+        if pos is not None and pos.last_lat is not None and pos.last_lng is not None:
+            itens.append(payload_posicao_motoboy(pos))
+    if not itens:
+        return
+
+    socketio.emit("posicoes_motoboys", {"itens": itens}, to="admins")
+
+    with app.app_context():
+        try:
+            for item in itens:
+                for entrega_id in CERCAS.corridas_ativas(item["id"]):
+                    socketio.emit("posicao_entrega", {
+                        "entrega_id": entrega_id,
+                        "lat": item["lat"],
+                        "lng": item["lng"],
+                        "cooperado": item["nome"],
+                        "quando_local": item["ultima_atualizacao"],
+                    }, to=f"entrega_{entrega_id}")
+        finally:
+            db.session.remove()
+
+
+def _loop_transmissao_posicoes():
+    while True:
+        socketio.sleep(POSICAO_TRANSMISSAO_SEC)
+        try:
+            transmitir_posicoes()
+        except Exception as e:
+            app.logger.warning(f"Falha na transmissão de posições: {e}")
+
+
+def iniciar_transmissao_posicoes():
+    socketio.start_background_task(_loop_transmissao_posicoes)
+
+
+# =========================================================
+# ÍNDICE ESPACIAL (GRADE) DAS POSIÇÕES AO VIVO
+# =========================================================
+# Grade uniforme em graus: célula (i, j) = floor(lat/d), floor(lng/d).
+# Cada ping move o cooperado de célula em O(1); "quem está perto" visita só
+# as células em anéis ao redor do ponto, em vez de varrer todos os cooperados.
+GRADE_CELULA_M = float(os.getenv("GRADE_CELULA_M", "500"))
+GRADE_RAIO_MAX_M = float(os.getenv("GRADE_RAIO_MAX_M", "50000"))  # teto de busca do kNN
+STATUS_DISPONIVEIS = ("livre", "ocioso")
+
+
+class GradeEspacial:
+    def __init__(self, celula_m: float):
+        self.passo = celula_m / 110_540.0  # graus de latitude por célula
+        self._lock = threading.Lock()
+        self._celulas = {}  # (i, j) -> {cooperado_id: (lat, lng)}
+        self._onde = {}     # cooperado_id -> (i, j)
+
+    def _celula(self, lat, lng):
+        return (math.floor(lat / self.passo), math.floor(lng / self.passo))
+
+    def mover(self, cooperado_id, lat, lng):
+        if lat is None or lng is None:
+            return
+        nova = self._celula(lat, lng)
+        with self._lock:
+            antiga = self._onde.get(cooperado_id)
+            if antiga is not None and antiga != nova:
+                cel = self._celulas.get(antiga)
+                if cel is not None:
+                    cel.pop(cooperado_id, None)
+                    if not cel:
+                        del self._celulas[antiga]
+            self._celulas.setdefault(nova, {})[cooperado_id] = (lat, lng)
+            self._onde[cooperado_id] = nova
+
+    def remover(self, cooperado_id):
+        with self._lock:
+            antiga = self._onde.pop(cooperado_id, None)
+            if antiga is not None:
+                cel = self._celulas.get(antiga)
+                if cel is not None:
+                    cel.pop(cooperado_id, None)
+                    if not cel:
+                        del self._celulas[antiga]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._onde)
+
+    def _anel(self, ci, cj, r):
+        """Itens das células na borda do quadrado de raio r (em células) ao redor de (ci, cj)."""
+        if r == 0:
+            chaves = [(ci, cj)]
+        else:
+            chaves = [(ci - r, cj + d) for d in range(-r, r + 1)]
+            chaves += [(ci + r, cj + d) for d in range(-r, r + 1)]
+            chaves += [(ci + d, cj - r) for d in range(-r + 1, r)]
+            chaves += [(ci + d, cj + r) for d in range(-r + 1, r)]
+        itens = []
+        with self._lock:
+            for ch in chaves:
+                cel = self._celulas.get(ch)
+                if cel:
+                    itens.extend((cid, a, b) for cid, (a, b) in cel.items())
+        return itens
+
+    def buscar(self, lat, lng, k=None, raio_m=None, aceitar=None):
+        """
+        Vizinhos de (lat, lng) em ordem de distância: lista de (dist_m, cooperado_id).
+        k: quantos no máximo; raio_m: distância máxima; aceitar(id) -> bool filtra.
+        Expande anel a anel e para quando nenhum ponto fora do anel pode ser mais
+        perto que o k-ésimo encontrado (ou quando passou do raio / viu todos).
+        """
+        if raio_m is None:
+            raio_m = GRADE_RAIO_MAX_M
+        ci, cj = self._celula(lat, lng)
+        # menor lado da célula em metros (lng encolhe com cos(lat))
+        lado_m = self.passo * 111_320.0 * max(math.cos(math.radians(lat)), 0.01)
+        lado_m = min(lado_m, self.passo * 110_540.0)
+        max_r = int(raio_m / lado_m) + 1
+        total = len(self)
+
+        achados = []
+        vistos = 0
+        r = 0
+        while r <= max_r and vistos < total:
+            for cid, a, b in self._anel(ci, cj, r):
+                vistos += 1
+                d = haversine_m(lat, lng, a, b)
+                if d > raio_m:
+                    continue
+                if aceitar is not None and not aceitar(cid):
+                    continue
+                achados.append((d, cid))
+            if k is not None and len(achados) >= k:
+                achados.sort()
+                # tudo que está fora do anel r fica a >= r * lado_m do ponto
+                if achados[k - 1][0] <= r * lado_m:
+                    break
+            r += 1
+
+        achados.sort()
+        return achados[:k] if k is not None else achados
+
+
+GRADE = GradeEspacial(GRADE_CELULA_M)
+
+
+def _filtro_status(status):
+    status = tuple(status) if status else None
+    if not status:
+        return None
+    return lambda cid: POSICOES.status(cid)[2] in status
+
+
+def motoboys_proximos(lat, lng, k=5, raio_m=None, status=STATUS_DISPONIVEIS, excluir=()):
+    """k cooperados mais próximos com status em `status`: lista de (dist_m, cooperado_id)."""
+    filtro = _filtro_status(status)
+    excluir = set(excluir or ())
+    if excluir:
+        base = filtro
+        filtro = lambda cid: cid not in excluir and (base is None or base(cid))
+    return GRADE.buscar(lat, lng, k=k, raio_m=raio_m, aceitar=filtro)
+
+
+def motoboys_no_raio(lat, lng, raio_m, status=STATUS_DISPONIVEIS):
+    """Todos os cooperados a até raio_m metros, com status em `status`, do mais perto ao mais longe."""
+    return GRADE.buscar(lat, lng, raio_m=raio_m, aceitar=_filtro_status(status))
+
+
+def semear_posicoes_do_banco():
+    """No boot, indexa quem tem posição gravada (os pings seguintes atualizam)."""
+    with app.app_context():
+        try:
+            POSICOES.semear(
+                Cooperado.query.filter(Cooperado.last_lat.isnot(None), Cooperado.last_lng.isnot(None)).all()
+            )
+        except Exception as e:
+            app.logger.warning(f"Falha ao carregar posições: {e}")
+        finally:
+            db.session.remove()
+    if BACKPLANE.distribuido:
+        # posições que os outros workers ainda não gravaram no banco
+        try:
+            for valor in BACKPLANE.hgetall("posicoes").values():
+                POSICOES.aplicar_remota(json.loads(valor), somente_se_mais_novo=True)
+        except Exception as e:
+            app.logger.warning(f"Backplane: falha ao carregar posições: {e}")
+
+
+def _loop_replicacao_posicoes():
+    for valor in BACKPLANE.escutar("posicoes"):
+        try:
+            dados = json.loads(valor)
+            if dados.get("origem") != WORKER_ID:
+                POSICOES.aplicar_remota(dados)
+        except Exception as e:
+            app.logger.warning(f"Backplane: posição inválida recebida: {e}")
+
+
+def iniciar_replicacao_posicoes():
+    if BACKPLANE.distribuido:
+        socketio.start_background_task(_loop_replicacao_posicoes)
+
+
+# =========================================================
+# DESPACHO AUTOMÁTICO DE ENTREGAS
+# =========================================================
+# Opcional (DESPACHO_AUTO=1 ou POST /api/despacho/auto). A cada DESPACHO_INTERVALO_SEC
+# pega as entregas sem cooperado e oferece cada uma ao cooperado livre/ocioso de menor custo:
+#   custo = distância até a coleta (m)
+#           + DESPACHO_M_POR_POSICAO * posição na ListaEspera (fora da fila = depois do último)
+#           - DESPACHO_M_POR_MIN_OCIOSO * minutos ocioso (limitado a DESPACHO_OCIOSO_MAX_MIN)
+# A entrega fica com status_corrida='pendente', aguardando o aceite do cooperado.
+DESPACHO_AUTO = os.getenv("DESPACHO_AUTO", "0") == "1"
+DESPACHO_INTERVALO_SEC = float(os.getenv("DESPACHO_INTERVALO_SEC", "3"))
+DESPACHO_RAIO_M = float(os.getenv("DESPACHO_RAIO_M", "8000"))
+DESPACHO_CANDIDATOS = int(os.getenv("DESPACHO_CANDIDATOS", "10"))
+DESPACHO_M_POR_POSICAO = float(os.getenv("DESPACHO_M_POR_POSICAO", "400"))
+DESPACHO_M_POR_MIN_OCIOSO = float(os.getenv("DESPACHO_M_POR_MIN_OCIOSO", "50"))
+DESPACHO_OCIOSO_MAX_MIN = float(os.getenv("DESPACHO_OCIOSO_MAX_MIN", "30"))
+DESPACHO_JANELA_H = float(os.getenv("DESPACHO_JANELA_H", "6"))                # entregas mais velhas ficam com o admin
+DESPACHO_ANTECEDENCIA_MIN = float(os.getenv("DESPACHO_ANTECEDENCIA_MIN", "30"))  # agendadas: despacha X min antes
+DESPACHO_LOTE = int(os.getenv("DESPACHO_LOTE", "50"))
+STATUS_CONCLUIDOS = ("recebido", "entregue")
+
+
+class Despachante:
+    """Liga/desliga do despacho + quem já recusou cada entrega (para não reoferecer)."""
+
+    def __init__(self, ativo: bool):
+        self.ativo = ativo
+        self._lock = threading.Lock()
+        self._recusas = {}  # entrega_id -> {cooperado_id: quando}
+
+    def registrar_recusa(self, entrega_id, cooperado_id):
+        with self._lock:
+            self._recusas.setdefault(int(entrega_id), {})[int(cooperado_id)] = datetime.utcnow()
+
+    def recusaram(self, entrega_id) -> set:
+        with self._lock:
+            return set(self._recusas.get(entrega_id, ()))
+
+    def esquecer_antigas(self, limite):
+        with self._lock:
+            for eid in list(self._recusas):
+                quem = {c: t for c, t in self._recusas[eid].items() if t >= limite}
+                if quem:
+                    self._recusas[eid] = quem
+                else:
+                    del self._recusas[eid]
+
+
+DESPACHANTE = Despachante(DESPACHO_AUTO)
+
+
+def _filtro_entrega_aberta():
+    return (Entrega.status == None) | (~func.lower(Entrega.status).in_(STATUS_CONCLUIDOS))
+
+
+def _cooperados_ocupados(desde) -> set:
+    """Cooperados com corrida pendente (aguardando aceite) ou aceita e ainda não concluída."""
+    linhas = (
+        db.session.query(Entrega.cooperado_id)
+        .filter(
+            Entrega.cooperado_id.isnot(None),
+            Entrega.status_corrida.in_(['pendente', 'aceita']),
+            Entrega.data_envio >= desde,
+            _filtro_entrega_aberta(),
+        )
+        .distinct()
+        .all()
+    )
+    return {cid for (cid,) in linhas}
+
+
+def _fila_espera() -> dict:
+    """cooperado_id -> posição na ListaEspera (0 = primeiro)."""
+    ids = [
+        cid for (cid,) in (
+            db.session.query(ListaEspera.cooperado_id)
+            .filter(ListaEspera.cooperado_id.isnot(None))
+            .order_by(ListaEspera.pos.asc(), ListaEspera.created_at.asc())
+            .all()
+        )
+    ]
+    return {cid: i for i, cid in enumerate(ids)}
+
+
+def custo_despacho(dist_m, pos_fila, idle_s) -> float:
+    ocioso_min = min((idle_s or 0) / 60.0, DESPACHO_OCIOSO_MAX_MIN)
+    return dist_m + DESPACHO_M_POR_POSICAO * pos_fila - DESPACHO_M_POR_MIN_OCIOSO * ocioso_min
+
+
+def escolher_cooperado(entrega, fila: dict, excluir=()):
+    """
+    Melhor cooperado para a entrega: (custo, cooperado_id, dist_m) ou None.
+    Candidatos: os DESPACHO_CANDIDATOS mais próximos da coleta (grade) + quem está na fila
+    dentro do raio. Sem lat/lng de coleta, só a fila decide.
+    """
+    origem = entrega.get_origem()
+    lat, lng = _float_or_none(origem.get("lat")), _float_or_none(origem.get("lng"))
+
+    candidatos = {}
+    if lat is not None and lng is not None:
+        for dist, cid in motoboys_proximos(lat, lng, k=DESPACHO_CANDIDATOS,
+                                           raio_m=DESPACHO_RAIO_M, excluir=excluir):
+            candidatos[cid] = dist
+        for cid in fila:
+            if cid in candidatos or cid in excluir:
+                continue
+            p = POSICOES.get(cid)
+            if p is None or p.last_lat is None or p.last_lng is None:
+                continue
+            dist = haversine_m(lat, lng, p.last_lat, p.last_lng)
+            if dist <= DESPACHO_RAIO_M:
+                candidatos[cid] = dist
+    else:
+        for cid in fila:
+            if cid not in excluir:
+                candidatos[cid] = 0.0
+
+    fim_fila = len(fila)
+    melhor = None
+    for cid, dist in candidatos.items():
+        _, idle_s, status_str = POSICOES.status(cid)
+        if status_str not in STATUS_DISPONIVEIS:
+            continue
+        custo = custo_despacho(dist, fila.get(cid, fim_fila), idle_s)
+        if melhor is None or custo < melhor[0]:
+            melhor = (custo, cid, dist)
+    return melhor
+
+
+def atribuir_automaticamente(entrega, cooperado_id) -> bool:
+    """Atribui só se a entrega continua sem cooperado (o admin pode ter atribuído antes)."""
+    n = (
+        Entrega.query
+        .filter(Entrega.id == entrega.id, Entrega.cooperado_id.is_(None))
+        .update({
+            "cooperado_id": cooperado_id,
+            "data_atribuida": datetime.utcnow(),
+            "status_corrida": "pendente",
+            "versao": Entrega.versao + 1,
+        }, synchronize_session=False)
+    )
+    if not n:
+        db.session.rollback()
+        return False
+    ListaEspera.query.filter_by(cooperado_id=cooperado_id).delete(synchronize_session=False)
+    db.session.commit()
+    return True
+
+
+def rodar_despacho() -> int:
+    """Uma rodada do despacho. Retorna quantas entregas foram oferecidas."""
+    with app.app_context():
+        try:
+            agora = datetime.utcnow()
+            desde = agora - timedelta(hours=DESPACHO_JANELA_H)
+            DESPACHANTE.esquecer_antigas(desde)
+
+            pendentes = (
+                Entrega.query
+                .filter(
+                    Entrega.cooperado_id.is_(None),
+                    Entrega.data_envio >= desde,
+                    Entrega.data_envio <= agora + timedelta(minutes=DESPACHO_ANTECEDENCIA_MIN),
+                    _filtro_entrega_aberta(),
+                )
+                .order_by(Entrega.data_envio.asc())
+                .limit(DESPACHO_LOTE)
+                .all()
+            )
+            if not pendentes:
+                return 0
+
+            ocupados = _cooperados_ocupados(desde)
+            fila = _fila_espera()
+            feitas = 0
+            for entrega in pendentes:
+                escolha = escolher_cooperado(entrega, fila, ocupados | DESPACHANTE.recusaram(entrega.id))
+                if escolha is None:
+                    continue
+                _, cid, _ = escolha
+                if not atribuir_automaticamente(entrega, cid):
+                    continue
+
+                feitas += 1
+                ocupados.add(cid)
+                saiu_da_fila = fila.pop(cid, None) is not None
+                if saiu_da_fila:
+                    fila = {c: i for i, c in enumerate(sorted(fila, key=fila.get))}
+
+                agendar_expiracao_oferta(entrega)
+                emitir_atualizacao_entrega(entrega, "atribuida")
+                emitir_oferta_corrida(entrega)
+                if saiu_da_fila:
+                    emitir_lista_espera()
+            return feitas
+        except Exception as e:
+            db.session.rollback()
+            app.logger.warning(f"Falha no despacho automático: {e}")
+            return 0
+        finally:
+            db.session.remove()
+
+
+def despacho_ativo() -> bool:
+    """Chave liga/desliga: vale para todos os workers quando há backplane."""
+    if BACKPLANE.distribuido:
+        try:
+            valor = BACKPLANE.hget("config", "despacho_ativo")
+            if valor is not None:
+                DESPACHANTE.ativo = valor == "1"
+        except Exception as e:
+            app.logger.warning(f"Backplane: falha ao ler despacho_ativo ({e})")
+    return DESPACHANTE.ativo
+
+
+def _loop_despacho():
+    while True:
+        socketio.sleep(DESPACHO_INTERVALO_SEC)
+        if despacho_ativo() and e_lider("despacho", DESPACHO_INTERVALO_SEC):
+            rodar_despacho()
+
+
+def iniciar_despacho():
+    socketio.start_background_task(_loop_despacho)
+
+
+# =========================================================
+# OFERTAS COM PRAZO (RODA DE TEMPORIZADORES) + REOFERTA EM CASCATA
+# =========================================================
+# Entrega atribuída fica 'pendente' até o cooperado aceitar. Se ele não responder
+# em OFERTA_TIMEOUT_SEC (0 desliga), a oferta conta como recusa e passa ao próximo
+# candidato (fila de espera / proximidade, mesmas regras do despacho automático).
+OFERTA_TIMEOUT_SEC = int(os.getenv("OFERTA_TIMEOUT_SEC", "45"))
+RODA_SLOTS = int(os.getenv("RODA_SLOTS", "512"))
+RODA_TICK_SEC = float(os.getenv("RODA_TICK_SEC", "1"))
+
+
+class RodaTemporizadores:
+    """
+    Roda de temporizadores (hashed timing wheel): agendar e cancelar em O(1).
+    Cada slot é um dict chave -> [voltas_restantes, callback, args]; a cada tick o
+    cursor anda um slot e dispara o que estiver com 0 voltas.
+    """
+
+    def __init__(self, slots: int, tick_s: float):
+        self.tick_s = tick_s
+        self._lock = threading.Lock()
+        self._slots = [dict() for _ in range(slots)]
+        self._onde = {}  # chave -> índice do slot
+        self._cursor = 0
+
+    def agendar(self, chave, atraso_s: float, callback, *args):
+        """(Re)agenda `callback(*args)` para daqui a atraso_s; a chave substitui um agendamento anterior."""
+        n = len(self._slots)
+        ticks = max(1, int(math.ceil(atraso_s / self.tick_s)))
+        with self._lock:
+            self._remover(chave)
+            idx = (self._cursor + ticks) % n
+            self._slots[idx][chave] = [(ticks - 1) // n, callback, args]
+            self._onde[chave] = idx
+
+    def cancelar(self, chave) -> bool:
+        with self._lock:
+            return self._remover(chave)
+
+    def _remover(self, chave) -> bool:
+        idx = self._onde.pop(chave, None)
+        if idx is None:
+            return False
+        self._slots[idx].pop(chave, None)
+        return True
+
+    def __len__(self):
+        return len(self._onde)
+
+    def avancar(self):
+        """Um tick: dispara (fora do lock) os temporizadores vencidos no slot atual."""
+        vencidos = []
+        with self._lock:
+            self._cursor = (self._cursor + 1) % len(self._slots)
+            slot = self._slots[self._cursor]
+            for chave, item in list(slot.items()):
+                if item[0] == 0:
+                    del slot[chave]
+                    del self._onde[chave]
+                    vencidos.append(item)
+                else:
+                    item[0] -= 1
+
+        for _, callback, args in vencidos:
+            try:
+                callback(*args)
+            except Exception as e:
+                app.logger.warning(f"Falha em temporizador: {e}")
+
+
+RODA_TEMPORIZADORES = RodaTemporizadores(RODA_SLOTS, RODA_TICK_SEC)
+
+
+def agendar_expiracao_oferta(entrega, atraso_s=None):
+    """Começa (ou recomeça) a contar o prazo da oferta pendente da entrega."""
+    if OFERTA_TIMEOUT_SEC <= 0 or not entrega or not entrega.cooperado_id:
+        return
+    RODA_TEMPORIZADORES.agendar(
+        ("oferta", entrega.id),
+        OFERTA_TIMEOUT_SEC if atraso_s is None else atraso_s,
+        expirar_oferta, entrega.id, entrega.cooperado_id,
+    )
+
+
+def cancelar_expiracao_oferta(entrega_id):
+    RODA_TEMPORIZADORES.cancelar(("oferta", int(entrega_id)))
+
+
+def reoferecer_entrega(entrega, anterior_id):
+    """
+    Passa a entrega recusada/expirada por `anterior_id` ao próximo candidato.
+    Sem candidato, a entrega volta sem cooperado com status_corrida='recusada'.
+    Retorna o novo cooperado_id (ou None).
+    """
+    desde = datetime.utcnow() - timedelta(hours=DESPACHO_JANELA_H)
+    fila = _fila_espera()
+    excluir = _cooperados_ocupados(desde) | DESPACHANTE.recusaram(entrega.id)
+    if anterior_id:
+        excluir.add(anterior_id)
+    escolha = escolher_cooperado(entrega, fila, excluir)
+    novo_id = escolha[1] if escolha else None
+
+    if novo_id:
+        valores = {"cooperado_id": novo_id, "data_atribuida": datetime.utcnow(), "status_corrida": "pendente"}
+    else:
+        valores = {"cooperado_id": None, "data_atribuida": None, "status_corrida": "recusada"}
+    valores["versao"] = Entrega.versao + 1
+
+    n = (
+        Entrega.query
+        .filter(
+            Entrega.id == entrega.id,
+            (Entrega.status_corrida.is_(None)) | (Entrega.status_corrida != "aceita"),
+            (Entrega.cooperado_id == anterior_id) | (Entrega.cooperado_id.is_(None)),
+        )
+        .update(valores, synchronize_session=False)
+    )
+    if not n:
+        db.session.rollback()
+        return None
+
+    saiu_da_fila = novo_id in fila
+    if saiu_da_fila:
+        ListaEspera.query.filter_by(cooperado_id=novo_id).delete(synchronize_session=False)
+    db.session.commit()
+
+    if novo_id:
+        agendar_expiracao_oferta(entrega)
+        emitir_atualizacao_entrega(entrega, "reoferecida")
+        emitir_oferta_corrida(entrega)
+        if saiu_da_fila:
+            emitir_lista_espera()
+    else:
+        emitir_atualizacao_entrega(entrega, "recusada")
+    return novo_id
+
+
+def expirar_oferta(entrega_id, cooperado_id):
+    """Prazo da oferta acabou: se ainda está pendente com o mesmo cooperado, conta como recusa."""
+    with app.app_context():
+        try:
+            entrega = Entrega.query.get(entrega_id)
+            if (
+                entrega is None
+                or entrega.cooperado_id != cooperado_id
+                or entrega.status_corrida != "pendente"
+                or (entrega.status or "").lower() in STATUS_CONCLUIDOS
+            ):
+                return
+            DESPACHANTE.registrar_recusa(entrega_id, cooperado_id)
+            reoferecer_entrega(entrega, cooperado_id)
+        except Exception as e:
+            db.session.rollback()
+            app.logger.warning(f"Falha ao expirar oferta da entrega {entrega_id}: {e}")
+        finally:
+            db.session.remove()
+
+
+def retomar_ofertas_pendentes():
+    """
+    No boot, reagenda o prazo das ofertas que estavam pendentes (com o tempo que sobrou).
+    Roda em todo worker, sem liderança: uma concessão presa ao worker antigo deixaria
+    ninguém rearmar depois de um deploy. Expirar duas vezes é inofensivo (expirar_oferta
+    confere o cooperado e reoferecer_entrega é um UPDATE condicional).
+    """
+    if OFERTA_TIMEOUT_SEC <= 0:
+        return
+    with app.app_context():
+        try:
+            agora = datetime.utcnow()
+            pendentes = (
+                Entrega.query
+                .filter(
+                    Entrega.cooperado_id.isnot(None),
+                    Entrega.status_corrida == "pendente",
+                    Entrega.data_envio >= agora - timedelta(hours=DESPACHO_JANELA_H),
+                    Entrega.data_envio <= agora + timedelta(minutes=DESPACHO_ANTECEDENCIA_MIN),
+                    _filtro_entrega_aberta(),
+                )
+                .all()
+            )
+            agora_utc = datetime.now(timezone.utc)
+            for e in pendentes:
+                atribuida = _to_utc_aware(e.data_atribuida)
+                decorrido = (agora_utc - atribuida).total_seconds() if atribuida else 0
+                agendar_expiracao_oferta(e, max(RODA_TICK_SEC, OFERTA_TIMEOUT_SEC - decorrido))
+        except Exception as e:
+            app.logger.warning(f"Falha ao retomar ofertas pendentes: {e}")
+        finally:
+            db.session.remove()
+
+
+def _loop_roda_temporizadores():
+    while True:
+        socketio.sleep(RODA_TEMPORIZADORES.tick_s)
+        RODA_TEMPORIZADORES.avancar()
+
+
+def iniciar_roda_temporizadores():
+    socketio.start_background_task(_loop_roda_temporizadores)
+
+
+# =========================================================
+# ROTEIRIZAÇÃO DAS PARADAS INTERMEDIÁRIAS
+# =========================================================
+# Origem e destino ficam fixos; as paradas com lat/lng são reordenadas por
+# vizinho mais próximo + 2-opt/or-opt sobre a distância haversine. Paradas sem
+# coordenada continuam na posição em que o cliente as digitou.
+ROTA_FATOR_VIA = float(os.getenv("ROTA_FATOR_VIA", "1.3"))  # linha reta -> estimativa pelas ruas
+ROTA_MAX_PASSADAS = int(os.getenv("ROTA_MAX_PASSADAS", "50"))
+
+
+def _coord_ponto(ponto):
+    """(lat, lng) de um dict de origem/destino/parada, ou None."""
+    if not isinstance(ponto, dict):
+        return None
+    lat, lng = _float_or_none(ponto.get("lat")), _float_or_none(ponto.get("lng"))
+    if lat is None or lng is None:
+        return None
+    return (lat, lng)
+
+
+def _comprimento_caminho(caminho, dist) -> float:
+    return sum(dist[a][b] for a, b in zip(caminho, caminho[1:]))
+
+
+def ordenar_pontos(pontos, inicio=None, fim=None) -> list:
+    """
+    Ordem (índices de `pontos`) do caminho inicio -> pontos -> fim mais curto que a
+    heurística acha. inicio/fim: (lat, lng) ou None (ponta livre).
+    """
+    n = len(pontos)
+    if n <= 1:
+        return list(range(n))
+
+    coords = list(pontos) + [inicio, fim]
+    ini = n if inicio is not None else None
+    fin = n + 1 if fim is not None else None
+    nos = [i for i in range(n + 2) if coords[i] is not None]
+    dist = [[0.0] * (n + 2) for _ in range(n + 2)]
+    for a in nos:
+        for b in nos:
+            if a < b:
+                dist[a][b] = dist[b][a] = haversine_m(*coords[a], *coords[b])
+
+    # vizinho mais próximo (sem início fixo, testa cada ponto como o primeiro)
+    melhor = None
+    for primeiro in ([ini] if ini is not None else range(n)):
+        atual = primeiro
+        restantes = set(range(n)) - {primeiro}
+        ordem = [] if ini is not None else [primeiro]
+        while restantes:
+            atual = min(restantes, key=lambda j: dist[atual][j])
+            restantes.discard(atual)
+            ordem.append(atual)
+        caminho = ([ini] if ini is not None else []) + ordem + ([fin] if fin is not None else [])
+        total = _comprimento_caminho(caminho, dist)
+        if melhor is None or total < melhor[0]:
+            melhor = (total, caminho)
+    caminho = melhor[1]
+
+    def d(a, b):
+        # ponta livre (None) não custa nada
+        return 0.0 if a is None or b is None else dist[a][b]
+
+    def vizinho(c, k):
+        return c[k] if 0 <= k < len(c) else None
+
+    # 2-opt (inverte um trecho) + or-opt (move um trecho de 1 a 3 paradas),
+    # repetidos enquanto encurtarem. Pontas fixas não se movem.
+    lo = 1 if ini is not None else 0
+    for _ in range(ROTA_MAX_PASSADAS):
+        melhorou = False
+        hi = len(caminho) - (1 if fin is not None else 0)
+
+        for i in range(lo, hi - 1):
+            for j in range(i + 1, hi):
+                a, b = vizinho(caminho, i - 1), vizinho(caminho, j + 1)
+                antes = d(a, caminho[i]) + d(caminho[j], b)
+                if d(a, caminho[j]) + d(caminho[i], b) < antes - 1e-6:
+                    caminho[i:j + 1] = reversed(caminho[i:j + 1])
+                    melhorou = True
+
+        for tam in (1, 2, 3):
+            i = lo
+            while i + tam <= hi:
+                trecho = caminho[i:i + tam]
+                a, b = vizinho(caminho, i - 1), vizinho(caminho, i + tam)
+                ganho = d(a, trecho[0]) + d(trecho[-1], b) - d(a, b)
+                resto = caminho[:i] + caminho[i + tam:]
+                k_min = lo
+                k_max = len(resto) - (1 if fin is not None else 0)
+                melhor_mov = None
+                for k in range(k_min, k_max + 1):
+                    if k == i:
+                        continue
+                    x, y = vizinho(resto, k - 1), vizinho(resto, k)
+                    for seg in (trecho, trecho[::-1]):
+                        custo = d(x, seg[0]) + d(seg[-1], y) - d(x, y)
+                        if custo < ganho - 1e-6 and (melhor_mov is None or custo < melhor_mov[0]):
+                            melhor_mov = (custo, k, seg)
+                if melhor_mov is not None:
+                    _, k, seg = melhor_mov
+                    caminho = resto[:k] + list(seg) + resto[k:]
+                    melhorou = True
+                i += 1
+
+        if not melhorou:
+            break
+
+    return [k for k in caminho if k < n]
+
+
+def km_estimado_rota(origem, destino, paradas) -> Optional[float]:
+    """km pela sequência origem -> paradas -> destino (só pontos com coordenada), já com ROTA_FATOR_VIA."""
+    pontos = [c for c in [_coord_ponto(origem)] + [_coord_ponto(p) for p in paradas] + [_coord_ponto(destino)] if c]
+    if len(pontos) < 2:
+        return None
+    metros = sum(haversine_m(*a, *b) for a, b in zip(pontos, pontos[1:]))
+    return round(metros * ROTA_FATOR_VIA / 1000.0, 2)
+
+
+def otimizar_paradas(origem, destino, paradas) -> dict:
+    """
+    Reordena as paradas entre origem e destino.
+    Retorna {"paradas": nova lista, "ordem": índices originais na nova ordem,
+             "km_estimado": km ou None, "km_antes": km na ordem digitada}.
+    """
+    paradas = list(paradas or [])
+    com_coord = [(i, _coord_ponto(p)) for i, p in enumerate(paradas)]
+    com_coord = [(i, c) for i, c in com_coord if c is not None]
+
+    ordem = list(range(len(paradas)))
+    if len(com_coord) >= 2:
+        nova = ordenar_pontos([c for _, c in com_coord], _coord_ponto(origem), _coord_ponto(destino))
+        for (posicao, _), k in zip(com_coord, nova):
+            ordem[posicao] = com_coord[k][0]
+
+    novas = [paradas[i] for i in ordem]
+    return {
+        "paradas": novas,
+        "ordem": ordem,
+        "km_estimado": km_estimado_rota(origem, destino, novas),
+        "km_antes": km_estimado_rota(origem, destino, paradas),
+    }
+
+
+def resumo_rota(resultado: dict) -> dict:
+    """Bloco 'rota' guardado junto das paradas (paradas_json)."""
+    return {
+        "km_estimado": resultado["km_estimado"],
+        "ordem_original": resultado["ordem"],
+        "calculada_em": datetime.utcnow().isoformat(timespec="seconds"),
+    }
+
+
+def roteirizar_entrega(entrega) -> dict:
+    """Otimiza e grava a ordem das paradas da entrega (sem commit)."""
+    dados = entrega._get_paradas_dict()
+    resultado = otimizar_paradas(entrega.get_origem(), entrega.get_destino(), dados["stops"])
+    dados["stops"] = resultado["paradas"]
+    dados["rota"] = resumo_rota(resultado)
+    entrega.paradas_json = json.dumps(dados, ensure_ascii=False)
+    return resultado
+
+
+# =========================================================
+# CERCAS (GEOFENCE) DE COLETA/DESTINO NO FLUXO DE PINGS
+# =========================================================
+# Para cada cooperado, guarda em memória as cercas das corridas aceitas e ainda
+# abertas (um círculo de CERCA_RAIO_M em volta da coleta e do destino), com a
+# caixa lat/lng já calculada: por ping, o custo é comparar alguns floats.
+# Só quem cai dentro da caixa paga o haversine. O destino só arma depois da
+# coleta (ou se a coleta não tem coordenada).
+CERCA_RAIO_M = float(os.getenv("CERCA_RAIO_M", "80"))
+CERCA_RECARREGAR_SEC = float(os.getenv("CERCA_RECARREGAR_SEC", "60"))
+
+
+class Cerca:
+    __slots__ = ("entrega_id", "tipo", "lat", "lng", "min_lat", "max_lat", "min_lng", "max_lng", "disparada")
+
+    def __init__(self, entrega_id, tipo, lat, lng, raio_m, disparada=False):
+        self.entrega_id = entrega_id
+        self.tipo = tipo  # 'coleta' | 'destino'
+        self.lat = lat
+        self.lng = lng
+        dlat = raio_m / 110_540.0
+        dlng = raio_m / (111_320.0 * max(math.cos(math.radians(lat)), 0.01))
+        self.min_lat, self.max_lat = lat - dlat, lat + dlat
+        self.min_lng, self.max_lng = lng - dlng, lng + dlng
+        self.disparada = disparada
+
+    def contem(self, lat, lng) -> bool:
+        if not (self.min_lat <= lat <= self.max_lat and self.min_lng <= lng <= self.max_lng):
+            return False
+        return haversine_m(self.lat, self.lng, lat, lng) <= CERCA_RAIO_M
+
+
+def cercas_da_entrega(entrega) -> list:
+    cercas = []
+    coleta = _coord_ponto(entrega.get_origem())
+    if coleta:
+        cercas.append(Cerca(entrega.id, "coleta", *coleta, CERCA_RAIO_M,
+                            disparada=entrega.chegada_coleta_em is not None))
+    destino = _coord_ponto(entrega.get_destino())
+    if destino:
+        cercas.append(Cerca(entrega.id, "destino", *destino, CERCA_RAIO_M,
+                            disparada=entrega.chegada_destino_em is not None))
+    return cercas
+
+
+class CercasAtivas:
+    """cooperado_id -> (carregado_em, [Cerca], [ids das corridas ativas]) do cooperado."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._itens = {}
+
+    def invalidar(self, cooperado_id):
+        if cooperado_id:
+            with self._lock:
+                self._itens.pop(int(cooperado_id), None)
+
+    def _carregar(self, cooperado_id, agora):
+        with self._lock:
+            item = self._itens.get(cooperado_id)
+        if item is not None and agora - item[0] < CERCA_RECARREGAR_SEC:
+            return item
+
+        entregas = (
+            Entrega.query
+            .filter(
+                Entrega.cooperado_id == cooperado_id,
+                Entrega.status_corrida == 'aceita',
+                _filtro_entrega_aberta(),
+            )
+            .all()
+        )
+        item = (agora, [c for e in entregas for c in cercas_da_entrega(e)], [e.id for e in entregas])
+        with self._lock:
+            self._itens[cooperado_id] = item
+        return item
+
+    def corridas_ativas(self, cooperado_id) -> list:
+        return self._carregar(cooperado_id, datetime.utcnow().timestamp())[2]
+
+    def verificar(self, cooperado_id, lat, lng) -> list:
+        """Cercas em que o fix acabou de entrar (cada uma dispara uma única vez)."""
+        if lat is None or lng is None:
+            return []
+        cercas = self._carregar(cooperado_id, datetime.utcnow().timestamp())[1]
+        if not cercas:
+            return []
+
+        coleta_ok = {c.entrega_id for c in cercas if c.tipo == "coleta" and c.disparada}
+        tem_coleta = {c.entrega_id for c in cercas if c.tipo == "coleta"}
+        entrou = []
+        for c in cercas:
+            if c.disparada:
+                continue
+            if c.tipo == "destino" and c.entrega_id in tem_coleta and c.entrega_id not in coleta_ok:
+                continue
+            if c.contem(lat, lng):
+                c.disparada = True
+                entrou.append(c)
+                if c.tipo == "coleta":
+                    coleta_ok.add(c.entrega_id)
+        return entrou
+
+
+CERCAS = CercasAtivas()
+
+
+def registrar_chegadas(cooperado_id, fixes):
+    """
+    Avalia as cercas do cooperado para cada fix (em ordem de horário), grava as
+    chegadas novas num commit próprio e emite os eventos.
+    Chamado pelas rotas de ping DEPOIS do trabalho delas (POSICOES é só memória);
+    num lote, uma chegada no meio do lote conta com o horário daquele fix.
+    """
+    entradas = []
+    try:
+        for fix in fixes:
+            for cerca in CERCAS.verificar(cooperado_id, fix["lat"], fix["lng"]):
+                entradas.append((cerca, fix))
+    except Exception as e:
+        db.session.rollback()
+        app.logger.warning(f"Falha ao avaliar cercas do cooperado {cooperado_id}: {e}")
+        return
+    if not entradas:
+        return
 
-        socketio.emit(
-            "fila_espera_atualizada",
-            {"itens": payload},
-            broadcast=True
-        )
+    gravadas = set()
+    try:
+        for cerca, fix in entradas:
+            coluna = Entrega.chegada_coleta_em if cerca.tipo == "coleta" else Entrega.chegada_destino_em
+            # horário automático: não mexe na versão de edição da entrega
+            n = (
+                Entrega.query
+                .filter(Entrega.id == cerca.entrega_id,
+                        Entrega.cooperado_id == cooperado_id,
+                        coluna.is_(None))
+                .update({coluna: fix["t"]}, synchronize_session=False)
+            )
+            if n:
+                gravadas.add(cerca.entrega_id)
+                # sai no commit abaixo
+                emitir_evento_entrega(cerca.entrega_id, f"chegou_{cerca.tipo}", fix["t"],
+                                      cooperado_id=cooperado_id, lat=fix["lat"], lng=fix["lng"])
+        db.session.commit()
     except Exception as e:
-        try:
-            current_app.logger.warning(f"Falha ao emitir fila_espera_atualizada: {e}")
-        except Exception:
-            pass
+        db.session.rollback()
+        # as cercas já foram marcadas como disparadas: recarrega do banco no próximo fix
+        CERCAS.invalidar(cooperado_id)
+        app.logger.warning(f"Falha ao gravar chegadas do cooperado {cooperado_id}: {e}")
+        return
+    for entrega_id in gravadas:
+        ETAS.invalidar(entrega_id)
 
-class Trajeto(db.Model):
-    __tablename__ = 'trajeto'
 
-    id = db.Column(db.Integer, primary_key=True)
+# =========================================================
+# ETA DAS CORRIDAS ATIVAS
+# =========================================================
+# Velocidade suavizada (EWMA do last_speed_kmh) por cooperado, atualizada a cada
+# ping; a estimativa de cada entrega fica em cache e só é refeita quando o
+# motoboy anda ETA_RECALCULO_M ou o cálculo passa de ETA_RECALCULO_SEC.
+ETA_EWMA_ALFA = float(os.getenv("ETA_EWMA_ALFA", "0.3"))
+ETA_VEL_PADRAO_KMH = float(os.getenv("ETA_VEL_PADRAO_KMH", "22"))
+ETA_VEL_MIN_KMH = float(os.getenv("ETA_VEL_MIN_KMH", "10"))    # parado no sinal não vira ETA infinito
+ETA_VEL_MAX_KMH = float(os.getenv("ETA_VEL_MAX_KMH", "60"))
+ETA_RECALCULO_M = float(os.getenv("ETA_RECALCULO_M", "100"))
+ETA_RECALCULO_SEC = float(os.getenv("ETA_RECALCULO_SEC", "60"))
+ETA_VEL_ESQUECER_SEC = float(os.getenv("ETA_VEL_ESQUECER_SEC", "1800"))  # sem ping há 30 min => esquece a EWMA
+
+
+def pontos_restantes(entrega) -> list:
+    """
+    Coordenadas que faltam visitar: coleta (se ainda não chegou) -> paradas -> destino.
+    Depois da chegada na coleta, estima direto até o destino.
+    """
+    destino = _coord_ponto(entrega.get_destino())
+    if entrega.chegada_coleta_em is not None:
+        return [destino] if destino else []
+    pontos = [_coord_ponto(entrega.get_origem())]
+    pontos += [_coord_ponto(p) for p in entrega.get_paradas()]
+    pontos.append(destino)
+    return [p for p in pontos if p]
+
+
+class MotorETA:
+    """Velocidade EWMA por cooperado + cache de ETA por entrega."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._vel = {}     # cooperado_id -> (km/h suavizado, visto_em epoch)
+        self._cache = {}   # entrega_id -> dict (ver estimar)
+        self._limpo_em = 0.0
+
+    def observar(self, cooperado_id, v_kmh):
+        if v_kmh is None:
+            return
+        agora = datetime.utcnow().timestamp()
+        with self._lock:
+            atual = self._vel.get(cooperado_id)
+            self._vel[cooperado_id] = (
+                v_kmh if atual is None else ETA_EWMA_ALFA * v_kmh + (1 - ETA_EWMA_ALFA) * atual[0],
+                agora,
+            )
+        if agora - self._limpo_em >= ETA_RECALCULO_SEC:
+            self.limpar(agora)
 
-    # Quem fez o trajeto
-    cooperado_id = db.Column(db.Integer, db.ForeignKey('cooperado.id'), nullable=False)
-    cooperado = db.relationship('Cooperado', backref='trajetos')
+    def limpar(self, agora=None):
+        """
+        Esquece ETAs que já passaram do prazo de recálculo (corrida encerrada, excluída
+        ou que ninguém mais consulta) e velocidades de quem parou de pingar.
+        """
+        agora = agora or datetime.utcnow().timestamp()
+        with self._lock:
+            self._limpo_em = agora
+            for eid in [eid for eid, item in self._cache.items()
+                        if agora - item["calculado"].timestamp() >= ETA_RECALCULO_SEC]:
+                del self._cache[eid]
+            for cid in [cid for cid, (_, visto) in self._vel.items()
+                        if agora - visto >= ETA_VEL_ESQUECER_SEC]:
+                del self._vel[cid]
+
+    def velocidade(self, cooperado_id) -> float:
+        with self._lock:
+            v = self._vel.get(cooperado_id)
+            v = v[0] if v is not None else None
+        if v is None:
+            return ETA_VEL_PADRAO_KMH
+        return min(max(v, ETA_VEL_MIN_KMH), ETA_VEL_MAX_KMH)
+
+    def invalidar(self, entrega_id):
+        with self._lock:
+            self._cache.pop(entrega_id, None)
+
+    def estimar(self, entrega):
+        """
+        {"distancia_km", "eta_min", "previsao", "velocidade_kmh", "calculado_em"}
+        da posição ao vivo do cooperado até o destino; None sem cooperado/coordenadas.
+        """
+        cid = entrega.cooperado_id
+        if not cid or (entrega.status or '').strip().lower() in STATUS_CONCLUIDOS:
+            self.invalidar(entrega.id)
+            return None
+        pos = POSICOES.get(cid) or entrega.cooperado
+        if pos is None or pos.last_lat is None or pos.last_lng is None:
+            return None
 
-    # Horários em UTC naive (igual ao resto do sistema)
-    inicio = db.Column(db.DateTime, nullable=False)   # quando começou o trajeto
-    fim = db.Column(db.DateTime, nullable=True)       # quando terminou (se tiver)
+        agora = datetime.now(timezone.utc)
+        with self._lock:
+            item = self._cache.get(entrega.id)
+        if (
+            item is not None
+            and item["cooperado_id"] == cid
+            and (agora - item["calculado"]).total_seconds() < ETA_RECALCULO_SEC
+            and haversine_m(item["lat"], item["lng"], pos.last_lat, pos.last_lng) < ETA_RECALCULO_M
+        ):
+            return item["eta"]
+
+        pontos = pontos_restantes(entrega)
+        if not pontos:
+            return None
+        caminho = [(pos.last_lat, pos.last_lng)] + pontos
+        km = sum(haversine_m(*a, *b) for a, b in zip(caminho, caminho[1:])) * ROTA_FATOR_VIA / 1000.0
+        vel = self.velocidade(cid)
+        minutos = km / vel * 60.0
+        eta = {
+            "distancia_km": round(km, 2),
+            "eta_min": int(math.ceil(minutos)),
+            "previsao": (agora + timedelta(minutes=minutos)).isoformat(timespec="seconds"),
+            "velocidade_kmh": round(vel, 1),
+            "calculado_em": agora.isoformat(timespec="seconds"),
+        }
+        with self._lock:
+            self._cache[entrega.id] = {
+                "cooperado_id": cid, "lat": pos.last_lat, "lng": pos.last_lng,
+                "calculado": agora, "eta": eta,
+            }
+        return eta
 
-    # Métricas principais
-    distancia_m = db.Column(db.Float, nullable=True)          # em metros
-    duracao_s = db.Column(db.Integer, nullable=True)          # em segundos
-    velocidade_media_kmh = db.Column(db.Float, nullable=True) # km/h
 
-    # Coordenadas (opcionais)
-    origem_lat = db.Column(db.Float, nullable=True)
-    origem_lng = db.Column(db.Float, nullable=True)
-    destino_lat = db.Column(db.Float, nullable=True)
-    destino_lng = db.Column(db.Float, nullable=True)
+ETAS = MotorETA()
 
-    # JSON com pontos do trajeto (lista de lat/lng/hora) – para futuro "vídeo" no mapa
-    pontos_json = db.Column(db.Text, nullable=True)
 
-    # Quando foi gravado no sistema
-    criado_em = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+# =========================================================
+# INTERVALO DE PING ADAPTATIVO
+# =========================================================
+# A resposta do ping diz ao aparelho quando pingar de novo e a partir de quantos
+# metros de deslocamento: rápido em corrida aceita ou com rastreio público sendo
+# visto, lento parado na base / na fila de espera. Sem socket aberto, o lento
+# nunca passa da metade de OFFLINE_AFTER_SEC (o ping é o que mantém online).
+PING_RAPIDO_SEC = int(os.getenv("PING_RAPIDO_SEC", "5"))
+PING_NORMAL_SEC = int(os.getenv("PING_NORMAL_SEC", "15"))
+PING_LENTO_SEC = int(os.getenv("PING_LENTO_SEC", "120"))
+PING_RAPIDO_M = int(os.getenv("PING_RAPIDO_M", "10"))
+PING_NORMAL_M = int(os.getenv("PING_NORMAL_M", "30"))
+PING_LENTO_M = int(os.getenv("PING_LENTO_M", "100"))
+RASTREIO_OBSERVADO_SEC = int(os.getenv("RASTREIO_OBSERVADO_SEC", "45"))
+
+# cooperado_id -> última vez (timestamp) que alguém puxou o rastreio público dele
+RASTREIO_OBSERVADO = {}
+
+
+def marcar_rastreio_observado(cooperado_id):
+    RASTREIO_OBSERVADO[cooperado_id] = datetime.utcnow().timestamp()
+
+
+def intervalo_ping(cooperado_id) -> dict:
+    """{"proximo_ping_s", "deslocamento_min_m", "modo_ping"} para o estado atual do cooperado."""
+    agora = datetime.utcnow().timestamp()
+    observado = agora - RASTREIO_OBSERVADO.get(cooperado_id, 0) < RASTREIO_OBSERVADO_SEC
+    if observado or CERCAS.corridas_ativas(cooperado_id):
+        intervalo, metros, modo = PING_RAPIDO_SEC, PING_RAPIDO_M, "corrida"
+    else:
+        status = POSICOES.status(cooperado_id)[2]
+        na_fila = MEMBROS_FILA_ESPERA.contem(cooperado_id)
+        if na_fila or status == "ocioso":
+            rec = POSICOES.get(cooperado_id)
+            intervalo = PING_LENTO_SEC
+            if rec is None or not rec.conectado:
+                intervalo = min(intervalo, max(PING_NORMAL_SEC, OFFLINE_AFTER_SEC // 2))
+            metros, modo = PING_LENTO_M, "parado"
+        else:
+            intervalo, metros, modo = PING_NORMAL_SEC, PING_NORMAL_M, "livre"
+    return {"proximo_ping_s": intervalo, "deslocamento_min_m": metros, "modo_ping": modo}
 
 
 # =========================================================
-# HELPERS DE DATA / FUSO
+# TRAJETOS AUTOMÁTICOS (SEGMENTAÇÃO NO FLUXO DE PINGS)
 # =========================================================
-def to_brasilia(dt):
-    if not dt:
-        return None
-    if dt.tzinfo is None:
-        dt = pytz.utc.localize(dt)
-    return dt.astimezone(BRAZIL_TZ)
+# Abre um trajeto quando o cooperado começa a se mover (>= MOVING_SPEED_KMH),
+# acumula distância/duração ponto a ponto e fecha quando fica parado ou some.
+# O Trajeto é gravado UMA vez, no fechamento, já com as métricas prontas.
+TRAJETO_PARADO_FECHA_SEC = int(os.getenv("TRAJETO_PARADO_FECHA_SEC", "180"))  # parado 3 min => fecha
+TRAJETO_MIN_DIST_M = float(os.getenv("TRAJETO_MIN_DIST_M", "200"))            # menor que isso => descarta
+TRAJETO_MAX_PRECISAO_M = float(os.getenv("TRAJETO_MAX_PRECISAO_M", "100"))    # fix impreciso => ignora
+TRAJETO_MAX_VEL_KMH = float(os.getenv("TRAJETO_MAX_VEL_KMH", "160"))          # "salto" de GPS => ignora
+
+
+class TrajetoEmAberto:
+    __slots__ = (
+        "cooperado_id", "pontos", "velocidades", "distancia_m",
+        "ultimo_t", "ultimo_mov_t", "n_pontos_mov", "distancia_mov_m", "visto_em",
+    )
 
-from datetime import datetime, timezone
-import os
+    def __init__(self, cooperado_id, fix):
+        self.cooperado_id = cooperado_id
+        self.pontos = [(fix["lat"], fix["lng"], fix["t"])]
+        self.velocidades = [fix["v_kmh"]]
+        self.distancia_m = 0.0
+        self.ultimo_t = fix["t"]
+        self.ultimo_mov_t = fix["t"]
+        # "foto" do trajeto no último ponto em movimento (corta a cauda parada no fechamento)
+        self.n_pontos_mov = 1
+        self.distancia_mov_m = 0.0
+        self.visto_em = datetime.utcnow()  # relógio do servidor (o do aparelho pode estar torto)
+
+    def adicionar(self, fix, dist_m, em_movimento):
+        self.pontos.append((fix["lat"], fix["lng"], fix["t"]))
+        self.velocidades.append(fix["v_kmh"])
+        self.distancia_m += dist_m
+        self.ultimo_t = fix["t"]
+        self.visto_em = datetime.utcnow()
+        if em_movimento:
+            self.ultimo_mov_t = fix["t"]
+            self.n_pontos_mov = len(self.pontos)
+            self.distancia_mov_m = self.distancia_m
+
+    def inserir(self, fix):
+        """Fix atrasado que cai dentro do trajeto: entra na posição certa e as métricas são refeitas."""
+        ts = [p[2] for p in self.pontos]
+        i = bisect_left(ts, fix["t"])
+        if i < len(ts) and ts[i] == fix["t"]:
+            return  # duplicado
+        self.pontos.insert(i, (fix["lat"], fix["lng"], fix["t"]))
+        self.velocidades.insert(i, fix["v_kmh"])
+        self._recalcular()
+
+    def absorver(self, anterior):
+        """Junta na frente deste trajeto um trajeto recuperado que termina logo antes dele."""
+        self.pontos = anterior.pontos + self.pontos
+        self.velocidades = anterior.velocidades + self.velocidades
+        self._recalcular()
+
+    def _recalcular(self):
+        """Refaz distância/cauda parada do zero (mesmos filtros do fluxo ao vivo)."""
+        pontos, vels = [self.pontos[0]], [self.velocidades[0]]
+        dist = dist_mov = 0.0
+        n_mov, ultimo_mov_t = 1, self.pontos[0][2]
+        for p, v in zip(self.pontos[1:], self.velocidades[1:]):
+            gap = (p[2] - pontos[-1][2]).total_seconds()
+            if gap <= 0:
+                continue
+            d = haversine_m(pontos[-1][0], pontos[-1][1], p[0], p[1])
+            v_calc = d / gap * 3.6
+            if v_calc > TRAJETO_MAX_VEL_KMH:
+                continue
+            pontos.append(p)
+            vels.append(v)
+            dist += d
+            if (v if v is not None else v_calc) >= MOVING_SPEED_KMH:
+                n_mov, dist_mov, ultimo_mov_t = len(pontos), dist, p[2]
+        self.pontos, self.velocidades = pontos, vels
+        self.distancia_m, self.distancia_mov_m = dist, dist_mov
+        self.n_pontos_mov, self.ultimo_mov_t = n_mov, ultimo_mov_t
+        self.ultimo_t = pontos[-1][2]
+
+    def fechar(self):
+        """Retorna (pontos, distancia_m) sem a cauda parada."""
+        return self.pontos[:self.n_pontos_mov], self.distancia_mov_m
+
+
+class SegmentadorTrajetos:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._abertos = {}
+        self._visto_ate = {}  # cooperado_id -> horário (aparelho) do fix mais novo já processado
+
+    @staticmethod
+    def _passo(abertos, cooperado_id, fix, fechados):
+        """Um fix na máquina de estados (abre / acumula / fecha) de `abertos`."""
+        seg = abertos.get(cooperado_id)
+        gap = None
+        if seg is not None:
+            gap = (fix["t"] - seg.ultimo_t).total_seconds()
+            if gap <= 0:
+                return
+            if gap > OFFLINE_AFTER_SEC:
+                fechados.append(abertos.pop(cooperado_id))
+                seg = None
+
+        if fix["accuracy"] is not None and fix["accuracy"] > TRAJETO_MAX_PRECISAO_M:
+            return
 
-# -------------------------------------------------------------------
-# CONFIG DE TEMPOS (para NÃO dar NameError)
-# Ajuste os valores como quiser. Também aceita env vars no Render.
-# -------------------------------------------------------------------
-OFFLINE_AFTER_SEC = int(os.getenv("OFFLINE_AFTER_SEC", "120"))  # 2 min sem ping => offline
-IDLE_AFTER_SEC    = int(os.getenv("IDLE_AFTER_SEC", "300"))     # 5 min sem movimento => ocioso
-# Se velocidade >= isso, considera "em movimento"
-MOVING_SPEED_KMH = float(os.getenv("MOVING_SPEED_KMH", "3.0"))
+        if seg is None:
+            v = fix["v_kmh"]
+            if v is not None and v >= MOVING_SPEED_KMH:
+                abertos[cooperado_id] = TrajetoEmAberto(cooperado_id, fix)
+            return
 
+        lat0, lng0, _ = seg.pontos[-1]
+        dist = haversine_m(lat0, lng0, fix["lat"], fix["lng"])
+        v_calc = dist / gap * 3.6
+        if v_calc > TRAJETO_MAX_VEL_KMH:
+            return
 
-def _to_utc_aware(dt):
-    """
-    Garante datetime timezone-aware em UTC.
-    - None -> None
-    - naive -> assume que está em UTC e adiciona tzinfo
-    - aware -> converte para UTC
-    """
-    if dt is None:
-        return None
-    if dt.tzinfo is None:
-        return dt.replace(tzinfo=timezone.utc)
-    return dt.astimezone(timezone.utc)
+        v = fix["v_kmh"] if fix["v_kmh"] is not None else v_calc
+        seg.adicionar(fix, dist, v >= MOVING_SPEED_KMH)
 
+        if (seg.ultimo_t - seg.ultimo_mov_t).total_seconds() >= TRAJETO_PARADO_FECHA_SEC:
+            fechados.append(abertos.pop(cooperado_id))
 
-def calc_status_cooperado(c):
-    """
-    Retorna: (is_online, idle_seconds, status_str)
-    status_str: offline | ocioso | livre | em_corrida
-    """
-    # Agora é UTC-aware (não dá erro com TIMESTAMPTZ)
-    now_utc = datetime.now(timezone.utc)
+    def processar(self, cooperado_id: int, fixes: list) -> list:
+        """
+        Alimenta o segmentador com fixes JÁ ordenados por horário.
+        Fixes mais velhos que o último processado (lote offline que chegou depois)
+        não se perdem: os que caem dentro do trajeto aberto são inseridos nele; os
+        anteriores viram trajetos recuperados, segmentados à parte e fechados já
+        (o último é emendado no aberto se termina colado no início dele).
+        Retorna a lista de TrajetoEmAberto que fecharam neste lote.
+        """
+        fechados = []
+        with self._lock:
+            visto = self._visto_ate.get(cooperado_id)
+            atrasados = [f for f in fixes if visto is not None and f["t"] <= visto]
+            novos = [f for f in fixes if visto is None or f["t"] > visto]
+
+            if atrasados:
+                seg = self._abertos.get(cooperado_id)
+                recuperar = []
+                for fix in atrasados:
+                    if seg is not None and fix["t"] > seg.pontos[0][2]:
+                        if fix["accuracy"] is None or fix["accuracy"] <= TRAJETO_MAX_PRECISAO_M:
+                            seg.inserir(fix)
+                    else:
+                        recuperar.append(fix)
+                if recuperar:
+                    abertos_tmp = {}
+                    for fix in recuperar:
+                        self._passo(abertos_tmp, cooperado_id, fix, fechados)
+                    resto = abertos_tmp.pop(cooperado_id, None)
+                    if resto is not None:
+                        if seg is not None and (seg.pontos[0][2] - resto.ultimo_t).total_seconds() <= OFFLINE_AFTER_SEC:
+                            seg.absorver(resto)
+                        else:
+                            fechados.append(resto)
+
+            for fix in novos:
+                self._passo(self._abertos, cooperado_id, fix, fechados)
+            if novos:
+                self._visto_ate[cooperado_id] = novos[-1]["t"]
+        return fechados
+
+    def fechar_inativos(self, agora_utc=None, todos=False) -> list:
+        """Fecha trajetos de quem parou de mandar ping (offline) ou está parado há muito tempo."""
+        agora_utc = agora_utc or datetime.utcnow()
+        fechados = []
+        with self._lock:
+            for cid, seg in list(self._abertos.items()):
+                # idades pelo relógio do servidor + intervalos pelo relógio do aparelho
+                sem_ping = (agora_utc - seg.visto_em).total_seconds()
+                parado = sem_ping + (seg.ultimo_t - seg.ultimo_mov_t).total_seconds()
+                if todos or sem_ping > OFFLINE_AFTER_SEC or parado >= TRAJETO_PARADO_FECHA_SEC:
+                    fechados.append(self._abertos.pop(cid))
+        return fechados
+
+    def fechar_cooperado(self, cooperado_id: int) -> list:
+        with self._lock:
+            seg = self._abertos.pop(cooperado_id, None)
+        return [seg] if seg is not None else []
+
+
+SEGMENTADOR = SegmentadorTrajetos()
+
+
+def gravar_trajetos(fechados: list, commit=True) -> list:
+    """Grava os trajetos fechados (métricas já acumuladas); descarta os curtos demais."""
+    novos = []
+    for seg in fechados:
+        pontos, distancia = seg.fechar()
+        if len(pontos) < 2 or distancia < TRAJETO_MIN_DIST_M:
+            continue
+        inicio = pontos[0][2]
+        fim = pontos[-1][2]
+        duracao = int((fim - inicio).total_seconds())
+        if duracao <= 0:
+            continue
 
-    last_ping = _to_utc_aware(getattr(c, "last_ping", None))
-    last_moving_at = _to_utc_aware(getattr(c, "last_moving_at", None))
+        traj = Trajeto(
+            cooperado_id=seg.cooperado_id,
+            inicio=inicio,
+            fim=fim,
+            distancia_m=distancia,
+            duracao_s=duracao,
+            velocidade_media_kmh=(distancia / 1000.0) / (duracao / 3600.0),
+            origem_lat=pontos[0][0],
+            origem_lng=pontos[0][1],
+            destino_lat=pontos[-1][0],
+            destino_lng=pontos[-1][1],
+        )
+        traj.set_pontos(pontos)
+        traj.consolidado = True
+        db.session.add(traj)
+        novos.append(traj)
+
+    if novos:
+        # Resumo diário incremental: soma já no fechamento, na mesma transação
+        totais = defaultdict(lambda: [0, 0.0, 0])
+        for t in novos:
+            acc = totais[(t.cooperado_id, dia_local_trajeto(t.inicio))]
+            acc[0] += 1
+            acc[1] += t.distancia_m
+            acc[2] += t.duracao_s
+        try:
+            with db.session.begin_nested():
+                somar_resumo_diario(totais)
+        except IntegrityError:
+            # corrida no INSERT do dia: fica pendente e o worker de retenção consolida
+            for t in novos:
+                t.consolidado = False
 
-    # ONLINE “REAL” = ping recente
-    is_online = bool(getattr(c, "online", False)) and (last_ping is not None)
-    if is_online:
-        delta = (now_utc - last_ping).total_seconds()
-        if delta > OFFLINE_AFTER_SEC:
-            is_online = False
+    if novos and commit:
+        db.session.commit()
+    return novos
 
-    if not is_online:
-        return (False, None, "offline")
 
-    # Ocioso = online, mas sem movimento por tempo
-    if last_moving_at:
-        idle_seconds = int((now_utc - last_moving_at).total_seconds())
-    else:
-        # se nunca marcou movimento, usa last_ping como referência
-        idle_seconds = int((now_utc - last_ping).total_seconds()) if last_ping else 0
+def _fechar_trajetos_seguro(todos=False):
+    with app.app_context():
+        try:
+            gravar_trajetos(SEGMENTADOR.fechar_inativos(todos=todos))
+        except Exception as e:
+            db.session.rollback()
+            app.logger.warning(f"Falha ao gravar trajetos: {e}")
+        finally:
+            db.session.remove()
 
-    # Se você tem “em_corrida/ocupado” no cooperado, priorize isso:
-    em_corrida = bool(getattr(c, "em_corrida", False) or getattr(c, "ocupado", False))
-    if em_corrida:
-        return (True, idle_seconds, "em_corrida")
 
-    if idle_seconds >= IDLE_AFTER_SEC:
-        return (True, idle_seconds, "ocioso")
+def _loop_trajetos():
+    while True:
+        socketio.sleep(POSICAO_FLUSH_SEC)
+        _fechar_trajetos_seguro()
 
-    return (True, idle_seconds, "livre")
+
+def iniciar_segmentador_trajetos():
+    socketio.start_background_task(_loop_trajetos)
+    atexit.register(_fechar_trajetos_seguro, todos=True)
 
 
 def local_date_window_to_utc_range(local_date: date):
@@ -913,6 +3887,133 @@ app.jinja_env.filters['diasemana'] = diasemana
 app.jinja_env.globals['tem_comprovante'] = comprovante_existe
 app.jinja_env.globals['token_rastreio'] = gerar_token_rastreio
 
+
+# =========================================================
+# RETENÇÃO + RESUMO DIÁRIO DE TRAJETOS (WORKER)
+# =========================================================
+# Trajeto bruto fica TRAJETO_RETENCAO_DIAS no banco. Antes de apagar, ele é
+# somado em TrajetoResumoDiario (e marcado consolidado=True), então os totais
+# antigos continuam disponíveis. Trajetos novos já são somados no fechamento
+# (gravar_trajetos); aqui sobram os legados e os que perderam corrida no INSERT.
+# Tudo em lotes pequenos, fora da requisição.
+TRAJETO_RETENCAO_DIAS = int(os.getenv("TRAJETO_RETENCAO_DIAS", "31"))
+TRAJETO_RETENCAO_INTERVALO_SEC = int(os.getenv("TRAJETO_RETENCAO_INTERVALO_SEC", "3600"))
+TRAJETO_RETENCAO_LOTE = int(os.getenv("TRAJETO_RETENCAO_LOTE", "500"))
+
+
+def dia_local_trajeto(inicio_utc) -> date:
+    """Dia (Brasília) ao qual o trajeto pertence: o do início."""
+    return to_brasilia(inicio_utc).date()
+
+
+def somar_resumo_diario(totais: dict):
+    """
+    totais: {(cooperado_id, dia): (n_trajetos, distancia_m, duracao_s)}.
+    Soma na sessão atual (sem commit): UPDATE incremental e, se o dia ainda
+    não existe, INSERT. Corrida no INSERT estoura IntegrityError (unique).
+    """
+    tab = TrajetoResumoDiario.__table__
+    agora = datetime.utcnow()
+    for (cid, dia), (n, dist, dur) in totais.items():
+        r = db.session.execute(
+            tab.update()
+            .where(tab.c.cooperado_id == cid, tab.c.dia == dia)
+            .values(
+                n_trajetos=tab.c.n_trajetos + n,
+                distancia_m=tab.c.distancia_m + dist,
+                duracao_s=tab.c.duracao_s + dur,
+                atualizado_em=agora,
+            )
+        )
+        if r.rowcount == 0:
+            db.session.execute(
+                tab.insert().values(
+                    cooperado_id=cid, dia=dia, n_trajetos=n,
+                    distancia_m=dist, duracao_s=dur, atualizado_em=agora,
+                )
+            )
+
+
+def consolidar_trajetos_pendentes(lote: int = TRAJETO_RETENCAO_LOTE) -> int:
+    """Soma no resumo diário um lote de trajetos não consolidados (sem commit)."""
+    pend = (
+        db.session.query(Trajeto.id, Trajeto.cooperado_id, Trajeto.inicio,
+                         Trajeto.distancia_m, Trajeto.duracao_s)
+        .filter(Trajeto.consolidado == False)
+        .order_by(Trajeto.id)
+        .limit(lote)
+        .all()
+    )
+    if not pend:
+        return 0
+
+    totais = defaultdict(lambda: [0, 0.0, 0])
+    for _id, cid, inicio, dist, dur in pend:
+        t = totais[(cid, dia_local_trajeto(inicio))]
+        t[0] += 1
+        t[1] += float(dist or 0.0)
+        t[2] += int(dur or 0)
+
+    ids = [p[0] for p in pend]
+    tab = Trajeto.__table__
+    r = db.session.execute(
+        tab.update()
+        .where(tab.c.id.in_(ids), tab.c.consolidado == False)
+        .values(consolidado=True)
+    )
+    if r.rowcount != len(ids):
+        # alguém consolidou parte do lote ao mesmo tempo: desfaz e tenta na próxima rodada
+        db.session.rollback()
+        return 0
+
+    somar_resumo_diario(totais)
+    return len(ids)
+
+
+def apagar_trajetos_antigos(lote: int = TRAJETO_RETENCAO_LOTE) -> int:
+    """Apaga (sem commit) um lote de trajetos JÁ consolidados e mais velhos que a retenção."""
+    limite = datetime.utcnow() - timedelta(days=TRAJETO_RETENCAO_DIAS)
+    ids = [
+        i for (i,) in
+        db.session.query(Trajeto.id)
+        .filter(Trajeto.consolidado == True, Trajeto.inicio < limite)
+        .limit(lote)
+        .all()
+    ]
+    if ids:
+        Trajeto.query.filter(Trajeto.id.in_(ids)).delete(synchronize_session=False)
+    return len(ids)
+
+
+def rodar_retencao_trajetos():
+    """Uma rodada completa: consolida tudo que está pendente e depois apaga o que venceu."""
+    with app.app_context():
+        try:
+            for etapa in (consolidar_trajetos_pendentes, apagar_trajetos_antigos):
+                while True:
+                    n = etapa()
+                    db.session.commit()
+                    if n < TRAJETO_RETENCAO_LOTE:
+                        break
+                    socketio.sleep(0.05)  # respira entre lotes
+        except Exception as e:
+            db.session.rollback()
+            app.logger.warning(f"Falha na retenção de trajetos: {e}")
+        finally:
+            db.session.remove()
+
+
+def _loop_retencao_trajetos():
+    socketio.sleep(60)  # não disputa o banco com o boot
+    while True:
+        if e_lider("retencao_trajetos", TRAJETO_RETENCAO_INTERVALO_SEC):
+            rodar_retencao_trajetos()
+        socketio.sleep(TRAJETO_RETENCAO_INTERVALO_SEC)
+
+
+def iniciar_retencao_trajetos():
+    socketio.start_background_task(_loop_retencao_trajetos)
+
 # =========================================================
 # RASTREAMENTO - HELPER DE LINHA DO TEMPO
 # =========================================================
@@ -955,6 +4056,22 @@ def montar_eventos_rastreamento(entrega: Entrega):
             "icone": "🚚"
         })
 
+    # 3b) Chegadas detectadas pela cerca nos pings do motoboy
+    if entrega.chegada_coleta_em:
+        eventos.append({
+            "titulo": "Motoboy chegou na coleta",
+            "descricao": "Detectado pela localização do motoboy.",
+            "quando": to_brasilia(entrega.chegada_coleta_em),
+            "icone": "📍"
+        })
+    if entrega.chegada_destino_em:
+        eventos.append({
+            "titulo": "Motoboy chegou no destino",
+            "descricao": "Detectado pela localização do motoboy.",
+            "quando": to_brasilia(entrega.chegada_destino_em),
+            "icone": "🏁"
+        })
+
     # 4) Entrega concluída
     if st in ('entregue', 'recebido'):
         eventos.append({
@@ -1759,7 +4876,10 @@ def logout():
         coop = Cooperado.query.get(uid)
         if coop:
             coop.online = False
+            coop.presenca = "offline"
             db.session.commit()
+        POSICOES.marcar_offline(uid)
+        gravar_trajetos(SEGMENTADOR.fechar_cooperado(uid))
 
     session.clear()
     return redirect(url_for('login'))
@@ -2271,8 +5391,11 @@ def api_cliente_solicitar_entrega():
             "lat": entrega_dest.get('lat'),
             "lng": entrega_dest.get('lng'),
         }
+        # paradas intermediárias na melhor ordem entre coleta e entrega
+        rota = otimizar_paradas(origem_json_dict, destino_json_dict, paradas_lista)
         paradas_json_dict = {
-            "stops": paradas_lista
+            "stops": rota["paradas"],
+            "rota": resumo_rota(rota),
         }
 
         # Campos da Entrega compatíveis com o seu model atual
@@ -2327,6 +5450,10 @@ def api_cliente_solicitar_entrega():
         'meio_pagamento': meio_pagamento,
         'status_pagamento': entrega_obj.status_pagamento,
         'comprovante_url': url_for('cliente_comprovante', entrega_id=entrega_obj.id),
+        'rota': {
+            'km_estimado': rota['km_estimado'],
+            'ordem_paradas': rota['ordem'],
+        },
     })
 
 
@@ -2708,6 +5835,7 @@ def api_rastreamento(codigo):
         "data_atribuida": _dt(entrega.data_atribuida),
         "origem_extra": origem_extra,
         "destino_extra": destino_extra,
+        "eta": ETAS.estimar(entrega) if (entrega.status or '').strip().lower() not in STATUS_CONCLUIDOS else None,
         "eventos": [
             {
                 "titulo": ev["titulo"],
@@ -2822,19 +5950,20 @@ def admin():
 
     motoboys_js = []
     for c in cooperados:
-        if getattr(c, "last_lat", None) is not None and getattr(c, "last_lng", None) is not None:
-            is_online, idle_s, status_str = calc_status_cooperado(c)
+        p = POSICOES.de(c)
+        if getattr(p, "last_lat", None) is not None and getattr(p, "last_lng", None) is not None:
+            is_online, idle_s, status_str = status_mantido(p)
 
             motoboys_js.append({
                 "id": c.id,
                 "nome": c.nome,
-                "lat": c.last_lat,
-                "lng": c.last_lng,
+                "lat": p.last_lat,
+                "lng": p.last_lng,
                 "online": bool(is_online),
                 "status": status_str,
                 "idle_seconds": idle_s,
-                "velocidade": float(getattr(c, "last_speed_kmh", 0) or 0),
-                "ultima_atualizacao": to_brasilia(c.last_ping).strftime('%d/%m %H:%M') if c.last_ping else ""
+                "velocidade": float(getattr(p, "last_speed_kmh", 0) or 0),
+                "ultima_atualizacao": to_brasilia(p.last_ping).strftime('%d/%m %H:%M') if p.last_ping else ""
             })
 
     return render_template(
@@ -2859,27 +5988,17 @@ def admin():
 
 @app.route("/admin_novo_socorro")
 def admin_novo_socorro():
-    """Rota que o admin consulta (polling) para saber se há socorros pendentes.
+    """Socorro pendente mais recente (o painel consulta ao abrir/reconectar; o resto chega por socket).
     Importante: **não** marca como lido aqui. Só marca quando o admin clicar no X.
     """
     if not session.get("is_admin") and not session.get("is_master"):
         abort(403)
 
-    global SOCORRO_QUEUE
-
-    pendentes = [s for s in (SOCORRO_QUEUE or []) if not s.get("lido")]
-    if not pendentes:
+    ultimo = socorros_pendentes().order_by(Socorro.id.desc()).first()
+    if ultimo is None:
         return jsonify({"novo": False, "count": 0}), 200
 
-    ultimo = pendentes[-1]
-    return jsonify({
-        "novo": True,
-        "count": len(pendentes),
-        "id": ultimo.get("id"),
-        "cooperado": ultimo.get("cooperado_nome"),
-        "mensagem": ultimo.get("mensagem") or "",
-        "momento": ultimo.get("momento"),
-    }), 200
+    return jsonify({"novo": True, **payload_socorro(ultimo, socorros_pendentes().count())}), 200
 
 
 
@@ -2889,8 +6008,6 @@ def admin_socorro_marcar_lido():
     if not session.get("is_admin") and not session.get("is_master"):
         abort(403)
 
-    global SOCORRO_QUEUE
-
     data = request.get_json(silent=True) or {}
     sid = data.get("id")
     try:
@@ -2898,18 +6015,20 @@ def admin_socorro_marcar_lido():
     except Exception:
         return jsonify(ok=False, error="id inválido"), 400
 
-    found = False
-    for s in SOCORRO_QUEUE:
-        if int(s.get("id") or 0) == sid_int:
-            s["lido"] = True
-            found = True
-            break
-
-    if not found:
+    item = db.session.get(Socorro, sid_int)
+    if item is None:
         return jsonify(ok=False, error="socorro não encontrado"), 404
+    if not item.lido:
+        item.lido = True
+        item.lido_em = datetime.utcnow()
+        item.lido_por = session.get("user_nome") or ("master" if session.get("is_master") else "admin")
+        db.session.flush()
 
-    pendentes = [s for s in (SOCORRO_QUEUE or []) if not s.get("lido")]
-    return jsonify(ok=True, count=len(pendentes))
+    count = socorros_pendentes().count()
+    # todas as abas de admin fecham o alerta (ou passam ao próximo pendente)
+    enfileirar_emissao("socorro_lido", {"id": sid_int, "count": count}, [{"to": "admins"}])
+    db.session.commit()
+    return jsonify(ok=True, count=count)
 
 # =========================================================
 # ADMIN — visualizar / baixar comprovante (foto) da entrega
@@ -3121,48 +6240,7 @@ def cooperado_verificar_nova_entrega():
     if not entrega:
         return jsonify({"tem_entrega": False})
 
-    # Usa os helpers do model Entrega para pegar origem/destino:
-    origem = entrega.get_origem() or {}
-    destino = entrega.get_destino() or {}
-
-    origem_endereco = (
-        origem.get('endereco')
-        or origem.get('address')
-        or origem.get('bairro')
-        or None
-    )
-    origem_bairro = origem.get('bairro') or None
-
-    destino_endereco = (
-        destino.get('endereco')
-        or destino.get('address')
-        or destino.get('bairro')
-        or entrega.bairro
-    )
-    destino_bairro = destino.get('bairro') or entrega.bairro
-
-    payload = {
-        "id": entrega.id,
-        "cliente": entrega.cliente,
-        "valor": float(entrega.valor or 0),
-
-        "origem_endereco": origem_endereco,
-        "origem_bairro": origem_bairro,
-
-        "destino_endereco": destino_endereco,
-        "destino_bairro": destino_bairro,
-
-        "lat_origem": origem.get('lat'),
-        "lng_origem": origem.get('lng'),
-        "lat_destino": destino.get('lat'),
-        "lng_destino": destino.get('lng'),
-
-        "tempo_estimado": "aprox.",
-        "distancia": 0,
-        "status_pagamento": (entrega.status_pagamento or "").lower(),
-        "data_entrega": entrega.data_envio.strftime("%Y-%m-%d") if entrega.data_envio else None,
-        "recebida_por": entrega.recebido_por or "",
-    }
+    payload = payload_corrida_cooperado(entrega)
 
     return jsonify({"tem_entrega": True, "entrega": payload})
 
@@ -3195,24 +6273,53 @@ def cooperado_aceitar_entrega():
     except ValueError:
         return jsonify({"status": "erro", "msg": "id de entrega inválido"}), 400
 
+    # Aceite atômico: um único UPDATE condicional. Se dois motoboys tocarem
+    # "aceitar" ao mesmo tempo, só um deles encontra a linha ainda disponível.
+    esperada = versao_esperada(dados)
+    consulta = Entrega.query.filter(
+        Entrega.id == entrega_id,
+        (Entrega.cooperado_id.is_(None)) | (Entrega.cooperado_id == cooperado_id),
+        Entrega.status_corrida.in_(['pendente']),
+    )
+    if esperada is not None:
+        consulta = consulta.filter(Entrega.versao == esperada)
+    aceitou = consulta.update({
+        "cooperado_id": cooperado_id,
+        "status": "em_andamento",   # usa o mesmo campo que você já usa no sistema
+        "status_corrida": "aceita",
+        "data_atribuida": datetime.utcnow(),
+        "versao": Entrega.versao + 1,
+    }, synchronize_session=False)
+    db.session.commit()
+
     entrega = Entrega.query.get(entrega_id)
     if not entrega:
         return jsonify({"status": "erro", "msg": "Entrega não encontrada."}), 404
 
-    # Se já tiver cooperado diferente, não deixa "roubar"
-    if entrega.cooperado_id and entrega.cooperado_id != cooperado_id:
-        return jsonify({
-            "status": "erro",
-            "msg": "Essa entrega já foi aceita por outro motoboy."
-        }), 409
+    if not aceitou and versao_conflita(entrega, esperada) and entrega.status_corrida == "pendente" \
+            and entrega.cooperado_id in (None, cooperado_id):
+        # oferta mudou desde que o motoboy a viu (ex.: valor editado): mostra a atual
+        return resposta_conflito(entrega.id)
 
-    # Marca entrega como atribuída para esse cooperado
-    entrega.cooperado_id = cooperado_id
-    entrega.status = "em_andamento"   # usa o mesmo campo que você já usa no sistema
-    entrega.status_corrida = "aceita"
-    entrega.data_atribuida = datetime.utcnow()
+    if not aceitou:
+        # Se já tiver cooperado diferente, não deixa "roubar"
+        if entrega.cooperado_id and entrega.cooperado_id != cooperado_id:
+            return jsonify({
+                "status": "erro",
+                "msg": "Essa entrega já foi aceita por outro motoboy."
+            }), 409
+        if entrega.status_corrida != "aceita":
+            return jsonify({
+                "status": "erro",
+                "msg": "Essa entrega não está mais disponível."
+            }), 409
+        # toque repetido do mesmo motoboy: já é dele, responde como aceite
 
-    db.session.commit()
+    cancelar_expiracao_oferta(entrega.id)
+    if aceitou:
+        # nova versão: a linha do painel precisa dela para a próxima edição
+        emitir_atualizacao_entrega(entrega, "aceita")
+    CERCAS.invalidar(cooperado_id)
 
     entrega_json = {
         "id": entrega.id,
@@ -3231,6 +6338,7 @@ def cooperado_aceitar_entrega():
         "tempo_estimado": None,
         "status_pagamento": getattr(entrega, "status_pagamento", "pendente"),
         "recebida_por": getattr(entrega, "recebido_por", None),
+        "versao": entrega.versao,
         "data": (
             entrega.data_envio.date().isoformat()
             if getattr(entrega, "data_envio", None) else None
@@ -3261,14 +6369,28 @@ def cooperado_recusar_entrega():
         # se quiser permitir recusa mesmo antes de atribuir, pode tirar esse if
         return jsonify(status="erro", msg="Entrega não pertence a este cooperado"), 403
 
-    # volta pra fila do admin
+    if versao_conflita(entrega, versao_esperada(data)):
+        return resposta_conflito(entrega.id)
+
+    # volta pra fila do admin (o despacho automático não reoferece a quem recusou)
+    DESPACHANTE.registrar_recusa(entrega.id, user_id)
     entrega.cooperado_id = None
     if hasattr(entrega, "status_entrega"):
         entrega.status_entrega = "pendente"
     if hasattr(entrega, "hora_atribuida"):
         entrega.hora_atribuida = None
 
-    db.session.commit()
+    conflito = commit_ou_conflito(entrega)
+    if conflito:
+        return conflito
+    cancelar_expiracao_oferta(entrega.id)
+    # a recusa já está gravada: falha ao reoferecer não pode virar erro para o app
+    entrega_id = entrega.id
+    try:
+        reoferecer_entrega(entrega, user_id)
+    except Exception as e:
+        db.session.rollback()
+        app.logger.warning(f"Falha ao reoferecer a entrega {entrega_id} após recusa: {e}")
     return jsonify(status="ok")
 
 @app.route("/cooperado/finalizar_entrega", methods=["POST"])
@@ -3294,6 +6416,9 @@ def cooperado_finalizar_entrega():
     if entrega.cooperado_id != user_id:
         return jsonify(status="erro", msg="Entrega não pertence a este cooperado"), 403
 
+    if versao_conflita(entrega, versao_esperada(data)):
+        return resposta_conflito(entrega.id)
+
     # 👉 aqui NÃO tem checagem de localização, pode finalizar de qualquer lugar
     entrega.recebida_por = recebida_por
 
@@ -3305,7 +6430,10 @@ def cooperado_finalizar_entrega():
         entrega.hora_finalizada = datetime.utcnow()
 
     # status_pagamento continua pendente, motoboy marca depois
-    db.session.commit()
+    conflito = commit_ou_conflito(entrega)
+    if conflito:
+        return conflito
+    emitir_atualizacao_entrega(entrega, "finalizada")
 
     entrega_dict = {
       "id": entrega.id,
@@ -3319,6 +6447,7 @@ def cooperado_finalizar_entrega():
       "data": getattr(entrega, "data_entrega", None) or "",
       "recebida_por": entrega.recebida_por,
       "status_pagamento": getattr(entrega, "status_pagamento", "pendente"),
+      "versao": entrega.versao,
     }
 
     return jsonify(status="ok", entrega=entrega_dict)
@@ -3337,81 +6466,108 @@ def cooperado_aceitar_corrida():
     if not entrega_id:
         return jsonify(ok=False, error='entrega_id obrigatório'), 400
 
+    # mesmo UPDATE condicional do aceite por id (sem janela entre checar e gravar)
+    esperada = versao_esperada(data)
+    consulta = Entrega.query.filter(
+        Entrega.id == entrega_id,
+        Entrega.cooperado_id == user_id,
+        Entrega.status_corrida.in_(['pendente']),
+    )
+    if esperada is not None:
+        consulta = consulta.filter(Entrega.versao == esperada)
+    aceitou = consulta.update({
+        "status_corrida": "aceita",
+        "data_atribuida": func.coalesce(Entrega.data_atribuida, datetime.utcnow()),
+        "versao": Entrega.versao + 1,
+    }, synchronize_session=False)
+    db.session.commit()
+
     entrega = Entrega.query.get_or_404(entrega_id)
 
     if entrega.cooperado_id != user_id:
         return jsonify(ok=False, error='Entrega não pertence a este cooperado'), 403
+    if not aceitou and entrega.status_corrida != 'aceita':
+        if versao_conflita(entrega, esperada) and entrega.status_corrida == 'pendente':
+            return resposta_conflito(entrega.id)
+        return jsonify(ok=False, error='Entrega não está mais disponível'), 409
 
-    entrega.status_corrida = 'aceita'
-    if not entrega.data_atribuida:
-        entrega.data_atribuida = datetime.now(BRAZIL_TZ)
-
-    db.session.commit()
-    return jsonify(ok=True, status_corrida=entrega.status_corrida)
+    cancelar_expiracao_oferta(entrega.id)
+    if aceitou:
+        emitir_atualizacao_entrega(entrega, "aceita")
+    CERCAS.invalidar(user_id)
+    return jsonify(ok=True, status_corrida=entrega.status_corrida, versao=entrega.versao)
 
 @app.route('/cooperado/atualizar_localizacao', methods=['POST'])
 def cooperado_atualizar_localizacao():
     if session.get('user_id') is None or session.get('is_admin'):
         return jsonify({'status': 'erro', 'msg': 'Não autorizado'}), 403
 
-    cooperado_id = session['user_id']
-    cooperado = Cooperado.query.get(cooperado_id)
+    cooperado_id = session['user_id']
+    cooperado = Cooperado.query.get(cooperado_id)
+    if not cooperado:
+        return jsonify({'status': 'erro', 'msg': 'Cooperado não encontrado'}), 404
+
+    data = request.get_json(silent=True) or {}
+
+    # lat/lng obrigatórios; speed pode vir em m/s (speed_mps) OU km/h (velocidade)
+    fix = normalizar_fix(data)
+    if fix is None:
+        return jsonify({'status': 'erro', 'msg': 'Lat/Lng inválidos'}), 400
+
+    # atualiza a posição ao vivo (o banco é gravado pelo flush periódico);
+    # fix mais velho que o atual só vai para o trajeto
+    aplicado = POSICOES.atualizar(cooperado, fix)
+    gravar_trajetos(SEGMENTADOR.processar(cooperado.id, [fix]))
+    registrar_chegadas(cooperado.id, [fix])
+
+    # emite para o painel em tempo real (adicione campos no payload, item 4)
+    if aplicado:
+        emitir_posicao_motoboy(cooperado, fix['lat'], fix['lng'], fix['v_kmh'])
+
+    return jsonify({'status': 'ok', **intervalo_ping(cooperado.id)})
+
+
+@app.route('/cooperado/atualizar_localizacao/lote', methods=['POST'])
+def cooperado_atualizar_localizacao_lote():
+    """
+    Mesmo que /cooperado/atualizar_localizacao, mas recebe vários fixes de uma vez
+    (ex.: pontos guardados enquanto o aparelho estava sem internet).
+
+    JSON esperado:
+    {
+      "fixes": [
+        {"lat": -5.79, "lng": -35.21, "speed_mps": 8.3, "heading": 90,
+         "accuracy": 12, "t": 1718000000000},
+        ...
+      ]
+    }
+    """
+    if session.get('user_id') is None or session.get('is_admin'):
+        return jsonify({'status': 'erro', 'msg': 'Não autorizado'}), 403
+
+    cooperado = Cooperado.query.get(session['user_id'])
     if not cooperado:
         return jsonify({'status': 'erro', 'msg': 'Cooperado não encontrado'}), 404
 
     data = request.get_json(silent=True) or {}
+    itens = data.get('fixes')
+    if not isinstance(itens, list) or not itens:
+        return jsonify({'status': 'erro', 'msg': 'Lista de fixes vazia'}), 400
+    if len(itens) > PING_LOTE_MAX:
+        return jsonify({'status': 'erro', 'msg': f'Máximo de {PING_LOTE_MAX} fixes por lote'}), 413
 
-    # lat/lng obrigatórios
-    try:
-        lat = float(data.get('lat'))
-        lng = float(data.get('lng'))
-    except (TypeError, ValueError):
-        return jsonify({'status': 'erro', 'msg': 'Lat/Lng inválidos'}), 400
-
-    # speed pode vir em m/s (Geolocation API) OU km/h (se você mandar assim)
-    speed_mps = data.get('speed_mps', None)
-    speed_kmh = data.get('velocidade', None)  # compatível com seu campo atual
-
-    # heading/accuracy opcionais
-    heading = data.get('heading', None)
-    accuracy = data.get('accuracy', None)
-
-    # normaliza velocidade
-    v_kmh = None
-    try:
-        if speed_mps is not None:
-            v_kmh = float(speed_mps) * 3.6
-        elif speed_kmh is not None:
-            v_kmh = float(speed_kmh)
-    except (TypeError, ValueError):
-        v_kmh = None
-
-    # salva no banco
-    cooperado.last_lat = lat
-    cooperado.last_lng = lng
-    cooperado.last_ping = datetime.utcnow()
-    cooperado.online = True
-
-    cooperado.last_speed_kmh = v_kmh
-    try:
-        cooperado.last_heading = float(heading) if heading is not None else None
-    except (TypeError, ValueError):
-        cooperado.last_heading = None
-    try:
-        cooperado.last_accuracy_m = float(accuracy) if accuracy is not None else None
-    except (TypeError, ValueError):
-        cooperado.last_accuracy_m = None
-
-    # marca “último movimento”
-    if v_kmh is not None and v_kmh >= MOVING_SPEED_KMH:
-        cooperado.last_moving_at = datetime.utcnow()
+    aceitos, descartados, aplicado = processar_lote_pings(cooperado, itens)
 
-    db.session.commit()
-
-    # emite para o painel em tempo real (adicione campos no payload, item 4)
-    emitir_posicao_motoboy(cooperado, lat, lng, v_kmh)
+    if aplicado:
+        emitir_posicao_motoboy(cooperado, aplicado['lat'], aplicado['lng'], aplicado['v_kmh'])
 
-    return jsonify({'status': 'ok'})
+    return jsonify({
+        'status': 'ok',
+        'aceitos': aceitos,
+        'descartados': descartados,
+        'posicao_atualizada': bool(aplicado),
+        **intervalo_ping(cooperado.id),
+    })
 
 
 # Recusar via API (AJAX/Fetch com JSON)
@@ -3432,9 +6588,23 @@ def cooperado_recusar_corrida():
     if entrega.cooperado_id != user_id:
         return jsonify(ok=False, error='Entrega não pertence a este cooperado'), 403
 
+    if versao_conflita(entrega, versao_esperada(data)):
+        return resposta_conflito(entrega.id)
+
     entrega.status_corrida = 'recusada'
-    db.session.commit()
-    return jsonify(ok=True, status_corrida=entrega.status_corrida)
+    DESPACHANTE.registrar_recusa(entrega.id, user_id)
+    conflito = commit_ou_conflito(entrega)
+    if conflito:
+        return conflito
+    cancelar_expiracao_oferta(entrega.id)
+    # a recusa já está gravada: falha ao reoferecer não pode virar erro para o app
+    entrega_id = entrega.id
+    try:
+        reoferecer_entrega(entrega, user_id)
+    except Exception as e:
+        db.session.rollback()
+        app.logger.warning(f"Falha ao reoferecer a entrega {entrega_id} após recusa: {e}")
+    return jsonify(ok=True, status_corrida='recusada')
 
 
 @app.route('/cooperado/api/novas', methods=['GET'])
@@ -3550,17 +6720,88 @@ def api_mobile_cooperado_corridas():
 
     return jsonify(ok=True, corridas=corridas)
 
-# variável global bem simples pra sinalizar um novo socorro
-SOCORRO_QUEUE = []
-NEXT_SOCORRO_ID = 1
+# =========================================================
+# SOCORRO (PERSISTIDO + PUSH PARA A SALA admins)
+# =========================================================
+SOCORRO_LIMITE_POR_MIN = int(os.getenv("SOCORRO_LIMITE_POR_MIN", "5"))
+# quem pode ajudar: k cooperados online mais perto de quem pediu (qualquer status menos offline)
+SOCORRO_VIZINHOS_K = int(os.getenv("SOCORRO_VIZINHOS_K", "5"))
+SOCORRO_VIZINHOS_RAIO_M = float(os.getenv("SOCORRO_VIZINHOS_RAIO_M", "15000"))
+SOCORRO_VIZINHOS_STATUS = ("livre", "ocioso", "em_corrida")
+
+
+class Socorro(db.Model):
+    __tablename__ = 'socorro'
+
+    id = db.Column(db.Integer, primary_key=True)
+    cooperado_id = db.Column(db.Integer, db.ForeignKey('cooperado.id', ondelete='SET NULL'), nullable=True)
+    cooperado_nome = db.Column(db.String(100), nullable=True)
+    mensagem = db.Column(db.String(500), nullable=False)
+    criado_em = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    # posição ao vivo do cooperado no momento do alerta (se houver)
+    lat = db.Column(db.Float, nullable=True)
+    lng = db.Column(db.Float, nullable=True)
+    posicao_em = db.Column(db.DateTime, nullable=True)
+
+    # vizinhos calculados na hora do alerta (lista de dicts, ver socorristas_proximos)
+    proximos_json = db.Column(db.Text, nullable=True)
+
+    lido = db.Column(db.Boolean, nullable=False, default=False)
+    lido_em = db.Column(db.DateTime, nullable=True)
+    lido_por = db.Column(db.String(80), nullable=True)
+
+    __table_args__ = (
+        # o painel só pergunta pelos não lidos (contagem + o mais recente)
+        db.Index("ix_socorro_lido_id", "lido", "id"),
+    )
+
+
+def socorros_pendentes():
+    return Socorro.query.filter(Socorro.lido.is_(False))
+
+
+def socorristas_proximos(lat, lng, excluir=()) -> list:
+    """Cooperados online mais perto de (lat, lng), pela grade ao vivo, com distância e status."""
+    proximos = []
+    for dist, cid in motoboys_proximos(lat, lng, k=SOCORRO_VIZINHOS_K, raio_m=SOCORRO_VIZINHOS_RAIO_M,
+                                       status=SOCORRO_VIZINHOS_STATUS, excluir=excluir):
+        pos = POSICOES.get(cid)
+        if pos is None:
+            continue
+        _, idle_s, status = status_mantido(pos)
+        proximos.append({
+            "cooperado_id": cid,
+            "nome": pos.nome,
+            "distancia_m": int(round(dist)),
+            "status": status,
+            "idle_seconds": idle_s,
+            "lat": pos.last_lat,
+            "lng": pos.last_lng,
+        })
+    return proximos
+
+
+def payload_socorro(s: Socorro, count: int) -> dict:
+    return {
+        "id": s.id,
+        "count": count,
+        "cooperado_id": s.cooperado_id,
+        "cooperado": s.cooperado_nome,
+        "mensagem": s.mensagem or "",
+        "momento": to_brasilia(s.criado_em).strftime("%d/%m/%Y %H:%M") if s.criado_em else None,
+        "lat": s.lat,
+        "lng": s.lng,
+        "posicao_quando": to_brasilia(s.posicao_em).strftime("%d/%m %H:%M:%S") if s.posicao_em else None,
+        "proximos": json.loads(s.proximos_json) if s.proximos_json else [],
+    }
+
 
 @app.route("/cooperado_socorro", methods=["POST"])
 def cooperado_socorro():
     """Cooperado pede ajuda (socorro).
-    Guarda em fila global simples para o admin visualizar até marcar como lido.
+    Grava na tabela socorro e avisa os admins conectados até alguém marcar como lido.
     """
-    global SOCORRO_QUEUE, NEXT_SOCORRO_ID
-
     data = request.get_json(silent=True) or {}
     tipo = data.get("tipo")
     detalhes = (data.get("detalhes") or "").strip()
@@ -3571,27 +6812,38 @@ def cooperado_socorro():
     cooperado_id = session.get("user_id")
     cooperado_nome = session.get("user_nome", "Cooperado")
 
-    agora_brt = datetime.now(BRAZIL_TZ)
+    # sem sessão, o limite vale por endereço (não um balde único para todo anônimo)
+    origem = cooperado_id or f"ip:{request.remote_addr}"
+    try:
+        excedeu = contar_taxa(f"socorro:{origem}", 60) > SOCORRO_LIMITE_POR_MIN
+    except Exception as e:
+        # backplane fora do ar não pode derrubar um pedido de socorro: deixa passar
+        app.logger.warning(f"Backplane: falha no limite de socorro ({e})")
+        excedeu = False
+    if excedeu:
+        return jsonify({"ok": False, "error": "Muitos pedidos de socorro; aguarde um minuto."}), 429
 
-    item = {
-        "id": int(NEXT_SOCORRO_ID),
-        "cooperado_id": cooperado_id,
-        "cooperado_nome": cooperado_nome,
-        "mensagem": f"{tipo}: {detalhes}" if detalhes else str(tipo),
-        "momento": agora_brt.strftime("%d/%m/%Y %H:%M"),
-        "timestamp": datetime.utcnow().isoformat(),
-        "lido": False,
-    }
-    NEXT_SOCORRO_ID += 1
-    SOCORRO_QUEUE.append(item)
+    item = Socorro(
+        cooperado_id=cooperado_id,
+        cooperado_nome=cooperado_nome,
+        mensagem=(f"{tipo}: {detalhes}" if detalhes else str(tipo))[:500],
+    )
+    # última posição: a ao vivo; sem ela, a gravada no cadastro
+    pos = (POSICOES.get(cooperado_id) or db.session.get(Cooperado, cooperado_id)) if cooperado_id else None
+    if pos is not None and pos.last_lat is not None and pos.last_lng is not None:
+        item.lat, item.lng, item.posicao_em = pos.last_lat, pos.last_lng, pos.last_ping
+        try:
+            item.proximos_json = json.dumps(socorristas_proximos(item.lat, item.lng, excluir=(cooperado_id,)))
+        except Exception as e:
+            app.logger.warning(f"Falha ao buscar cooperados próximos do socorro: {e}")
+    db.session.add(item)
+    db.session.flush()
 
-    # emite via socket (se o admin estiver conectado)
-    try:
-        socketio.emit("socorro_novo", item, broadcast=True)
-    except Exception:
-        pass
+    # sai no commit (se o admin estiver conectado)
+    enfileirar_emissao("socorro_novo", payload_socorro(item, socorros_pendentes().count()), [{"to": "admins"}])
+    db.session.commit()
 
-    return jsonify({"ok": True, "id": item["id"]})
+    return jsonify({"ok": True, "id": item.id})
 
 # ================================
 # CRUD de COOPERADO (mantidos)
@@ -4078,39 +7330,60 @@ def api_per_km():
 # =========================================================
 # TRAJETOS (HISTÓRICO POR COOPERADO / PERÍODO)
 # =========================================================
+def _opcoes_listagem_trajetos():
+    """Listagens não precisam dos pontos (blob grande): carrega só as métricas."""
+    return (
+        joinedload(Trajeto.cooperado),
+        defer(Trajeto.pontos_bin),
+        defer(Trajeto.pontos_json),
+    )
+
+
+def _query_resumo_trajetos(di, df, cooperado_id=None):
+    """Linhas de TrajetoResumoDiario no período (datas locais, inclusivas)."""
+    q = TrajetoResumoDiario.query
+    if di:
+        q = q.filter(TrajetoResumoDiario.dia >= di)
+    if df:
+        q = q.filter(TrajetoResumoDiario.dia <= df)
+    if cooperado_id is not None:
+        q = q.filter(TrajetoResumoDiario.cooperado_id == cooperado_id)
+    return q
+
+
+def totais_resumo_trajetos(di, df, cooperado_id=None):
+    """(n_trajetos, distancia_m, duracao_s) somados no período."""
+    n, dist, dur = _query_resumo_trajetos(di, df, cooperado_id).with_entities(
+        func.coalesce(func.sum(TrajetoResumoDiario.n_trajetos), 0),
+        func.coalesce(func.sum(TrajetoResumoDiario.distancia_m), 0.0),
+        func.coalesce(func.sum(TrajetoResumoDiario.duracao_s), 0),
+    ).one()
+    return int(n or 0), float(dist or 0.0), int(dur or 0)
+
+
 @app.route('/trajetos')
 def trajetos():
     if not session.get('is_admin'):
         return redirect(url_for('login'))
 
-    # Limpa automaticamente trajetos com mais de 31 dias (sempre mantém último mês)
-    try:
-        limite_utc = datetime.utcnow() - timedelta(days=31)
-        (
-            Trajeto.query
-            .filter(Trajeto.inicio < limite_utc)
-            .delete(synchronize_session=False)
-        )
-        db.session.commit()
-    except Exception:
-        db.session.rollback()
-
     cooperados = Cooperado.query.order_by(Cooperado.nome).all()
     cooperado_id = request.args.get('cooperado_id', 'todos')
     data_inicio = request.args.get('data_inicio')
     data_fim = request.args.get('data_fim')
 
-    q = Trajeto.query.options(joinedload(Trajeto.cooperado))
+    q = Trajeto.query.options(*_opcoes_listagem_trajetos())
+    di = df = None
 
     # Período padrão: últimos 30 dias em horário de Brasília
     hoje_brt = datetime.now(BRAZIL_TZ).date()
     if not data_inicio and not data_fim:
-        di_default = hoje_brt - timedelta(days=29)
-        di_utc, _ = local_date_window_to_utc_range(di_default)
-        _, df_utc = local_date_window_to_utc_range(hoje_brt)
+        di = hoje_brt - timedelta(days=29)
+        df = hoje_brt
+        di_utc, _ = local_date_window_to_utc_range(di)
+        _, df_utc = local_date_window_to_utc_range(df)
         q = q.filter(Trajeto.inicio >= di_utc, Trajeto.inicio <= df_utc)
 
-        data_inicio = di_default.isoformat()
+        data_inicio = di.isoformat()
         data_fim = hoje_brt.isoformat()
     else:
         if data_inicio:
@@ -4122,22 +7395,26 @@ def trajetos():
             _, df_utc = local_date_window_to_utc_range(df)
             q = q.filter(Trajeto.inicio <= df_utc)
 
+    coop_id = None
     if cooperado_id and cooperado_id != 'todos':
         try:
-            q = q.filter(Trajeto.cooperado_id == int(cooperado_id))
+            coop_id = int(cooperado_id)
+            q = q.filter(Trajeto.cooperado_id == coop_id)
         except ValueError:
             pass
 
     trajetos_list = q.order_by(Trajeto.inicio.desc()).limit(2000).all()
 
-    # KPIs gerais
-    total_km = sum((t.distancia_m or 0.0) for t in trajetos_list) / 1000.0
-    total_horas = sum((t.duracao_s or 0) for t in trajetos_list) / 3600.0
+    # KPIs gerais: do resumo diário (algumas linhas por cooperado/dia, não os trajetos)
+    total_trajetos, total_m, total_s = totais_resumo_trajetos(di, df, coop_id)
+    total_km = total_m / 1000.0
+    total_horas = total_s / 3600.0
     vel_media_geral = (total_km / total_horas) if total_horas > 0 else 0.0
 
     return render_template(
         'trajetos.html',
         trajetos=trajetos_list,
+        total_trajetos=total_trajetos,
         cooperados=cooperados,
         cooperado_id=cooperado_id,
         data_inicio=data_inicio,
@@ -4158,13 +7435,15 @@ def trajetos_exportar():
     data_inicio = request.args.get('data_inicio')
     data_fim = request.args.get('data_fim')
 
-    q = Trajeto.query.options(joinedload(Trajeto.cooperado))
+    q = Trajeto.query.options(*_opcoes_listagem_trajetos())
+    di = df = None
 
     hoje_brt = datetime.now(BRAZIL_TZ).date()
     if not data_inicio and not data_fim:
-        di_default = hoje_brt - timedelta(days=29)
-        di_utc, _ = local_date_window_to_utc_range(di_default)
-        _, df_utc = local_date_window_to_utc_range(hoje_brt)
+        di = hoje_brt - timedelta(days=29)
+        df = hoje_brt
+        di_utc, _ = local_date_window_to_utc_range(di)
+        _, df_utc = local_date_window_to_utc_range(df)
         q = q.filter(Trajeto.inicio >= di_utc, Trajeto.inicio <= df_utc)
     else:
         if data_inicio:
@@ -4176,9 +7455,11 @@ def trajetos_exportar():
             _, df_utc = local_date_window_to_utc_range(df)
             q = q.filter(Trajeto.inicio <= df_utc)
 
+    coop_id = None
     if cooperado_id and cooperado_id != 'todos':
         try:
-            q = q.filter(Trajeto.cooperado_id == int(cooperado_id))
+            coop_id = int(cooperado_id)
+            q = q.filter(Trajeto.cooperado_id == coop_id)
         except ValueError:
             pass
 
@@ -4209,6 +7490,22 @@ def trajetos_exportar():
 
     df_out = pd.DataFrame(rows)
 
+    # Resumo por cooperado/dia (vem do resumo diário: cobre inclusive dias já expurgados)
+    resumo_rows = []
+    for r in _query_resumo_trajetos(di, df, coop_id).options(joinedload(TrajetoResumoDiario.cooperado)) \
+            .order_by(TrajetoResumoDiario.dia.asc(), TrajetoResumoDiario.cooperado_id.asc()).all():
+        resumo_rows.append({
+            'Dia': r.dia.strftime('%d/%m/%Y'),
+            'Cooperado': r.cooperado.nome if r.cooperado else '',
+            'Trajetos': int(r.n_trajetos or 0),
+            'Distância (km)': round((r.distancia_m or 0.0) / 1000.0, 3),
+            'Horas em trajeto': round((r.duracao_s or 0) / 3600.0, 2),
+            'Velocidade média (km/h)': round(r.velocidade_media_kmh, 1),
+        })
+    df_resumo = pd.DataFrame(resumo_rows, columns=[
+        'Dia', 'Cooperado', 'Trajetos', 'Distância (km)', 'Horas em trajeto', 'Velocidade média (km/h)',
+    ])
+
     output = io.BytesIO()
     with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
         sheet = 'Trajetos'
@@ -4229,9 +7526,82 @@ def trajetos_exportar():
             idx = cols.index('Velocidade média (km/h)')
             ws.set_column(idx, idx, 22, vel_fmt)
 
+        df_resumo.to_excel(writer, index=False, sheet_name='Resumo diário')
+        ws_r = writer.sheets['Resumo diário']
+        for i, w in enumerate([12, 26, 10, 16, 16, 22]):
+            ws_r.set_column(i, i, w)
+
     output.seek(0)
     return send_file(output, download_name='trajetos.xlsx', as_attachment=True)
 
+
+@app.route('/api/trajetos/<int:trajeto_id>/replay')
+def api_trajeto_replay(trajeto_id):
+    if not session.get('is_admin'):
+        return jsonify({"ok": False, "error": "Não autorizado"}), 403
+
+    traj = Trajeto.query.get_or_404(trajeto_id)
+    zoom = _zoom_replay(request.args.get('zoom'))
+    resp = jsonify({"ok": True, "zoom": zoom, **replay_payload(traj, zoom)})
+    resp.headers["Cache-Control"] = "private, max-age=300"
+    return resp
+
+
+def _parse_datahora_local(v):
+    """'YYYY-MM-DDTHH:MM[:SS]' em horário de Brasília -> epoch s (ou None)."""
+    if not v:
+        return None
+    try:
+        dt = datetime.fromisoformat(v)
+    except ValueError:
+        return None
+    if dt.tzinfo is None:
+        dt = BRAZIL_TZ.localize(dt)
+    return int(dt.timestamp())
+
+
+@app.route('/api/trajetos/replay')
+def api_trajetos_replay_periodo():
+    """
+    Replay de um cooperado numa janela de tempo (?cooperado_id=&inicio=&fim=&zoom=).
+    Padrão: últimas 24h. Devolve um item por trajeto, recortado na janela.
+    """
+    if not session.get('is_admin'):
+        return jsonify({"ok": False, "error": "Não autorizado"}), 403
+
+    try:
+        cooperado_id = int(request.args.get('cooperado_id', ''))
+    except ValueError:
+        return jsonify({"ok": False, "error": "cooperado_id obrigatório"}), 400
+
+    zoom = _zoom_replay(request.args.get('zoom'))
+    t_fim = _parse_datahora_local(request.args.get('fim')) or int(datetime.now(timezone.utc).timestamp())
+    t_ini = _parse_datahora_local(request.args.get('inicio')) or (t_fim - 24 * 3600)
+    if t_ini > t_fim:
+        return jsonify({"ok": False, "error": "Janela inválida"}), 400
+
+    ini_utc = datetime.utcfromtimestamp(t_ini)
+    fim_utc = datetime.utcfromtimestamp(t_fim)
+    trajetos_list = (
+        Trajeto.query
+        .filter(
+            Trajeto.cooperado_id == cooperado_id,
+            Trajeto.inicio <= fim_utc,
+            Trajeto.fim >= ini_utc,
+        )
+        .order_by(Trajeto.inicio.asc())
+        .limit(200)
+        .all()
+    )
+
+    itens = [replay_payload(t, zoom, t_ini, t_fim) for t in trajetos_list]
+    return jsonify({
+        "ok": True,
+        "zoom": zoom,
+        "cooperado_id": cooperado_id,
+        "trajetos": [i for i in itens if i["n"]],
+    })
+
 from flask import request, jsonify
 
 @app.route('/mapa_motoboys')
@@ -4243,33 +7613,20 @@ def mapa_motoboys():
     motoboys_js = []
 
     for c in cooperados:
-        if c.last_lat is not None and c.last_lng is not None:
-            # ---- MONTA STATUS PRO MAPA ----
-            # ajusta esses campos conforme o teu modelo:
-            #   c.online -> app ligado?
-            #   c.em_corrida ou c.ocupado -> está em entrega?
-            online = bool(getattr(c, "online", False))
-            em_corrida = bool(getattr(c, "em_corrida", False) or getattr(c, "ocupado", False))
-
-            if not online:
-                status = "offline"
-            elif em_corrida:
-                status = "em_corrida"
-            else:
-                status = "livre"
-
-            is_online, idle_s, status_str = calc_status_cooperado(c)
+        p = POSICOES.de(c)  # posição ao vivo (memória) ou a última gravada no banco
+        if p.last_lat is not None and p.last_lng is not None:
+            is_online, idle_s, status_str = status_mantido(p)
 
             motoboys_js.append({
                 "id": c.id,
                 "nome": c.nome,
-                "lat": float(c.last_lat),
-                "lng": float(c.last_lng),
+                "lat": float(p.last_lat),
+                "lng": float(p.last_lng),
                 "online": bool(is_online),
                 "status": status_str,
                 "idle_seconds": idle_s,
-                "velocidade": float(getattr(c, "last_speed_kmh", 0) or 0),
-                "ultima_atualizacao": (to_brasilia(c.last_ping).strftime('%d/%m %H:%M') if c.last_ping else ""),
+                "velocidade": float(getattr(p, "last_speed_kmh", 0) or 0),
+                "ultima_atualizacao": (to_brasilia(p.last_ping).strftime('%d/%m %H:%M') if p.last_ping else ""),
                 "endereco": getattr(c, "zona", None) or getattr(c, "bairro", None) or "",
                 "observacao": getattr(c, "observacao", "") or ""
             })
@@ -4284,6 +7641,101 @@ def mapa_motoboys():
     return render_template('mapa_motoboys.html', motoboys_js=motoboys_js)
 
 
+@app.route('/api/motoboys/proximos')
+def api_motoboys_proximos():
+    """
+    Motoboys mais próximos de um ponto (índice em grade, sem varrer cooperados).
+    ?lat=&lng=&k=5&raio_m=&status=livre,ocioso  (status=todos => qualquer um online ou não)
+    """
+    if not session.get('is_admin'):
+        return jsonify({"ok": False, "error": "Não autorizado"}), 403
+
+    lat = _float_or_none(request.args.get('lat'))
+    lng = _float_or_none(request.args.get('lng'))
+    if lat is None or lng is None or not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        return jsonify({"ok": False, "error": "lat/lng inválidos"}), 400
+
+    try:
+        k = max(1, min(50, int(request.args.get('k', 5))))
+    except ValueError:
+        k = 5
+    raio_m = _float_or_none(request.args.get('raio_m'))
+
+    status_arg = (request.args.get('status') or '').strip().lower()
+    if status_arg == 'todos':
+        status = None
+    elif status_arg:
+        status = tuple(x.strip() for x in status_arg.split(',') if x.strip())
+    else:
+        status = STATUS_DISPONIVEIS
+
+    itens = []
+    for dist, cid in motoboys_proximos(lat, lng, k=k, raio_m=raio_m, status=status):
+        p = POSICOES.get(cid)
+        if p is None:
+            continue
+        _, idle_s, status_str = status_mantido(p)
+        itens.append({
+            "id": cid,
+            "nome": p.nome,
+            "lat": p.last_lat,
+            "lng": p.last_lng,
+            "dist_m": round(dist, 1),
+            "status": status_str,
+            "idle_seconds": idle_s,
+        })
+    return jsonify({"ok": True, "itens": itens})
+
+
+@app.post('/api/entregas/<int:entrega_id>/rota')
+def api_roteirizar_entrega(entrega_id):
+    """Reordena as paradas da entrega (vizinho mais próximo + 2-opt) e grava a nova ordem."""
+    if not session.get('is_admin'):
+        return jsonify({"ok": False, "error": "Não autorizado"}), 403
+
+    e = Entrega.query.get_or_404(entrega_id)
+    if versao_conflita(e, versao_esperada(request.get_json(silent=True))):
+        return resposta_conflito(e.id)
+
+    rota = roteirizar_entrega(e)
+    conflito = commit_ou_conflito(e)
+    if conflito:
+        return conflito
+
+    return jsonify({
+        "ok": True,
+        "entrega_id": e.id,
+        "paradas": rota["paradas"],
+        "ordem": rota["ordem"],
+        "km_estimado": rota["km_estimado"],
+        "km_antes": rota["km_antes"],
+        "versao": e.versao,
+    })
+
+
+@app.route('/api/despacho/auto', methods=['GET', 'POST'])
+def api_despacho_auto():
+    """Liga/desliga o despacho automático. POST {"ativo": true|false}."""
+    if not session.get('is_admin'):
+        return jsonify({"ok": False, "error": "Não autorizado"}), 403
+
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        DESPACHANTE.ativo = bool(data.get('ativo'))
+        BACKPLANE.hset("config", "despacho_ativo", "1" if DESPACHANTE.ativo else "0")
+        app.logger.info(f"Despacho automático {'ligado' if DESPACHANTE.ativo else 'desligado'}")
+
+    return jsonify({"ok": True, "ativo": despacho_ativo()})
+
+
+@app.get('/api/emissoes/metricas')
+def api_emissoes_metricas():
+    """Profundidade da fila de emissões Socket.IO, descartes e latência até o emit."""
+    if not session.get('is_admin'):
+        return jsonify({"ok": False, "error": "Não autorizado"}), 403
+    return jsonify({"ok": True, **FILA_EMISSOES.metricas()})
+
+
 # =========================================================
 # ENTREGAS: CADASTRAR / AGENDAR / EDITAR / EXCLUIR
 # =========================================================
@@ -4349,6 +7801,8 @@ def api_update_entrega_valor(entrega_id):
 
     e = Entrega.query.get_or_404(entrega_id)
     data = request.get_json(silent=True) or {}
+    if versao_conflita(e, versao_esperada(data)):
+        return resposta_conflito(e.id)
 
     try:
         novo_valor = _parse_money_to_float(data.get("valor"))
@@ -4359,12 +7813,14 @@ def api_update_entrega_valor(entrega_id):
         return jsonify({"ok": False, "error": "Valor não pode ser negativo."}), 400
 
     e.valor = float(novo_valor)
-    db.session.commit()
+    conflito = commit_ou_conflito(e)
+    if conflito:
+        return conflito
 
     # Atualiza painéis em tempo real (se você usa isso)
     emitir_atualizacao_entrega(e, "editada")
 
-    return jsonify({"ok": True, "id": e.id, "valor": float(e.valor)}), 200
+    return jsonify({"ok": True, "id": e.id, "valor": float(e.valor), "versao": e.versao}), 200
 
 
 @app.patch("/api/entregas/<int:entrega_id>/inline")
@@ -4375,14 +7831,18 @@ def api_update_entrega_inline(entrega_id):
       - cooperado_id (int ou '' para remover)
       - status (string)
       - status_pagamento (string)
+      - versao (int, opcional): versão que o operador viu; se mudou => 409 com o estado atual
     """
     if not session.get("is_admin") and not session.get("is_master"):
         return jsonify(ok=False, error="unauthorized"), 401
 
     e = Entrega.query.get_or_404(entrega_id)
     data = request.get_json(silent=True) or {}
+    if versao_conflita(e, versao_esperada(data)):
+        return resposta_conflito(e.id)
 
     changed = False
+    cooperado_anterior = e.cooperado_id
 
     if "valor" in data:
         try:
@@ -4407,6 +7867,10 @@ def api_update_entrega_inline(entrega_id):
             if not coop:
                 return jsonify(ok=False, error="cooperado não encontrado"), 404
             e.cooperado_id = cid_int
+            if cid_int != cooperado_anterior:
+                # novo cooperado: a corrida volta a aguardar aceite
+                e.data_atribuida = datetime.utcnow()
+                e.status_corrida = 'pendente'
             changed = True
 
     if "status" in data:
@@ -4422,7 +7886,15 @@ def api_update_entrega_inline(entrega_id):
             changed = True
 
     if changed:
-        db.session.commit()
+        conflito = commit_ou_conflito(e)
+        if conflito:
+            return conflito
+        if e.cooperado_id != cooperado_anterior:
+            if e.cooperado_id:
+                agendar_expiracao_oferta(e)
+                emitir_oferta_corrida(e)
+            else:
+                cancelar_expiracao_oferta(e.id)
 
     return jsonify(
         ok=True,
@@ -4432,6 +7904,7 @@ def api_update_entrega_inline(entrega_id):
         cooperado_nome=(e.cooperado.nome if getattr(e, "cooperado", None) else None),
         status=e.status,
         status_pagamento=e.status_pagamento,
+        versao=e.versao,
     )
 
 
@@ -4522,6 +7995,8 @@ def cadastrar_entrega():
             ListaEspera.query.filter_by(cooperado_id=int(cooperado_id)).delete()
 
         db.session.commit()
+        agendar_expiracao_oferta(entrega)
+        emitir_oferta_corrida(entrega)
 
         # DEBUG AQUI
         print("DEBUG_PAGAMENTO_ENTREGA", entrega.id, repr(entrega.pagamento))
@@ -4708,6 +8183,10 @@ def editar_entrega(id):
         return redirect(url_for('painel_cooperado'))
 
     if request.method == 'POST':
+        voltar = url_for('editar_entrega', id=entrega.id)
+        if versao_conflita(entrega, versao_esperada()):
+            return resposta_conflito(entrega.id, voltar)
+
         if is_admin:
             novo_cliente_nome = (request.form.get('cliente') or '').strip()
             entrega.cliente = novo_cliente_nome
@@ -4747,7 +8226,9 @@ def editar_entrega(id):
                 request.form.get('pagamento') or entrega.pagamento or ''
             ).strip()
 
-            db.session.commit()
+            conflito = commit_ou_conflito(entrega, voltar)
+            if conflito:
+                return conflito
 
             try:
                 if pagamento_usa_credito(entrega.pagamento):
@@ -4779,6 +8260,7 @@ def editar_entrega(id):
                     cliente=entrega.cliente,
                     bairro=entrega.bairro,
                     valor=float(entrega.valor or 0),
+                    versao=entrega.versao,
                 )
 
             return redirect_back_to_admin()
@@ -4791,7 +8273,10 @@ def editar_entrega(id):
             ).lower()
             entrega.status = request.form.get('status') or entrega.status
             entrega.recebido_por = request.form.get('recebido_por')
-            db.session.commit()
+            conflito = commit_ou_conflito(entrega, voltar)
+            if conflito:
+                return conflito
+            emitir_atualizacao_entrega(entrega, 'editada')
             flash('Entrega atualizada!')
 
             if _wants_json():
@@ -4802,6 +8287,7 @@ def editar_entrega(id):
                     status=entrega.status,
                     status_pagamento=entrega.status_pagamento,
                     recebido_por=entrega.recebido_por,
+                    versao=entrega.versao,
                 )
 
             return redirect(url_for('painel_cooperado'))
@@ -4819,6 +8305,8 @@ def atribuir_cooperado(id):
 
     entrega = Entrega.query.get_or_404(id)
     coop_id = (request.form.get('cooperado_id') or '').strip()
+    if versao_conflita(entrega, versao_esperada()):
+        return resposta_conflito(entrega.id, request.referrer or url_for('admin'))
 
     try:
         if coop_id:
@@ -4833,7 +8321,12 @@ def atribuir_cooperado(id):
             entrega.data_atribuida = None
             entrega.status_corrida = None
 
-        db.session.commit()
+        db.session.commit()  # StaleDataError => except abaixo (409)
+        if entrega.cooperado_id:
+            agendar_expiracao_oferta(entrega)
+            emitir_oferta_corrida(entrega)
+        else:
+            cancelar_expiracao_oferta(entrega.id)
         msg = 'Entrega atribuída com sucesso!'
         flash(msg, 'success')
 
@@ -4844,8 +8337,12 @@ def atribuir_cooperado(id):
                 entrega_id=entrega.id,
                 cooperado_id=entrega.cooperado_id,
                 status_corrida=entrega.status_corrida,
+                versao=entrega.versao,
             )
 
+    except StaleDataError:
+        return resposta_conflito(id, request.referrer or url_for('admin'))
+
     except Exception as e:
         db.session.rollback()
         msg = 'Erro ao atribuir entrega'
@@ -4883,6 +8380,7 @@ def excluir_entrega(id):
 
         db.session.delete(entrega)
         db.session.commit()
+        ETAS.invalidar(id)
         msg = 'Entrega excluída com sucesso.'
         flash(msg, 'success')
 
@@ -4920,14 +8418,19 @@ def marcar_pagamento(id):
         return redirect(url_for('login'))
 
     e = Entrega.query.get_or_404(id)
+    if versao_conflita(e, versao_esperada(request.get_json(silent=True))):
+        return resposta_conflito(e.id, request.referrer or url_for('admin'))
     e.status_pagamento = "pago"
-    db.session.commit()
+    conflito = commit_ou_conflito(e, request.referrer or url_for('admin'))
+    if conflito:
+        return conflito
 
     if _wants_json():
         return jsonify(
             ok=True,
             entrega_id=e.id,
             status_pagamento=e.status_pagamento,
+            versao=e.versao,
         )
 
     return redirect_back_to_admin()
@@ -4939,14 +8442,19 @@ def marcar_entregue(id):
         return redirect(url_for('login'))
 
     e = Entrega.query.get_or_404(id)
+    if versao_conflita(e, versao_esperada(request.get_json(silent=True))):
+        return resposta_conflito(e.id, request.referrer or url_for('admin'))
     e.status = "entregue"
-    db.session.commit()
+    conflito = commit_ou_conflito(e, request.referrer or url_for('admin'))
+    if conflito:
+        return conflito
 
     if _wants_json():
         return jsonify(
             ok=True,
             entrega_id=e.id,
             status=e.status,
+            versao=e.versao,
         )
 
     return redirect_back_to_admin()
@@ -4962,6 +8470,8 @@ def api_atualizar_valor_entrega(id):
     e = Entrega.query.get_or_404(id)
 
     data = request.get_json(silent=True) or {}
+    if versao_conflita(e, versao_esperada(data)):
+        return resposta_conflito(e.id)
     novo_valor_raw = data.get("valor", None)
 
     try:
@@ -4981,7 +8491,9 @@ def api_atualizar_valor_entrega(id):
 
     e.valor = novo_valor
     db.session.add(e)
-    db.session.commit()
+    conflito = commit_ou_conflito(e)
+    if conflito:
+        return conflito
 
     # Recalcula crédito se necessário (mesma lógica do editar_entrega)
     try:
@@ -5009,6 +8521,7 @@ def api_atualizar_valor_entrega(id):
         entrega_id=e.id,
         valor=round(float(e.valor or 0), 2),
         status_pagamento=(e.status_pagamento or "").lower(),
+        versao=e.versao,
         changed=True
     )
 
@@ -5772,11 +9285,16 @@ def credmov_excluir(mov_id):
 def toggle_pagamento(id):
     e = Entrega.query.get_or_404(id)
     _assert_entrega_do_cooperado(e)
+    if versao_conflita(e, versao_esperada(request.get_json(silent=True))):
+        return resposta_conflito(e.id)
     atual = (e.status_pagamento or 'pendente').lower()
     novo = 'pago' if atual != 'pago' else 'pendente'
     e.status_pagamento = novo
-    db.session.commit()
-    return jsonify(ok=True, status_pagamento=novo)
+    conflito = commit_ou_conflito(e)
+    if conflito:
+        return conflito
+    emitir_atualizacao_entrega(e, "pagamento")
+    return jsonify(ok=True, status_pagamento=novo, versao=e.versao)
 
 
 @app.get('/cooperado/api/ganhos')
@@ -5853,6 +9371,7 @@ def cooperado_marcar_entregue(id):
 
     recebido_por = ''
     foto_fs = None
+    payload = {}
 
     # 1) Se veio multipart (FormData), pega do form/files
     # OBS: mesmo sem arquivo, o browser envia multipart e request.files pode vir vazio,
@@ -5865,6 +9384,9 @@ def cooperado_marcar_entregue(id):
         payload = request.get_json(silent=True) or {}
         recebido_por = (payload.get('recebido_por') or '').strip()
 
+    if versao_conflita(e, versao_esperada(payload)):
+        return resposta_conflito(e.id)
+
     if not recebido_por and not foto_fs:
         return jsonify(ok=False, error='Informe o nome de quem recebeu OU envie uma foto.'), 400
 
@@ -5877,8 +9399,11 @@ def cooperado_marcar_entregue(id):
 
     e.status = 'recebido'
     e.recebido_por = recebido_por or (e.recebido_por or None)
-    db.session.commit()
-    return jsonify(ok=True, tem_foto=comprovante_existe(e.id))
+    conflito = commit_ou_conflito(e)
+    if conflito:
+        return conflito
+    emitir_atualizacao_entrega(e, "entregue")
+    return jsonify(ok=True, tem_foto=comprovante_existe(e.id), versao=e.versao)
 
 
 @app.get('/cooperado/api/entrega_atribuida')
@@ -6688,12 +10213,22 @@ def criar_bd():
             "ALTER TABLE cliente ADD COLUMN IF NOT EXISTS reset_code VARCHAR(10)",
             "ALTER TABLE cliente ADD COLUMN IF NOT EXISTS reset_expires_at TIMESTAMP",
 
+            "ALTER TABLE cooperado ADD COLUMN IF NOT EXISTS presenca VARCHAR(20)",
+
             "ALTER TABLE entrega ADD COLUMN IF NOT EXISTS credito_usado REAL DEFAULT 0",
             "ALTER TABLE entrega ADD COLUMN IF NOT EXISTS credito_mov_id INTEGER",
             "ALTER TABLE entrega ADD COLUMN IF NOT EXISTS cliente_id INTEGER",
 
             "ALTER TABLE entrega ADD COLUMN IF NOT EXISTS origem_json TEXT",
             "ALTER TABLE entrega ADD COLUMN IF NOT EXISTS destino_json TEXT",
+            "ALTER TABLE entrega ADD COLUMN IF NOT EXISTS versao INTEGER NOT NULL DEFAULT 1",
+            "ALTER TABLE entrega ADD COLUMN IF NOT EXISTS chegada_coleta_em TIMESTAMP",
+            "ALTER TABLE entrega ADD COLUMN IF NOT EXISTS chegada_destino_em TIMESTAMP",
+
+            "ALTER TABLE socorro ADD COLUMN IF NOT EXISTS proximos_json TEXT",
+
+            "ALTER TABLE trajeto ADD COLUMN IF NOT EXISTS pontos_bin BYTEA",
+            "ALTER TABLE trajeto ADD COLUMN IF NOT EXISTS consolidado BOOLEAN NOT NULL DEFAULT FALSE",
             
             "ALTER TABLE credito ADD COLUMN IF NOT EXISTS desconto_tipo VARCHAR(20) DEFAULT 'nenhum'",
             "ALTER TABLE credito ADD COLUMN IF NOT EXISTS desconto_valor REAL DEFAULT 0",
@@ -6822,6 +10357,8 @@ def criar_bd():
 
             "CREATE INDEX IF NOT EXISTS idx_trajeto_cooperado_id ON trajeto (cooperado_id)",
             "CREATE INDEX IF NOT EXISTS idx_trajeto_inicio ON trajeto (inicio DESC)",
+            "CREATE INDEX IF NOT EXISTS idx_trajeto_pendente ON trajeto (id) WHERE NOT consolidado",
+            "CREATE INDEX IF NOT EXISTS idx_trajeto_resumo_dia ON trajeto_resumo_diario (dia)",
         ]
         for s in idx_cmds:
             try:
@@ -6860,6 +10397,17 @@ def criar_bd():
         db.session.commit()
 
 criar_bd()
+semear_posicoes_do_banco()
+iniciar_replicacao_posicoes()
+iniciar_flush_posicoes()
+iniciar_fila_emissoes()
+iniciar_varredura_presenca()
+iniciar_transmissao_posicoes()
+iniciar_segmentador_trajetos()
+iniciar_retencao_trajetos()
+iniciar_despacho()
+iniciar_roda_temporizadores()
+retomar_ofertas_pendentes()
 
 # =========================================================
 # EVENTOS SOCKET.IO (TEMPO REAL)
@@ -6868,13 +10416,42 @@ criar_bd()
 from flask import request
 
 # Conexão do cliente
+def cooperado_do_socket(auth=None):
+    """
+    Cooperado dono da conexão Socket.IO: sessão do painel (cookie) ou token do app
+    (gerar_token_mobile) em auth={"token": ...} ou ?token=. None se não autenticado.
+    """
+    if session.get("user_id") and not session.get("is_admin"):
+        return int(session["user_id"])
+    token = (auth or {}).get("token") if isinstance(auth, dict) else None
+    token = token or request.args.get("token")
+    if not token:
+        return None
+    try:
+        return int(ler_token_mobile(token).get("cooperado_id"))
+    except Exception:
+        return None
+
+
 @socketio.on("connect")
 def handle_connect(auth=None):
     try:
-        if current_user.is_authenticated and getattr(current_user, "tipo", "") == "admin":
+        if session.get("is_admin") or (
+            current_user.is_authenticated and getattr(current_user, "tipo", "") == "admin"
+        ):
             join_room("admins")
-    except Exception:
-        pass
+            return
+        cooperado_id = cooperado_do_socket(auth)
+        if cooperado_id:
+            cooperado = Cooperado.query.get(cooperado_id)
+            if not cooperado or not cooperado.ativo:
+                return False  # recusa a conexão: conta desativada não recebe ofertas
+            # sala privada do cooperado: ofertas de corrida chegam direto aqui
+            join_room(f"cooperado_{cooperado_id}")
+            # presença pela conexão: o app pode pingar devagar quando parado
+            POSICOES.conectar(cooperado, request.sid)
+    except Exception as e:
+        app.logger.warning(f"Falha no connect do Socket.IO: {e}")
 
 
 # Desconexão do cliente
@@ -6882,6 +10459,22 @@ def handle_connect(auth=None):
 def handle_disconnect(reason=None):
     # O Socket.IO passa 1 argumento (normalmente o 'reason'), por isso reason=None
     print(f"Cliente desconectado do Socket.IO: sid={request.sid}, reason={reason}")
+    # queda de conexão: a presença volta a depender do ping. Saída de propósito
+    # chega antes pelo evento 'encerrar' (esta versão do Socket.IO não passa o motivo).
+    try:
+        POSICOES.desconectar(request.sid)
+    except Exception as e:
+        app.logger.warning(f"Falha ao atualizar presença no disconnect: {e}")
+
+
+@socketio.on("encerrar")
+def handle_encerrar(data=None):
+    """O cliente vai fechar o socket de propósito (sair / encerrar turno): offline na hora."""
+    try:
+        POSICOES.desconectar(request.sid, encerrou=True)
+    except Exception as e:
+        app.logger.warning(f"Falha ao atualizar presença no encerrar: {e}")
+    disconnect()
 
 
 @socketio.on("entrar_sala")
@@ -6896,6 +10489,9 @@ def handle_entrar_sala(data):
     sala = data.get("sala")
     if not sala:
         return
+    # salas com posições de todos / ofertas de um cooperado: só pelo connect autenticado
+    if sala == "admins" or str(sala).startswith("cooperado_"):
+        return
 
     usuario_id = data.get("usuario_id")
 
@@ -6913,6 +10509,20 @@ def handle_entrar_sala(data):
     )
 
 
+@socketio.on("rastrear")
+def handle_rastrear(data):
+    """Página pública de rastreio: entra na sala da entrega do token (recebe 'posicao_entrega')."""
+    try:
+        entrega_id = int(ler_token_rastreio((data or {}).get("token")).get("entrega_id"))
+    except Exception:
+        return {"ok": False}
+    join_room(f"entrega_{entrega_id}")
+    e = Entrega.query.get(entrega_id)
+    if e and e.cooperado_id:
+        marcar_rastreio_observado(e.cooperado_id)
+    return {"ok": True, "entrega_id": entrega_id}
+
+
 @socketio.on("sair_sala")
 def handle_sair_sala(data):
     """
@@ -7035,9 +10645,10 @@ def rastreio_publico(token):
   .small{{opacity:.9;font-weight:700}}
 </style>
 </head><body>
-<header>Rastreio em tempo real — Entrega #{entrega_id} <span class="small">({coop_nome})</span></header>
+<header>Rastreio em tempo real — Entrega #{entrega_id} <span class="small">({coop_nome})</span> <span class="small" id="eta"></span></header>
 <div id="map"></div>
 <script src="https://unpkg.com/leaflet@1.9.4/dist/leaflet.js"></script>
+<script src="https://cdn.socket.io/4.7.5/socket.io.min.js" crossorigin="anonymous"></script>
 <script>
   const token = {json.dumps(token)};
   const map = L.map('map', {{ zoomControl:true }}).setView([-5.7945,-35.2110], 13);
@@ -7054,10 +10665,20 @@ def rastreio_publico(token):
       const data = await r.json();
       if(!data.ok) return;
 
+      mover(data);
+    }}catch(e){{}}
+  }}
+
+  function mover(data){{
       const lat = data.lat, lng = data.lng;
       if(typeof lat !== 'number' || typeof lng !== 'number') return;
+      if(data.eta) ultimaEta = data.eta;
 
-      const txt = (data.cooperado || '') + ' • ' + (data.quando_local || '');
+      let txt = (data.cooperado || '') + ' • ' + (data.quando_local || '');
+      if(ultimaEta){{
+        txt += ' • chega em ~' + ultimaEta.eta_min + ' min (' + ultimaEta.distancia_km.toFixed(1).replace('.', ',') + ' km)';
+        document.getElementById('eta').textContent = '— chega em ~' + ultimaEta.eta_min + ' min';
+      }}
       if(!marker){{
         marker = L.circleMarker([lat,lng], {{
           radius: 7,
@@ -7070,10 +10691,25 @@ def rastreio_publico(token):
         marker.setLatLng([lat,lng]);
         marker.setTooltipContent(txt);
       }}
-    }}catch(e){{}}
   }}
-  pull();
-  setInterval(pull, 5000);
+
+  // posição ao vivo pela sala da entrega; o HTTP fica para ETA/encerramento
+  // (a cada 30s com o socket conectado, 5s sem ele)
+  let ultimaEta = null;
+  let ultimoPull = 0;
+  const socket = io({{ transports: ["polling"] }});
+  socket.on('connect', () => socket.emit('rastrear', {{ token }}));
+  socket.on('posicao_entrega', mover);
+
+  function tick(){{
+    const espera = socket.connected ? 30000 : 5000;
+    if(Date.now() - ultimoPull >= espera){{
+      ultimoPull = Date.now();
+      pull();
+    }}
+  }}
+  tick();
+  setInterval(tick, 5000);
 </script>
 </body></html>"""
     return html
@@ -7095,28 +10731,25 @@ def api_rastreio_pos(token):
         return jsonify(ok=False, error="ended"), 410
 
     coop = getattr(e, "cooperado", None)
-    if not coop or coop.last_lat is None or coop.last_lng is None:
+    if coop:
+        marcar_rastreio_observado(coop.id)  # o app dele passa a pingar no ritmo rápido
+    pos = POSICOES.de(coop) if coop else None
+    if not coop or pos.last_lat is None or pos.last_lng is None:
         return jsonify(ok=True, lat=None, lng=None, cooperado=(coop.nome if coop else None), quando_local=None)
 
     when_local = None
     try:
-        if coop.last_ping:
-            when_local = to_brasilia(coop.last_ping).strftime("%d/%m/%Y %H:%M:%S")
+        if pos.last_ping:
+            when_local = to_brasilia(pos.last_ping).strftime("%d/%m/%Y %H:%M:%S")
     except Exception:
         when_local = None
 
     return jsonify(ok=True,
-                   lat=float(coop.last_lat),
-                   lng=float(coop.last_lng),
+                   lat=float(pos.last_lat),
+                   lng=float(pos.last_lng),
                    cooperado=coop.nome,
-                   quando_local=when_local)
-
-
-if __name__ == '__main__':
-    port = int(os.environ.get('PORT', 5000))
-    # importante rodar pelo socketio, não pelo app.run
-    socketio.run(app, host='0.0.0.0', port=port)
-
+                   quando_local=when_local,
+                   eta=ETAS.estimar(e))
 
 
 # =============================
@@ -7177,44 +10810,143 @@ def api_mobile_ping():
     coop = request.cooperado_mobile
     data = request.get_json(silent=True) or {}
 
-    try:
-        lat = float(data.get("lat"))
-        lng = float(data.get("lng"))
-    except (TypeError, ValueError):
+    fix = normalizar_fix(data)
+    if fix is None:
         return jsonify(ok=False, error="lat_lng_invalidos"), 400
 
-    speed_mps = data.get("speed_mps", None)
-    heading = data.get("heading", None)
-    accuracy = data.get("accuracy", None)
+    aplicado = POSICOES.atualizar(coop, fix)
+    gravar_trajetos(SEGMENTADOR.processar(coop.id, [fix]))
+    registrar_chegadas(coop.id, [fix])
 
-    v_kmh = None
-    try:
-        if speed_mps is not None:
-            v_kmh = float(speed_mps) * 3.6
-    except (TypeError, ValueError):
-        v_kmh = None
+    if aplicado:
+        try:
+            emitir_posicao_motoboy(coop, fix["lat"], fix["lng"], fix["v_kmh"])
+        except Exception:
+            pass
 
-    coop.last_lat = lat
-    coop.last_lng = lng
-    coop.last_ping = datetime.utcnow()
-    coop.online = True
-    coop.last_speed_kmh = v_kmh
+    return jsonify(ok=True, **intervalo_ping(coop.id))
 
-    try:
-        coop.last_heading = float(heading) if heading is not None else None
-    except (TypeError, ValueError):
-        coop.last_heading = None
 
-    try:
-        coop.last_accuracy_m = float(accuracy) if accuracy is not None else None
-    except (TypeError, ValueError):
-        coop.last_accuracy_m = None
+@app.post("/api/mobile/ping/lote")
+@mobile_auth_required
+def api_mobile_ping_lote():
+    """
+    Recebe um lote ordenado de fixes do app (um POST a cada N segundos em vez de um por fix).
+    Aceita lotes atrasados / fora de ordem (buffer offline do aparelho).
 
-    db.session.commit()
+    JSON: {"fixes": [{"lat", "lng", "speed_mps", "heading", "accuracy", "t"}, ...]}
+    """
+    coop = request.cooperado_mobile
+    data = request.get_json(silent=True) or {}
+
+    itens = data.get("fixes")
+    if not isinstance(itens, list) or not itens:
+        return jsonify(ok=False, error="fixes_vazio"), 400
+    if len(itens) > PING_LOTE_MAX:
+        return jsonify(ok=False, error="lote_grande_demais", max=PING_LOTE_MAX), 413
 
+    aceitos, descartados, aplicado = processar_lote_pings(coop, itens)
+
+    if aplicado:
+        try:
+            emitir_posicao_motoboy(coop, aplicado["lat"], aplicado["lng"], aplicado["v_kmh"])
+        except Exception:
+            pass
+
+    return jsonify(ok=True, aceitos=aceitos, descartados=descartados,
+                   posicao_atualizada=bool(aplicado), **intervalo_ping(coop.id))
+
+
+# =============================
+# SOCKET.IO DO APP (NAMESPACE /mobile)
+# =============================
+# Mesmo fluxo de /api/mobile/ping, mas numa conexão só: o token é lido uma vez
+# no connect e o cooperado fica guardado por sid (sem decode nem query por ping).
+# Pela mesma conexão chegam 'nova_corrida' e 'entrega_atualizada' (sala cooperado_<id>).
+# Antes de fechar de propósito (sair / fim do turno) o app emite 'encerrar'.
+
+class CooperadoConectado:
+    """O pouco do Cooperado que o fluxo de pings usa (id/nome), sem objeto do ORM."""
+    __slots__ = ("id", "nome")
+
+    def __init__(self, cooperado):
+        self.id = cooperado.id
+        self.nome = cooperado.nome
+
+
+# sid -> CooperadoConectado
+CONEXOES_MOBILE = {}
+
+
+@socketio.on("connect", namespace=SOCKET_NS_MOBILE)
+def mobile_connect(auth=None):
+    token = (auth or {}).get("token") if isinstance(auth, dict) else None
     try:
-        emitir_posicao_motoboy(coop, lat, lng, v_kmh)
+        cooperado_id = int(ler_token_mobile(token).get("cooperado_id"))
     except Exception:
-        pass
+        return False  # recusa a conexão
 
-    return jsonify(ok=True)
+    coop = Cooperado.query.get(cooperado_id)
+    if not coop or not coop.ativo:
+        return False
+
+    CONEXOES_MOBILE[request.sid] = CooperadoConectado(coop)
+    join_room(f"cooperado_{coop.id}")
+    POSICOES.conectar(coop, request.sid)
+    emit("conectado", {"cooperado_id": coop.id, "nome": coop.nome, **intervalo_ping(coop.id)})
+
+
+@socketio.on("disconnect", namespace=SOCKET_NS_MOBILE)
+def mobile_disconnect(reason=None):
+    # sem motivo nesta versão do Socket.IO: saída de propósito vem antes por 'encerrar'
+    CONEXOES_MOBILE.pop(request.sid, None)
+    POSICOES.desconectar(request.sid)
+
+
+@socketio.on("encerrar", namespace=SOCKET_NS_MOBILE)
+def mobile_encerrar(data=None):
+    """App saiu / encerrou o turno: offline na hora (em vez de esperar o limite do ping)."""
+    CONEXOES_MOBILE.pop(request.sid, None)
+    POSICOES.desconectar(request.sid, encerrou=True)
+    disconnect()
+
+
+@socketio.on("ping", namespace=SOCKET_NS_MOBILE)
+def mobile_ping(data):
+    """
+    Um fix {"lat", "lng", "speed_mps", "heading", "accuracy", "t"} ou um lote {"fixes": [...]}.
+    Responde pelo ack: {"ok", "proximo_ping_s", "deslocamento_min_m", "modo_ping", ...}.
+    """
+    coop = CONEXOES_MOBILE.get(request.sid)
+    if coop is None:
+        return {"ok": False, "error": "nao_autenticado"}
+    data = data if isinstance(data, dict) else {}
+
+    if "fixes" in data:
+        itens = data.get("fixes")
+        if not isinstance(itens, list) or not itens:
+            return {"ok": False, "error": "fixes_vazio"}
+        if len(itens) > PING_LOTE_MAX:
+            return {"ok": False, "error": "lote_grande_demais", "max": PING_LOTE_MAX}
+        aceitos, descartados, aplicado = processar_lote_pings(coop, itens)
+        if aplicado:
+            emitir_posicao_motoboy(coop, aplicado["lat"], aplicado["lng"], aplicado["v_kmh"])
+        return {"ok": True, "aceitos": aceitos, "descartados": descartados,
+                "posicao_atualizada": bool(aplicado), **intervalo_ping(coop.id)}
+
+    fix = normalizar_fix(data)
+    if fix is None:
+        return {"ok": False, "error": "lat_lng_invalidos"}
+
+    aplicado = POSICOES.atualizar(coop, fix)
+    gravar_trajetos(SEGMENTADOR.processar(coop.id, [fix]))
+    registrar_chegadas(coop.id, [fix])
+    if aplicado:
+        emitir_posicao_motoboy(coop, fix["lat"], fix["lng"], fix["v_kmh"])
+    return {"ok": True, "posicao_atualizada": aplicado, **intervalo_ping(coop.id)}
+
+
+if __name__ == '__main__':
+    port = int(os.environ.get('PORT', 5000))
+    # importante rodar pelo socketio, não pelo app.run
+    socketio.run(app, host='0.0.0.0', port=port)
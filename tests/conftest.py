@@ -0,0 +1,19 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# app.py cria o banco e sobe as tarefas de fundo no import: aponta para um sqlite
+# temporário (e sem backplane externo) ANTES de importar.
+_DB_DIR = tempfile.mkdtemp(prefix="coopex-testes-")
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(_DB_DIR, "testes.db")
+os.environ.pop("BACKPLANE_URL", None)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as coopex  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def app_coopex():
+    return coopex
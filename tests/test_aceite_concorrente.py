@@ -0,0 +1,74 @@
+"""Aceite de corrida sob concorrência: só um motoboy pode ganhar a mesma entrega."""
+import threading
+from collections import Counter
+from datetime import datetime
+
+N_MOTOBOYS = 200
+
+
+def _cria_cenario(coopex, prefixo):
+    with coopex.app.app_context():
+        cooperados = [
+            coopex.Cooperado(nome=f"{prefixo}-{i}", senha_hash="x") for i in range(N_MOTOBOYS)
+        ]
+        coopex.db.session.add_all(cooperados)
+        entrega = coopex.Entrega(
+            cliente="Restaurante", bairro="Centro", valor=10, pagamento="Pix",
+            status="pendente", status_corrida="pendente", data_envio=datetime.utcnow(),
+        )
+        coopex.db.session.add(entrega)
+        coopex.db.session.commit()
+        return entrega.id, [c.id for c in cooperados]
+
+
+def test_um_unico_vencedor_entre_aceites_paralelos(app_coopex):
+    coopex = app_coopex
+    entrega_id, ids = _cria_cenario(coopex, "paralelo")
+
+    largada = threading.Barrier(N_MOTOBOYS)
+    respostas = {}
+
+    def aceitar(cid):
+        cliente = coopex.app.test_client()
+        with cliente.session_transaction() as s:
+            s["user_id"] = cid
+        largada.wait()
+        r = cliente.post("/cooperado/aceitar_entrega", json={"entrega_id": entrega_id})
+        respostas[cid] = (r.status_code, r.get_json())
+
+    threads = [threading.Thread(target=aceitar, args=(cid,)) for cid in ids]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(timeout=120)
+
+    assert len(respostas) == N_MOTOBOYS
+    codigos = Counter(code for code, _ in respostas.values())
+    assert codigos == {200: 1, 409: N_MOTOBOYS - 1}, codigos
+
+    vencedor = next(cid for cid, (code, _) in respostas.items() if code == 200)
+    for cid, (code, corpo) in respostas.items():
+        if cid != vencedor:
+            assert corpo["msg"] == "Essa entrega já foi aceita por outro motoboy."
+
+    with coopex.app.app_context():
+        entrega = coopex.db.session.get(coopex.Entrega, entrega_id)
+        assert entrega.cooperado_id == vencedor
+        assert entrega.status_corrida == "aceita"
+        assert entrega.versao == 2  # um único UPDATE passou
+
+
+def test_toque_repetido_do_vencedor_continua_aceito(app_coopex):
+    coopex = app_coopex
+    entrega_id, ids = _cria_cenario(coopex, "repetido")
+    cliente = coopex.app.test_client()
+    with cliente.session_transaction() as s:
+        s["user_id"] = ids[0]
+
+    primeiro = cliente.post("/cooperado/aceitar_entrega", json={"entrega_id": entrega_id})
+    segundo = cliente.post("/cooperado/aceitar_entrega", json={"entrega_id": entrega_id})
+
+    assert primeiro.status_code == 200
+    assert segundo.status_code == 200
+    with coopex.app.app_context():
+        assert coopex.db.session.get(coopex.Entrega, entrega_id).versao == 2
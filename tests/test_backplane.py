@@ -0,0 +1,237 @@
+"""BackplaneRedis (cliente RESP2 próprio) contra um servidor RESP mínimo em processo."""
+import pickle
+import queue
+import socket
+import socketserver
+import threading
+import time
+
+import pytest
+
+
+class _ServidorResp(socketserver.ThreadingTCPServer):
+    """O suficiente do protocolo Redis para o backplane: hashes, contadores, pub/sub, SET NX EX."""
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _Conexao)
+        self.lock = threading.Lock()
+        self.hashes = {}
+        self.chaves = {}
+        self.expira = {}
+        self.assinantes = {}  # canal -> [socket]
+        self.comandos = []
+
+    def derrubar_assinantes(self):
+        with self.lock:
+            socks = [s for lista in self.assinantes.values() for s in lista]
+            self.assinantes.clear()
+        for s in socks:
+            try:
+                s.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+def _resp(valor) -> bytes:
+    if valor is None:
+        return b"$-1\r\n"
+    if isinstance(valor, Exception):
+        return b"-ERR " + str(valor).encode() + b"\r\n"
+    if isinstance(valor, int):
+        return b":%d\r\n" % valor
+    if isinstance(valor, str):
+        return b"+" + valor.encode() + b"\r\n"
+    if isinstance(valor, list):
+        return b"*%d\r\n" % len(valor) + b"".join(_resp(v) for v in valor)
+    return b"$%d\r\n%s\r\n" % (len(valor), valor)
+
+
+class _Conexao(socketserver.StreamRequestHandler):
+    def handle(self):
+        srv = self.server
+        while True:
+            linha = self.rfile.readline()
+            if not linha:
+                return
+            args = []
+            for _ in range(int(linha[1:-2])):
+                n = int(self.rfile.readline()[1:-2])
+                args.append(self.rfile.read(n + 2)[:-2])
+            cmd = args[0].upper().decode()
+            with srv.lock:
+                srv.comandos.append(cmd)
+                agora = time.monotonic()
+                for k in [k for k, t in srv.expira.items() if t <= agora]:
+                    srv.chaves.pop(k, None)
+                    srv.expira.pop(k, None)
+                resposta = self._executar(srv, cmd, args, agora)
+            try:
+                self.wfile.write(_resp(resposta))
+            except OSError:
+                return
+
+    def _executar(self, srv, cmd, a, agora):
+        if cmd == "PUBLISH":
+            alvos = list(srv.assinantes.get(a[1], []))
+            for s in alvos:
+                try:
+                    s.sendall(_resp([b"message", a[1], a[2]]))
+                except OSError:
+                    pass
+            return len(alvos)
+        if cmd == "SUBSCRIBE":
+            srv.assinantes.setdefault(a[1], []).append(self.connection)
+            return [b"subscribe", a[1], 1]
+        if cmd == "HSET":
+            novo = a[2] not in srv.hashes.setdefault(a[1], {})
+            srv.hashes[a[1]][a[2]] = a[3]
+            return int(novo)
+        if cmd == "HGET":
+            return srv.hashes.get(a[1], {}).get(a[2])
+        if cmd == "HGETALL":
+            return [x for par in srv.hashes.get(a[1], {}).items() for x in par]
+        if cmd == "HDEL":
+            return int(srv.hashes.get(a[1], {}).pop(a[2], None) is not None)
+        if cmd == "INCR":
+            srv.chaves[a[1]] = str(int(srv.chaves.get(a[1], b"0")) + 1).encode()
+            return int(srv.chaves[a[1]])
+        if cmd == "EXPIRE":
+            srv.expira[a[1]] = agora + int(a[2])
+            return 1
+        if cmd == "GET":
+            return srv.chaves.get(a[1])
+        if cmd == "SET":
+            opcoes = [x.upper() for x in a[3:]]
+            if b"NX" in opcoes and a[1] in srv.chaves:
+                return None
+            srv.chaves[a[1]] = a[2]
+            if b"EX" in opcoes:
+                srv.expira[a[1]] = agora + int(a[3 + opcoes.index(b"EX") + 1])
+            return "OK"
+        return Exception(f"unknown command '{cmd}'")
+
+
+@pytest.fixture()
+def servidor():
+    srv = _ServidorResp()
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    yield srv
+    srv.shutdown()
+    srv.server_close()
+
+
+@pytest.fixture()
+def backplane(app_coopex, servidor):
+    host, porta = servidor.server_address
+    return app_coopex.BackplaneRedis(f"redis://{host}:{porta}/0")
+
+
+def _escutar_em_fila(bp, canal):
+    recebidos = queue.Queue()
+
+    def loop():
+        for msg in bp.escutar(canal):
+            recebidos.put(msg)
+
+    threading.Thread(target=loop, daemon=True).start()
+    return recebidos
+
+
+def _esperar_assinante(servidor, canal, n=1, prazo=5.0):
+    fim = time.monotonic() + prazo
+    while time.monotonic() < fim:
+        with servidor.lock:
+            if len(servidor.assinantes.get(canal.encode(), [])) >= n:
+                return
+        time.sleep(0.02)
+    raise AssertionError(f"ninguém assinou {canal}")
+
+
+def test_respostas_do_protocolo(app_coopex, backplane):
+    assert backplane.hget("nada", "x") is None                # bulk nulo
+    assert backplane.hgetall("nada") == {}                     # array vazio
+    backplane.hset("h", "a", "ação")
+    assert backplane.hget("h", "a") == "ação"                  # bulk em UTF-8
+    with pytest.raises(app_coopex.ErroBackplane):
+        backplane.comando("NAOEXISTE")                         # erro (-ERR)
+    assert backplane.comando("HSET", "h", "b", "2") == 1       # inteiro
+
+
+def test_hset_hgetall_hdel(backplane):
+    backplane.hset("posicoes", 1, '{"id": 1}')
+    backplane.hset("posicoes", 2, '{"id": 2}')
+    assert backplane.hgetall("posicoes") == {"1": '{"id": 1}', "2": '{"id": 2}'}
+    backplane.hdel("posicoes", 1)
+    assert backplane.hgetall("posicoes") == {"2": '{"id": 2}'}
+
+
+def test_incr_com_ttl(backplane, servidor):
+    assert [backplane.incr("taxa:x", ttl_s=1) for _ in range(3)] == [1, 2, 3]
+    # EXPIRE só na primeira ocorrência da janela
+    assert servidor.comandos.count("EXPIRE") == 1
+    time.sleep(1.1)
+    assert backplane.incr("taxa:x", ttl_s=1) == 1
+
+
+def test_publicar_e_escutar(backplane, servidor):
+    recebidos = _escutar_em_fila(backplane, "canal")
+    _esperar_assinante(servidor, "canal")
+    backplane.publicar("canal", "um")
+    backplane.publicar("canal", b"\x00dois")
+    assert recebidos.get(timeout=5) == b"um"
+    assert recebidos.get(timeout=5) == b"\x00dois"
+
+
+def test_gravar_e_publicar_em_pipeline(backplane, servidor):
+    recebidos = _escutar_em_fila(backplane, "posicoes")
+    _esperar_assinante(servidor, "posicoes")
+    backplane.gravar_e_publicar("posicoes", 7, "posicoes", '{"id": 7}')
+    assert recebidos.get(timeout=5) == b'{"id": 7}'
+    assert backplane.hget("posicoes", 7) == '{"id": 7}'
+    # a conexão continua sincronizada depois do pipeline (as duas respostas foram lidas)
+    assert backplane.incr("depois") == 1
+
+
+def test_escutar_reconecta_quando_a_assinatura_cai(backplane, servidor):
+    recebidos = _escutar_em_fila(backplane, "canal")
+    _esperar_assinante(servidor, "canal")
+    servidor.derrubar_assinantes()
+    _esperar_assinante(servidor, "canal")  # nova assinatura após o backoff
+    backplane.publicar("canal", "de novo")
+    assert recebidos.get(timeout=5) == b"de novo"
+
+
+def test_comando_reabre_conexao_perdida(backplane):
+    backplane.hset("h", "a", "1")
+    backplane._local.conn[0].close()
+    assert backplane.hget("h", "a") == "1"
+
+
+def test_lideranca(app_coopex, backplane, monkeypatch):
+    monkeypatch.setattr(app_coopex, "WORKER_ID", "worker-a")
+    assert backplane.lider("despacho", 1)
+    assert backplane.lider("despacho", 1)       # renova a própria concessão
+
+    monkeypatch.setattr(app_coopex, "WORKER_ID", "worker-b")
+    assert not backplane.lider("despacho", 1)   # outro worker não pega enquanto vale
+    assert backplane.lider("retencao", 1)       # tarefas diferentes, líderes independentes
+
+    time.sleep(1.1)
+    assert backplane.lider("despacho", 1)       # concessão expirou: B assume
+
+
+def test_gerenciador_socketio_pelo_backplane(app_coopex, backplane, servidor):
+    gerenciador = app_coopex.GerenciadorSocketBackplane(backplane)
+    recebidos = queue.Queue()
+
+    def loop():
+        for msg in gerenciador._listen():
+            recebidos.put(msg)
+
+    threading.Thread(target=loop, daemon=True).start()
+    _esperar_assinante(servidor, "socketio")
+    mensagem = {"method": "emit", "event": "x", "data": {"a": 1}, "room": "admins"}
+    gerenciador._publish(mensagem)
+    assert pickle.loads(recebidos.get(timeout=5)) == mensagem
@@ -0,0 +1,66 @@
+"""Mudanças feitas pelo cooperado chegam à linha do painel com a versão nova."""
+import time
+from datetime import datetime
+
+
+def _cria_entrega(coopex):
+    with coopex.app.app_context():
+        cooperado = coopex.Cooperado(nome="versao-painel", senha_hash="x")
+        coopex.db.session.add(cooperado)
+        coopex.db.session.flush()
+        entrega = coopex.Entrega(
+            cliente="Restaurante", bairro="Centro", valor=10, pagamento="Pix",
+            status="pendente", status_corrida="pendente", data_envio=datetime.utcnow(),
+            cooperado_id=cooperado.id,
+        )
+        coopex.db.session.add(entrega)
+        coopex.db.session.commit()
+        return entrega.id, cooperado.id
+
+
+def _versao_emitida(socket_admin, entrega_id, prazo=5.0):
+    fim = time.monotonic() + prazo
+    while time.monotonic() < fim:
+        for pacote in socket_admin.get_received():
+            if pacote["name"] != "entrega_atualizada":
+                continue
+            dados = pacote["args"][0]
+            if dados.get("id") == entrega_id:
+                return dados["versao"]
+        time.sleep(0.05)
+    raise AssertionError("entrega_atualizada não chegou ao painel")
+
+
+def test_aceite_atualiza_versao_do_painel(app_coopex):
+    coopex = app_coopex
+    entrega_id, cooperado_id = _cria_entrega(coopex)
+
+    admin = coopex.app.test_client()
+    with admin.session_transaction() as s:
+        s["is_admin"] = True
+    socket_admin = coopex.socketio.test_client(coopex.app, flask_test_client=admin)
+    assert socket_admin.is_connected()
+    socket_admin.get_received()
+
+    motoboy = coopex.app.test_client()
+    with motoboy.session_transaction() as s:
+        s["user_id"] = cooperado_id
+    r = motoboy.post("/cooperado/aceitar_entrega", json={"entrega_id": entrega_id, "versao": 1})
+    assert r.status_code == 200
+
+    # o painel edita a linha com a versão que recebeu pelo socket
+    versao = _versao_emitida(socket_admin, entrega_id)
+    assert versao == 2
+    r = admin.patch(f"/api/entregas/{entrega_id}/inline", json={"valor": "12,50", "versao": versao})
+    assert r.status_code == 200, r.get_json()
+    assert r.get_json()["versao"] == 3
+
+    # pagamento marcado pelo motoboy também sobe a versão da linha
+    r = motoboy.post(f"/cooperado/toggle_pagamento/{entrega_id}", json={"versao": 3})
+    assert r.status_code == 200
+    versao = _versao_emitida(socket_admin, entrega_id)
+    assert versao == 4
+    r = admin.patch(f"/api/entregas/{entrega_id}/inline", json={"status": "pendente", "versao": versao})
+    assert r.status_code == 200, r.get_json()
+
+    socket_admin.disconnect()